@@ -5,10 +5,13 @@ import argparse
 import cPickle as pkl
 import json
 import numpy
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from theano_util import (load_params, init_theano_params)
 from nmt import (build_sampler, pred_probs, build_model, prepare_data, init_params, gen_sample)
-from util import load_dict, load_config
+from util import load_dict, load_config, LRUCache, EncoderCache
 from compat import fill_options
+from lattice import WORD_DELIM
 import theano
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
@@ -17,20 +20,28 @@ use_noise = theano.shared(numpy.float32(0.))
 
 class ArcScorer(object):
     
-    def __init__(self, model):
-        '''Loads a Nematus NMT model
+    def __init__(self, models, state_cache_size=0, n_threads=1, encoder_cache_size=0):
+        '''Loads one Nematus NMT model, or several with the same vocabularies for ensemble scoring
         Sets the following fields in self:
-        - f_init: NMT initialization function
-        - f_next: NMT next function
+        - fs_init: NMT initialization function of each model
+        - fs_next: NMT next function of each model
         - word_dict: source mapping of word to id
         - word_dict_trag: target mapping of word to id
         - word_idict_trg: target mapping of id to word
-        For all these, we assume there is only one version, i.e. no ensemble
+        - state_cache: LRU cache of decoder steps, bounded by state_cache_size MB (None if 0)
+        - encoder_caches: cache of the encoder outputs of each model, bounded by encoder_cache_size MB each (None if 0)
+        - label_ids: target ids of each lattice label resolved so far (see label2ids())
+        - pool: thread pool that runs the models of an ensemble concurrently (None if n_threads is 1)
+        The dictionaries are those of the first model.
         '''
+        if isinstance(models, basestring):
+            models = [models]
+
         options = []
-        options.append(load_config(model))
-        # hacks for using old models with missing options
-        fill_options(options[-1])
+        for model in models:
+            options.append(load_config(model))
+            # hacks for using old models with missing options
+            fill_options(options[-1])
 
         dictionaries = options[0]['dictionaries']
         dictionaries_source = dictionaries[:-1]
@@ -61,21 +72,60 @@ class ArcScorer(object):
         word_idict_trg[0] = '<eos>'
         word_idict_trg[1] = 'UNK'
 
-        option = options[0]
-        params = init_params(option)
-        params = load_params(model, params)
-        tparams = init_theano_params(params)
-        f_init, f_next = build_sampler(tparams, option, use_noise, trng, return_alignment=False)
+        fs_init = []
+        fs_next = []
+        for model, option in zip(models, options):
+            params = init_params(option)
+            params = load_params(model, params)
+            tparams = init_theano_params(params)
+            f_init, f_next = build_sampler(tparams, option, use_noise, trng, return_alignment=False,
+                                           precompute_context=True)
+            fs_init.append(f_init)
+            fs_next.append(f_next)
 
-        self.f_init = f_init
-        self.f_next = f_next
+        self.fs_init = fs_init
+        self.fs_next = fs_next
         self.options = options
         self.word_dict = word_dicts[0]
         self.word_dict_trg = word_dict_trg
         self.word_idict_trg = word_idict_trg
+        self.init_caches(state_cache_size, n_threads, encoder_cache_size)
+
 
+    def init_caches(self, state_cache_size=0, n_threads=1, encoder_cache_size=0):
+        '''Sets up the caches and the thread pool of the models in self.fs_init and self.fs_next (see __init__())'''
         self.nmt_state_init = None
         self.nmt_context = None
+        self.nmt_projected_context = None
+
+        # Theano releases the GIL while it computes, so the models of an ensemble can run in threads
+        self.pool = None
+        if n_threads > 1 and len(self.fs_next) > 1:
+            self.pool = ThreadPool(min(n_threads, len(self.fs_next)))
+
+        # decoder steps computed for the current source sentence, keyed by (decoder state id, previous word).
+        # Each value holds the log-probability row for the next word, the next decoder state of each model and its id.
+        self.state_cache = None
+        if state_cache_size > 0:
+            self.state_cache = LRUCache(state_cache_size * 1024**2,
+                                        sizeof=lambda entry: entry[0].nbytes + sum(state.nbytes for state in entry[1]))
+        self.num_states = 0
+
+        # encoder outputs of source sentences seen before, e.g. when several lattices share a source sentence
+        self.encoder_caches = None
+        if encoder_cache_size > 0:
+            self.encoder_caches = [EncoderCache(encoder_cache_size * 1024**2) for f_init in self.fs_init]
+
+        # softmax rows computed by the most recent call of score_batch(), keyed like the state cache.
+        # Sibling arcs leaving the same lattice state share these rows instead of running f_next again.
+        self.last_steps = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+        # the vocabulary is fixed, so labels are resolved into ids once for all sentences
+        self.label_ids = {}
+        self.num_unk = 0
+        self.num_out_of_range = 0
 
         
     def src_sentence2id(self, sentence):
@@ -95,13 +145,96 @@ class ArcScorer(object):
 
     def set_source_sentence(self, sentence):
         '''This function needs to be called before running score()
-        Given a source sentence, it creates the initial NMT decoder state (self.nmt_state_init) as well as the bidirectional RNN encoding of the input context (self.nmt_context) by running f_init
+        Given a source sentence, it creates the initial NMT decoder states (self.nmt_state_init) as well as the bidirectional RNN encodings of the input context (self.nmt_context) and their projection for the attention model (self.nmt_projected_context) by running f_init of each model
+        (or by looking them up in the encoder cache)
         '''
         seq = self.src_sentence2id(sentence) + [[0]]
         sys.stderr.write("Set NMT src sent: {} {} ({} words)\n".format(sentence, seq, len(sentence.split())))
         self.source_sentence = numpy.array(seq).T.reshape([len(seq[0]), len(seq), 1])
-        self.nmt_state_init, input_rep = self.f_init(self.source_sentence)
-        self.nmt_context = numpy.tile(input_rep, [1, 1])
+        self.nmt_state_init = []
+        self.nmt_context = []
+        self.nmt_projected_context = []
+        for m, f_init in enumerate(self.fs_init):
+            if self.encoder_caches is not None:
+                state_init, input_rep, projected_input_rep = self.encoder_caches[m].encode(f_init, self.source_sentence)
+            else:
+                state_init, input_rep, projected_input_rep = f_init(self.source_sentence)
+            self.nmt_state_init.append(state_init)
+            self.nmt_context.append(input_rep)
+            self.nmt_projected_context.append(projected_input_rep)
+
+        # decoder states are only valid for the current source sentence
+        self.num_states = 1
+        self.last_steps = {}
+        if self.state_cache is not None:
+            self.state_cache.clear()
+
+
+    def initial_state(self):
+        '''Returns the decoder states before any target word has been produced'''
+        bos = -1 * numpy.ones((1,)).astype('int64') # beginning of sentence indicator
+        return {'nmt_state':self.nmt_state_init, 'prev_word':bos, 'id':0}
+
+
+    def label2ids(self, label):
+        '''
+        Convert an arc label into the tuple of target word ids it produces.
+        Epsilon words are dropped, <eos> is mapped to 0, and unknown words as well as words
+        outside the output layer of the model (n_words) to UNK; both are counted.
+        Results are memoized.
+        '''
+        ids = self.label_ids.get(label)
+        if ids is not None:
+            return ids
+
+        unk = self.word_dict_trg["UNK"]
+        n_words = self.options[0]['n_words']
+        ids = []
+        for word_str in label.split(WORD_DELIM):
+            if word_str == '<eps>':
+                continue
+            if word_str == '<eos>':
+                # NOTE: special processing for <eos>.
+                ids.append(0)
+            elif word_str in self.word_dict_trg:
+                idx = self.word_dict_trg[word_str]
+                if n_words and idx >= n_words:
+                    self.num_out_of_range += 1
+                    idx = unk
+                ids.append(idx)
+            else:
+                # NOTE: we might want to throw an exception rather than process UNK
+                self.num_unk += 1
+                ids.append(unk)
+
+        ids = tuple(ids)
+        self.label_ids[label] = ids
+        return ids
+
+
+    def arc2ids(self, arc):
+        '''Convert the label of an arc into the target word ids it produces, unless the arc carries them already'''
+        if arc.ids is not None:
+            return arc.ids
+        return self.label2ids(arc.label)
+
+
+    def prepare_graph(self, graph):
+        '''Resolves the labels of all arcs of a lattice into target ids before it is searched'''
+        graph.set_target_ids(self.label2ids)
+
+
+    def vocab_stats(self):
+        '''Describes how many lattice words were mapped to UNK when labels were resolved'''
+        return '{0} distinct labels, {1} unknown words, {2} words outside the output vocabulary'.format(
+            len(self.label_ids), self.num_unk, self.num_out_of_range)
+
+
+    def memo_stats(self):
+        '''Describes how often a softmax row was shared instead of computed'''
+        lookups = self.memo_hits + self.memo_misses
+        hit_rate = float(self.memo_hits) / lookups if lookups else 0.
+        return '{0} hits, {1} misses ({2:.1%} hit rate)'.format(self.memo_hits, self.memo_misses, hit_rate)
 
 
     def score(self, state, arc):
@@ -109,55 +242,107 @@ class ArcScorer(object):
         Given state and arc, return:
         - new state after decoding the word(s) given in arc.label
         - logProbability(word=arc.label | state, source_sentence) under the NMT model.
-        Note: a state here is is a tuple (NMT_state, previously_decoded_word)
+        Note: a state here is a dictionary of the NMT states of all models, the previously decoded word, and an id
         '''
+        return self.score_batch([(state, arc)])[0]
 
-        # If state was unset, default to the initial state
-        if state is None:
-            bos = -1 * numpy.ones((1,)).astype('int64') # beginning of sentence indicator
-            state = {'nmt_state':self.nmt_state_init, 'prev_word':bos}
 
-        logprob = 0.0
-        nmt_state, prev_word = state['nmt_state'], state['prev_word']
-        words = arc.words() # there may be multiple words in an arc, so process each successively
-        for word_str in words:
+    def score_batch(self, pairs):
+        '''
+        Batched version of score(). Given a list of (state, arc) pairs, return a list of
+        (new state, logProbability) tuples in the same order.
+        The decoder states and previous words of all pairs that still have a word left
+        to decode at a given position of their arc label are stacked into one matrix,
+        so there is one f_next call per word position rather than one per word and arc.
+        Each decoder step is computed at most once per call: hypotheses that share a decoder
+        state and previous word (e.g. sibling arcs) share one softmax row. Steps found in the
+        rows memoized by the previous call or in the state cache are not recomputed.
+        With an ensemble, the log-probabilities of the models are summed, as in gen_sample().
+        '''
+        nmt_states = []
+        prev_words = []
+        state_ids = []
+        words = []
+        for state, arc in pairs:
+            # If state was unset, default to the initial state
+            if state is None:
+                state = self.initial_state()
+            nmt_states.append(state['nmt_state'])
+            prev_words.append(state['prev_word'])
+            state_ids.append(state['id'])
+            # there may be multiple words in an arc, so process each successively
+            words.append(self.arc2ids(arc))
 
-            # if label is epsilon, do nothing (logprob+=0); else run NMT step
-            if word_str != '<eps>':
+        logprobs = numpy.zeros(len(pairs)).astype('float32')
+        memo = {}
+        maxlen = max([len(w) for w in words]) if words else 0
+        for pos in xrange(maxlen):
+            # hypotheses that still have a word to decode at this position
+            active = [i for i, w in enumerate(words) if len(w) > pos]
 
-                if word_str in self.word_dict_trg:
-                    word = self.word_dict_trg[word_str]
+            # decoder steps that are not memoized or cached, with one hypothesis to compute each of them from
+            missing = OrderedDict()
+            for i in active:
+                key = (state_ids[i], prev_words[i][0])
+                if key in memo or key in missing:
+                    self.memo_hits += 1
+                    continue
+                step = self.last_steps.get(key)
+                if step is not None:
+                    self.memo_hits += 1
+                else:
+                    self.memo_misses += 1
+                    if self.state_cache is not None:
+                        step = self.state_cache.get(key)
+                if step is None:
+                    missing[key] = i
                 else:
-                    # NOTE: we might want to throw an exception rather than process UNK
-                    word = self.word_dict_trg["UNK"] 
-                if word_str == '<eos>':
-                    # NOTE: special processing for <eos>.
-                    word = 0 
+                    memo[key] = step
 
-                # run one forward step of f_next(), 
+            if missing:
+                # run one forward step of f_next() of each model for all hypotheses not in the cache,
                 # returns probability distribution of next word, most probable next word, and the new NMT state
-                inps = [prev_word, self.nmt_context, nmt_state]
-                probdist, word_prediction, nmt_state_next = self.f_next(*inps)
-
+                prev_word = numpy.concatenate([prev_words[i] for i in missing.values()])
+                # all hypotheses share the context of the source sentence
+                hyp_sentences = numpy.zeros(len(missing), dtype='int64')
+                def _step(m):
+                    nmt_state = numpy.concatenate([nmt_states[i][m] for i in missing.values()])
+                    probdist, word_prediction, nmt_state_next = self.fs_next[m](prev_word, self.nmt_context[m],
+                                                                                self.nmt_projected_context[m],
+                                                                                nmt_state, hyp_sentences)
+                    return numpy.log(probdist), nmt_state_next
+                if self.pool is not None:
+                    steps = self.pool.map(_step, range(len(self.fs_next)))
+                else:
+                    steps = [_step(m) for m in xrange(len(self.fs_next))]
+                logprobdist = sum(logprobs_m for logprobs_m, _ in steps)
 
+                for row, key in enumerate(missing):
+                    step = (logprobdist[row], [nmt_state_next[row:row+1] for _, nmt_state_next in steps], self.num_states)
+                    self.num_states += 1
+                    if self.state_cache is not None:
+                        # copy, so that cached rows do not keep the whole batch alive
+                        step = (step[0].copy(), [state.copy() for state in step[1]], step[2])
+                        self.state_cache.put(key, step)
+                    memo[key] = step
 
-		#when a word is not in the distribution, unk it manually (and write it out to stderr)
-		if word >=  len(probdist[0]):
-			sys.stderr.write(str(word)+"\t") 
-        	        sys.stderr.write(str(word_str)+"\t")  
-			sys.stderr.write(str(len(probdist[0]))+"\t")  
-                        sys.stderr.write(str(type(probdist[0]))+"\t") 
-			sys.stderr.write("ARRAY OUT OF BOUNDS"+"\n")  
-			word = self.word_dict_trg["UNK"]
+            for i in active:
+                logprobdist, nmt_state_next, next_id = memo[(state_ids[i], prev_words[i][0])]
+                word = words[i][pos]
 
+                #when a word is not in the distribution, unk it manually (and write it out to stderr)
+                if word >= logprobdist.shape[0]:
+                    sys.stderr.write("{0}\t{1}\tARRAY OUT OF BOUNDS\n".format(word, logprobdist.shape[0]))
+                    word = self.word_dict_trg["UNK"]
 
                 # accumulate log probabilities
-                logprob += numpy.log(probdist[0][word])
-#                print "%s \t P(%s|...)=%f cumulativeLogProb=%f" %(arc, word_str, probdist[0][word], logprob)
+                logprobs[i] += logprobdist[word]
 
                 # reset NMT state and previously decoded word
-                nmt_state = nmt_state_next
-                prev_word = numpy.array([word]).astype('int64')
-
-        return {'nmt_state':nmt_state, 'prev_word':prev_word}, logprob
+                nmt_states[i] = nmt_state_next
+                prev_words[i] = numpy.array([word]).astype('int64')
+                state_ids[i] = next_id
 
+        self.last_steps = memo
+        return [({'nmt_state':nmt_states[i], 'prev_word':prev_words[i], 'id':state_ids[i]}, logprobs[i])
+                for i in xrange(len(pairs))]
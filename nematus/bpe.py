@@ -0,0 +1,120 @@
+'''
+Byte-pair encoding of lattice labels.
+
+Applies BPE merge operations learned with subword-nmt (learn_bpe.py) to words, the way
+subword-nmt's apply_bpe.py does, so that lattices can be segmented when they are loaded
+rather than by post-processing their symbol tables.
+'''
+
+import codecs
+
+from lattice import WORD_DELIM
+
+# labels that are never segmented
+SPECIAL_LABELS = frozenset(['<eps>', '<eos>', '</eos>', '<s>', '</s>', 'UNK'])
+
+def get_pairs(word):
+    '''Returns the set of adjacent symbol pairs in a word, given as a tuple of symbols'''
+    return set(zip(word[:-1], word[1:]))
+
+class BPE(object):
+    '''
+    Segments words into subword units with a list of BPE merge operations.
+
+    Segmentations are memoized: words in a cache that lives as long as the BPE object, and
+    complete lattice labels (words joined by WORD_DELIM) in another. A lattice loader that
+    keeps one BPE object for all sentences segments each distinct phrase only once.
+    '''
+
+    def __init__(self, codes_file, separator='@@'):
+        '''
+        codes_file is an open file with one merge operation per line, optionally preceded
+        by a "#version:" line, as written by learn_bpe.py.
+        '''
+        firstline = codes_file.readline()
+        if firstline.startswith('#version:'):
+            self.version = tuple(int(x) for x in firstline.split()[-1].split('.'))
+        else:
+            self.version = (0, 1)
+            codes_file.seek(0)
+
+        self.bpe_codes = {}
+        for line in codes_file:
+            pair = tuple(line.split())
+            if len(pair) == 2 and not pair in self.bpe_codes:
+                self.bpe_codes[pair] = len(self.bpe_codes)
+        self.separator = separator
+
+        self.word_cache = {}
+        self.label_cache = {}
+
+    @classmethod
+    def from_path(cls, path, separator='@@'):
+        with codecs.open(path, 'r', 'utf-8') as codes_file:
+            return cls(codes_file, separator)
+
+    def encode(self, word):
+        '''Returns the subword units of a (unicode) word as a tuple, without separators'''
+        if self.version == (0, 1):
+            symbols = tuple(word) + ('</w>',)
+        else:
+            symbols = tuple(word[:-1]) + (word[-1] + '</w>',)
+
+        pairs = get_pairs(symbols)
+        while pairs:
+            bigram = min(pairs, key=lambda pair: self.bpe_codes.get(pair, float('inf')))
+            if not bigram in self.bpe_codes:
+                break
+
+            first, second = bigram
+            merged = []
+            i = 0
+            while i < len(symbols):
+                if i < len(symbols) - 1 and symbols[i] == first and symbols[i+1] == second:
+                    merged.append(first + second)
+                    i += 2
+                else:
+                    merged.append(symbols[i])
+                    i += 1
+            symbols = tuple(merged)
+            pairs = get_pairs(symbols)
+
+        # remove the end-of-word marker
+        if symbols[-1] == '</w>':
+            symbols = symbols[:-1]
+        elif symbols[-1].endswith('</w>'):
+            symbols = symbols[:-1] + (symbols[-1][:-len('</w>')],)
+        return symbols
+
+    def segment_word(self, word):
+        '''Returns the subword units of a word, all but the last followed by the separator'''
+        units = self.word_cache.get(word)
+        if units is None:
+            if word in SPECIAL_LABELS or not word:
+                units = (word,)
+            else:
+                symbols = self.encode(word.decode('utf-8'))
+                units = tuple((symbol + self.separator).encode('utf-8') for symbol in symbols[:-1]) + \
+                        (symbols[-1].encode('utf-8'),)
+            self.word_cache[word] = units
+        return units
+
+    def segment_label(self, label):
+        '''
+        Segments a lattice label, a (UTF-8 encoded) string of words separated by WORD_DELIM,
+        into a label of subword units separated by WORD_DELIM.
+        '''
+        segmented = self.label_cache.get(label)
+        if segmented is None:
+            if label in SPECIAL_LABELS:
+                segmented = label
+            else:
+                segmented = WORD_DELIM.join(unit for word in label.split(WORD_DELIM)
+                                            for unit in self.segment_word(word))
+            self.label_cache[label] = segmented
+        return segmented
+
+    __call__ = segment_label
+
+    def stats(self):
+        return '{0} distinct labels, {1} distinct words'.format(len(self.label_cache), len(self.word_cache))
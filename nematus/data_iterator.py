@@ -21,7 +21,9 @@ class TextIterator:
                  skip_empty=False,
                  shuffle_each_epoch=False,
                  sort_by_length=True,
-                 maxibatch_size=20):
+                 maxibatch_size=20,
+                 return_index=False,
+                 skip_lines=0):
         if shuffle_each_epoch:
             self.source_orig = source
             self.target_orig = target
@@ -55,8 +57,18 @@ class TextIterator:
         self.shuffle = shuffle_each_epoch
         self.sort_by_length = sort_by_length
 
+        # with return_index, each batch also holds the line numbers of its sentence pairs,
+        # so that callers can restore the order of the corpus after sorting by length
+        self.return_index = return_index
+        self.line_idx = 0
+
+        # the first skip_lines sentence pairs are skipped (e.g. to resume scoring a corpus)
+        self.skip_lines = skip_lines
+        self.skip()
+
         self.source_buffer = []
         self.target_buffer = []
+        self.index_buffer = []
         self.k = batch_size * maxibatch_size
         
 
@@ -74,6 +86,14 @@ class TextIterator:
         else:
             self.source.seek(0)
             self.target.seek(0)
+        self.line_idx = 0
+        self.skip()
+
+    def skip(self):
+        for _ in xrange(self.skip_lines):
+            if self.source.readline() == "" or self.target.readline() == "":
+                break
+            self.line_idx += 1
 
     def next(self):
         if self.end_of_data:
@@ -83,6 +103,7 @@ class TextIterator:
 
         source = []
         target = []
+        index = []
 
         # fill buffer, if it's empty
         assert len(self.source_buffer) == len(self.target_buffer), 'Buffer size mismatch!'
@@ -98,6 +119,8 @@ class TextIterator:
 
                 self.source_buffer.append(ss.strip().split())
                 self.target_buffer.append(tt.strip().split())
+                self.index_buffer.append(self.line_idx)
+                self.line_idx += 1
 
             # sort by target buffer
             if self.sort_by_length:
@@ -106,13 +129,16 @@ class TextIterator:
 
                 _sbuf = [self.source_buffer[i] for i in tidx]
                 _tbuf = [self.target_buffer[i] for i in tidx]
+                _ibuf = [self.index_buffer[i] for i in tidx]
 
                 self.source_buffer = _sbuf
                 self.target_buffer = _tbuf
+                self.index_buffer = _ibuf
 
             else:
                 self.source_buffer.reverse()
                 self.target_buffer.reverse()
+                self.index_buffer.reverse()
 
         if len(self.source_buffer) == 0 or len(self.target_buffer) == 0:
             self.end_of_data = False
@@ -137,6 +163,7 @@ class TextIterator:
 
                 # read from source file and map to word index
                 tt = self.target_buffer.pop()
+                idx = self.index_buffer.pop()
                 tt = [self.target_dict[w] if w in self.target_dict else 1
                       for w in tt]
                 if self.n_words_target > 0:
@@ -149,6 +176,7 @@ class TextIterator:
 
                 source.append(ss)
                 target.append(tt)
+                index.append(idx)
 
                 if len(source) >= self.batch_size or \
                         len(target) >= self.batch_size:
@@ -158,6 +186,8 @@ class TextIterator:
 
         # all sentence pairs in maxibatch filtered out because of length
         if len(source) == 0 or len(target) == 0:
-            source, target = self.next()
+            return self.next()
 
+        if self.return_index:
+            return source, target, index
         return source, target
@@ -1,8 +1,22 @@
 """
-Lattice class. This represents a lattice. It supports loading from an OpenFST file.
+Lattice class. This represents a lattice. It supports loading from an OpenFST file
+or from a compact binary format, and from an archive that holds the lattices of many
+sentences in a single file.
 """
 
+import os
+import sys
+import mmap
+import struct
+import shutil
+import tempfile
+
 from heapq import *
+from array import array
+from operator import attrgetter
+from collections import defaultdict
+
+import numpy
 
 WORD_DELIM='|'
 
@@ -11,15 +25,18 @@ class Arc:
     tail = None
     label = None
     score = None
+    # target vocabulary ids of the words of the label, set by Graph.set_target_ids()
+    ids = None
 
     def __str__(self):
         return 'ARC[{} -> {} -> {}, {}]'.format(self.tail, self.label, self.head, self.score)
 
-    def __init__(self, tail, label, head, score):
+    def __init__(self, tail, label, head, score, words = None):
         self.tail = tail
         self.label = label
         self.head = head
         self.score = float(score)
+        self.wordlist = words
 
     def __hash__(self):
         return hash(self.tail, self.label, self.head)
@@ -28,7 +45,9 @@ class Arc:
         return (self.tail, self.label, self.head) == (other.tail, other.label, other.head)
 
     def words(self):
-        return self.label.split(WORD_DELIM)
+        if self.wordlist is None:
+            return self.label.split(WORD_DELIM)
+        return self.wordlist
 
     def numWords(self):
         return len(self.words())
@@ -69,6 +88,10 @@ class BestItem:
         self.arc = arc
         self.pathLength = pathLength
         self.prev = prevBest
+        # items that were recombined into this one, because they reached the same node with the same history
+        self.recombined = []
+        # the last target words of the path, if the search recombines items
+        self.history = ()
 
     def __str__(self):
         return 'ITEM[{}, {}, {}]'.format(self.arc, self.pathLength, self.score)
@@ -89,17 +112,193 @@ class BestItem:
         else:
             return self.score
 
+class Stack(object):
+    '''
+    A stack of the beam search over a lattice. Holds at most beam items: once it is full, an item is
+    only added if it is better than the worst item, which is then dropped. With a threshold, items
+    that are worse than the best item by more than the threshold are dropped as well. Items pushed
+    with the same recombination key are recombined into the best of them.
+    With normalize, items are compared by their length-normalized scores.
+    '''
+
+    def __init__(self, beam, threshold = None, normalize = False):
+        self.beam = beam
+        self.threshold = threshold
+        self.normalize = normalize
+        # entries [score, count, item, alive, key], with the worst item on top; items that lost
+        # in recombination are marked as not alive rather than removed
+        self.heap = []
+        self.keys = {}
+        self.size = 0
+        self.count = 0
+        self.best = float('-inf')
+        self.num_pruned = 0
+        self.num_recombined = 0
+
+    def _peek_worst(self):
+        while not self.heap[0][3]:
+            heappop(self.heap)
+        return self.heap[0]
+
+    def push(self, item, key = None):
+        '''Adds an item to the stack, unless it is pruned or recombined. Returns whether it was added.'''
+        score = item.normalizedScore() if self.normalize else item.score
+        if self.threshold is not None and score < self.best - self.threshold:
+            self.num_pruned += 1
+            return False
+
+        entry = None
+        if key is not None:
+            entry = self.keys.get(key)
+            if entry is not None:
+                self.num_recombined += 1
+                if score <= entry[0]:
+                    entry[2].recombined.append(item)
+                    return False
+                item.recombined.append(entry[2])
+                item.recombined.extend(entry[2].recombined)
+                entry[2].recombined = []
+                entry[3] = False
+                self.size -= 1
+
+        if self.size >= self.beam:
+            worst = self._peek_worst()
+            if score <= worst[0]:
+                self.num_pruned += 1
+                return False
+            heappop(self.heap)
+            self.size -= 1
+            self.num_pruned += 1
+            if self.keys.get(worst[4]) is worst:
+                del self.keys[worst[4]]
+
+        entry = [score, self.count, item, True, key]
+        self.count += 1
+        heappush(self.heap, entry)
+        self.size += 1
+        if key is not None:
+            self.keys[key] = entry
+        self.best = max(self.best, score)
+        return True
+
+    def items(self):
+        '''Returns the items of the stack, best first, without those that fell below the threshold'''
+        items = sorted((entry for entry in self.heap if entry[3]), key=lambda entry: (-entry[0], entry[1]))
+        if self.threshold is not None:
+            items = [entry for entry in items if entry[0] >= self.best - self.threshold]
+        return [entry[2] for entry in items]
+
+    def stats(self):
+        return '{0} pruned, {1} recombined'.format(self.num_pruned, self.num_recombined)
+
+class KBest(object):
+    '''
+    Lazy k-best extraction (Huang and Chiang, 2005, algorithm 3) over the back-pointers of a search.
+
+    Vertices are the nodes (walk()) or surviving items (beam_search()) of a search. incoming(v) returns
+    the candidate back-pointers of a vertex as (tail vertex, arc, transition score) triples; the root has
+    none. The score of a derivation is the score of the derivation of its tail plus the transition score,
+    so the arcs are never scored again: transition scores are those computed during the search, i.e.
+    for the best path to the tail.
+    '''
+
+    def __init__(self, incoming, root):
+        self.incoming = incoming
+        self.root = root
+        # for each vertex, its derivations found so far, best first, as (score, back-pointer index, tail rank)
+        self.derivations = {root: [(0., None, None)]}
+        # for each vertex, a heap of candidate derivations (negated score, back-pointer index, tail rank)
+        self.candidates = {}
+        self.edges = {}
+
+    def derivation(self, vertex, k):
+        '''Returns the k-th best derivation of vertex, counting from 0, or None if there are fewer'''
+        derivations = self.derivations.get(vertex)
+        if derivations is None:
+            derivations = self.derivations[vertex] = []
+            edges = self.edges[vertex] = self.incoming(vertex)
+            candidates = self.candidates[vertex] = []
+            for i, (tail, arc, transition) in enumerate(edges):
+                best = self.derivation(tail, 0)
+                if best is not None:
+                    candidates.append((-(best[0] + transition), i, 0))
+            heapify(candidates)
+
+        candidates = self.candidates.get(vertex, [])
+        while len(derivations) <= k and candidates:
+            negscore, i, rank = heappop(candidates)
+            derivations.append((-negscore, i, rank))
+            # the next best derivation through the same back-pointer
+            tail, arc, transition = self.edges[vertex][i]
+            following = self.derivation(tail, rank + 1)
+            if following is not None:
+                heappush(candidates, (-(following[0] + transition), i, rank + 1))
+
+        if k < len(derivations):
+            return derivations[k]
+        return None
+
+    def arcs(self, vertex, k):
+        '''Returns the score and the arcs of the k-th best derivation of vertex'''
+        score, i, rank = self.derivation(vertex, k)
+        arcs = []
+        # only the derivation of the root has no back-pointer
+        while i is not None:
+            vertex, arc, transition = self.edges[vertex][i]
+            if arc is not None:
+                arcs.append(arc)
+            _, i, rank = self.derivation(vertex, rank)
+        arcs.reverse()
+        return score, arcs
+
+    def nbest(self, vertex, n):
+        '''Returns up to n (score, arcs) pairs for the best derivations of vertex'''
+        results = []
+        for k in xrange(n):
+            if self.derivation(vertex, k) is None:
+                break
+            results.append(self.arcs(vertex, k))
+        return results
+
+class InterpolatedScorer(object):
+    '''
+    Wraps a scorer (e.g. an ArcScorer) and combines its score for an arc with the score read in
+    on the arc and a word penalty:
+
+        scorer_weight * score + arc_weight * arc.score + word_penalty * (number of words on the arc)
+
+    where <eps> does not count as a word, so that a single lattice search gives the final ranking.
+    '''
+
+    def __init__(self, scorer, scorer_weight = 1., arc_weight = 0., word_penalty = 0.):
+        self.scorer = scorer
+        self.scorer_weight = scorer_weight
+        self.arc_weight = arc_weight
+        self.word_penalty = word_penalty
+
+    def score(self, state, arc):
+        return self.score_batch([(state, arc)])[0]
+
+    def score_batch(self, pairs):
+        results = self.scorer.score_batch(pairs)
+        return [(newstate, self.scorer_weight * score + self.arc_weight * arc.score
+                 + self.word_penalty * sum(1 for word in arc.words() if word != '<eps>'))
+                for (state, arc), (newstate, score) in zip(pairs, results)]
+
 class Graph:
     def __str__(self):
         return `self.sentno`
 
-    def __init__(self, sentno, search_graph_file = None):
+    def __init__(self, sentno, search_graph_file = None, segmenter = None):
         self.sentno = sentno
         self.root = None
         self.nodelist = []
         self.arccount = 0
         self.finalstate = -1
         self.nodes = {}
+        # the words of each distinct label, shared by all arcs with that label
+        self.label_words = {}
+        self.segmenter = segmenter
         self.root = self.node(0)
 
         if search_graph_file is not None:
@@ -108,24 +307,64 @@ class Graph:
     def read_graph(self, search_graph_file):
         """
         Reads an OpenFST file and constructs a walkable graph.
+        If the graph has a segmenter (e.g. a bpe.BPE object), it is applied to every label.
         """
 
-        for line in search_graph_file:
-            try:
-                tail, head, source, target = line.rstrip().split(None, 3)
-            except ValueError:
-                self.finalstate = int(line.rstrip())
+        self.load_arcs(self.read_arcs(search_graph_file))
 
-            if len(target.split()) > 1:
-                target, score = target.split()
-            else:
-                score = 0.0
+    @classmethod
+    def from_arcs(cls, sentno, arcs, finalstate, segmenter = None):
+        """
+        Builds a graph from (tail, label, head, score) tuples.
+        """
+        graph = cls(sentno, segmenter = segmenter)
+        graph.finalstate = finalstate
+        graph.load_arcs(arcs)
+        return graph
+
+    def load_arcs(self, arcs):
+        """
+        Adds (tail, label, head, score) tuples as arcs, segmenting their labels if the graph has a segmenter.
+        """
+        segmenter = self.segmenter
+        for tail, label, head, score in arcs:
+            if segmenter is not None:
+                label = segmenter(label)
+            self.addArc(tail, label, head, score)
+
+        self.nodelist.sort(key=attrgetter('id'))
+
+    def arcs(self):
+        """
+        Yields all arcs as (tail, label, head, score) tuples, ordered by tail.
+        """
+        for node in self.nodelist:
+            for arc in node.getOutgoingArcs():
+                yield arc.tail.id, arc.label, arc.head.id, arc.score
+
+    def write_fst(self, f):
+        """
+        Writes the graph in OpenFST text format, as read by read_graph().
+        """
+        for tail, label, head, score in self.arcs():
+            f.write('{0} {1} {2} {2} {3}\n'.format(tail, head, label, 0.0 - score))
+        f.write('{0}\n'.format(self.finalstate))
 
-            tail = int(tail)
-            head = int(head)
-            self.addArc(tail, target, head, -float(score))
+    def read_arcs(self, search_graph_file):
+        """
+        Parses an OpenFST text file, yielding (tail, label, head, score) for each arc.
+        The final state is stored in self.finalstate.
+        """
 
-        self.nodelist = sorted(self.nodelist, cmp=lambda x, y: cmp(x.id, y.id))
+        for line in search_graph_file:
+            fields = line.split()
+            if len(fields) >= 4:
+                # tail head input-label output-label [weight]
+                score = -float(fields[4]) if len(fields) > 4 else 0.0
+                yield int(fields[0]), fields[3], int(fields[1]), score
+            elif fields:
+                # final state [weight]
+                self.finalstate = int(fields[0])
 
     #    print "graph[->{}] {} has {} nodes and {} arcs".format(graph.finalstate, graph.id(), graph.numnodes(), graph.numarcs())
 
@@ -140,136 +379,594 @@ class Graph:
         return self.arccount
 
     def addArc(self, tail, label, head, score):
-        arc = Arc(self.node(tail), label, self.node(head), score)
-        self.node(tail).addOutgoingArc(arc)
-        self.node(head).addIncomingArc(arc)
+        tailnode = self.node(tail)
+        headnode = self.node(head)
+        words = self.label_words.get(label)
+        if words is None:
+            words = self.label_words[label] = label.split(WORD_DELIM)
+        arc = Arc(tailnode, label, headnode, score, words)
+        tailnode.addOutgoingArc(arc)
+        headnode.addIncomingArc(arc)
         self.arccount += 1
 
+    def set_target_ids(self, label2ids):
+        """
+        Resolves the label of every arc into target vocabulary ids once, with label2ids, a function
+        from a label to a sequence of ids. Arcs with the same label share the resolved ids.
+        """
+        ids = dict((label, label2ids(label)) for label in self.label_words)
+        for node in self.nodelist:
+            for arc in node.getOutgoingArcs():
+                arc.ids = ids[arc.label]
+
     def node(self, id):
         id = int(id)
-        if not self.nodes.has_key(id):
+        node = self.nodes.get(id)
+        if node is None:
             node = Node(id)
             self.nodes[id] = node
             self.nodelist.append(node)
 
-        return self.nodes[id]
+        return node
 
     def score(self, state, arc):
         """The default scoring option. Returns the score read in on the arc, ignoring the old state and not returning a new one."""
         return None, arc.score
 
-    def extractBest(self, origitem, verbose = False):
-        words = []
+    def score_batch(self, pairs):
+        """Batched version of score(), taking a list of (state, arc) pairs."""
+        return [self.score(state, arc) for state, arc in pairs]
+
+    def extractBest(self, origitem, verbose = False, normalize = False):
+        arcs = []
         item = origitem
         while item.arc is not None:
-            words.insert(0, item.arc.label)
+            arcs.insert(0, item.arc)
             if verbose:
-                print "BESTARC: {}".format(item.arc)
+                print >>sys.stderr, "BESTARC: {}".format(item.arc)
             item = item.prev
 
-        return self.sentno, origitem.score, ' '.join(words).replace('<eps>','').replace(WORD_DELIM, ' ').strip()
+        score = origitem.normalizedScore() if normalize else origitem.score
+        return self.sentno, score, self.arcs2text(arcs)
+
+    def arcs2text(self, arcs):
+        return ' '.join(word for arc in arcs for word in arc.words() if word != '<eps>')
 
-    def beam_search(self, scorer = None, verbose = True, beam = 12):
+    def extractNBest(self, kbest, goal, nbest):
+        """Returns the nbest best paths to goal as a list of (sentno, score, text) tuples"""
+        return [(self.sentno, score, self.arcs2text(arcs)) for score, arcs in kbest.nbest(goal, nbest)]
+
+    def beam_search(self, scorer = None, verbose = True, beam = 12, threshold = None, history = None, nbest = None,
+                    normalize = False):
         '''
-        Performs beam search over the search graph. Paths are grouped by how many target words they represent, 
-        and cube pruning is applied to each.
+        Performs beam search over the search graph. Paths are grouped into stacks by how many target
+        words they represent. Each stack keeps at most beam items (histogram pruning), and, if
+        threshold is given, only items whose score is within threshold of the best item of the stack.
+        If history is given, items that reach the same node with the same last history words are
+        recombined: only the best of them is extended, the others are kept in its recombined list.
+        If nbest is given, returns a list of the nbest best paths, including recombined ones,
+        rather than only the best path. With normalize, complete paths are ranked by their
+        length-normalized scores; the items of a stack all have the same length. n-best lists are
+        ranked by unnormalized scores, so nbest cannot be combined with normalize.
         '''
+        if nbest is not None and normalize:
+            raise ValueError('n-best lists are ranked by unnormalized scores; nbest cannot be combined with normalize')
         if scorer is None:
             scorer = self
 
-        heaps = []
-        heaps.append([ BestItem(score = 0.) ])
+        startitem = BestItem(score = 0.)
+        stacks = [Stack(beam, threshold)]
+        stacks[0].push(startitem)
 
         # Any time we encounter a final state, it gets added here
-        finalitems = []
+        finalstack = Stack(beam, threshold, normalize)
 
         # iterate over the stacks
-        heapno = 0
-        while heapno < len(heaps):
-            heap = heaps[heapno]
-            if verbose: print "STACK {} WITH {} ITEMS".format(heapno, len(heap))
-
-            # Pop items off the stack, extending hypotheses and adding them into later stacks
-            beam_i = 0
-            while beam_i < beam and len(heap) > 0:
-                # Get the next item
-                item = heappop(heap)
+        stackno = 0
+        while stackno < len(stacks):
+            stack = stacks[stackno]
+            items = stack.items()
+            if verbose: print >>sys.stderr, "STACK {} WITH {} ITEMS ({})".format(stackno, len(items), stack.stats())
+
+            # Collect the outgoing arcs the surviving items of the stack can be extended with
+            extensions = []
+            for beam_i, item in enumerate(items):
                 if item.arc is not None:
                     node = item.arc.head
                 else:
-                    node = self.nodelist[0]
+                    node = self.root
 
-                if verbose: print "BEAM: POP {} -> {} ({} arcs)".format(beam_i, item, len(node.getOutgoingArcs()))
+                if verbose: print >>sys.stderr, "BEAM: POP {} -> {} ({} arcs)".format(beam_i, item, len(node.getOutgoingArcs()))
 
-                # Add its extensions
                 for arc in node.getOutgoingArcs():
-                    newstate, transitioncost = scorer.score(item.state, arc)
-                    score = item.score + transitioncost
-                    pathLength = item.pathLength + arc.numWords()
-
-                    nextstackno = heapno + arc.numWords()
-                    while len(heaps) <= nextstackno:
-                        heaps.append([])
-
-                    nextitem = BestItem(score, newstate, arc, pathLength, item)
-
-                    if len(arc.head.getOutgoingArcs()) == 0:
-                        heappush(finalitems, nextitem)
-                    else:
-                        heappush(heaps[nextstackno], nextitem)
+                    extensions.append((item, arc))
+
+            # Score all extensions of the popped items at once and add them into later stacks
+            results = scorer.score_batch([(item.state, arc) for item, arc in extensions])
+            for (item, arc), (newstate, transitioncost) in zip(extensions, results):
+                score = item.score + transitioncost
+                pathLength = item.pathLength + arc.numWords()
+
+                nextstackno = stackno + arc.numWords()
+                while len(stacks) <= nextstackno:
+                    stacks.append(Stack(beam, threshold))
+
+                nextitem = BestItem(score, newstate, arc, pathLength, item)
+                key = None
+                if history is not None:
+                    words = [word for word in arc.words() if word != '<eps>']
+                    nextitem.history = (item.history + tuple(words))[-history:] if history > 0 else ()
+                    key = (arc.head.id, nextitem.history)
+
+                if len(arc.head.getOutgoingArcs()) == 0:
+                    finalstack.push(nextitem, key)
+                else:
+                    stacks[nextstackno].push(nextitem, key)
 
-                    if verbose: print '  {} -> {}'.format(arc, score)
+                if verbose: print >>sys.stderr, '  {} -> {}'.format(arc, score)
 
-                beam_i += 1
+            stackno += 1
 
-            heapno += 1
+        finalitems = finalstack.items()
+        if nbest is not None:
+            # the alternatives to an item are the items recombined into it
+            def incoming(item):
+                if item is None:
+                    return [(finalitem, None, 0.) for finalitem in finalitems]
+                return [(alternative.prev, alternative.arc, alternative.score - alternative.prev.score)
+                        for alternative in [item] + item.recombined]
+            return self.extractNBest(KBest(incoming, startitem), None, nbest)
 
-        finalitem = heappop(finalitems)
-        result = self.extractBest(finalitem, verbose)
+        result = self.extractBest(finalitems[0], verbose, normalize)
         return result
 
 
-    def walk(self, scorer = None, normalize = False, verbose = False):
+    def walk(self, scorer = None, normalize = False, verbose = False, nbest = None):
+        '''
+        Finds the best path through the lattice with a single pass over its nodes in topological order.
+        With normalize, paths are compared by their length-normalized scores, which are also returned.
+        If nbest is given, returns a list of the nbest best paths, ranked by their unnormalized scores;
+        nbest cannot be combined with normalize.
+        '''
+        if nbest is not None and normalize:
+            raise ValueError('n-best lists are ranked by unnormalized scores; nbest cannot be combined with normalize')
 
         if scorer is None:
             scorer = self
 
-        # for each node, the best state, the word that produced it, and the cumulative score
+        # with nbest, all arcs into each node, with the transition scores computed from the best path to their tail
+        incoming = defaultdict(list)
+
+        # for each node, the best state, the word that produced it, and the cumulative score.
+        # Nodes are visited in topological order, so the best item of a node is final by the
+        # time its outgoing arcs are expanded.
         bestitems = {}
         for node in self.nodelist:
-            if verbose: print 'processing {} with {} incoming arcs'.format(node, len(node.getIncomingArcs()))
-            
-            best = None
-            for arc in node.getIncomingArcs():
-                prevBest = bestitems.get(arc.tail, BestItem(score = 0.))
-                oldscore, state = prevBest.score, prevBest.state
-                
-                newstate, transitioncost = scorer.score(state, arc)
-                score = oldscore + transitioncost
+            arcs = node.getOutgoingArcs()
+            if len(arcs) == 0:
+                continue
+
+            # nodes that cannot be reached from the root start no paths
+            if node == self.root:
+                prevBest = BestItem(score = 0.)
+            elif node in bestitems:
+                prevBest = bestitems[node]
+            else:
+                continue
+            if verbose:
+                if prevBest.arc is not None:
+                    print >>sys.stderr, 'best -> {} is {} ({})'.format(node, prevBest.arc.label, prevBest.arc.score)
+                print >>sys.stderr, 'processing {} with {} outgoing arcs'.format(node, len(arcs))
+
+            # score all outgoing arcs of the node with a single batched call
+            results = scorer.score_batch([(prevBest.state, arc) for arc in arcs])
+            for arc, (newstate, transitioncost) in zip(arcs, results):
+                score = prevBest.score + transitioncost
                 pathLength = prevBest.pathLength + arc.numWords()
+                best = bestitems.get(arc.head)
 
-                if verbose: print '  {} -> {}'.format(arc, score)
+                if verbose: print >>sys.stderr, '  {} -> {}'.format(arc, score)
+                if nbest is not None:
+                    incoming[arc.head].append((node, arc, transitioncost))
                 if normalize:
                     normalizedScore = score / float(pathLength)
                     if best is None or normalizedScore > best.normalizedScore():
                         if verbose: 
                             bestscore = best.normalizedScore() if best is not None else 0.
-                            print '  new best ({} > {})'.format(normalizedScore, bestscore)
-                        best = BestItem(score, newstate, arc, pathLength, prevBest)
+                            print >>sys.stderr, '  new best ({} > {})'.format(normalizedScore, bestscore)
+                        bestitems[arc.head] = BestItem(score, newstate, arc, pathLength, prevBest)
 
                 else:
                     if best is None or score > best.score:
                         if verbose: 
                             bestscore = best.score if best is not None else 0.
-                            print '  new best ({} > {})'.format(score, bestscore)
-                        best = BestItem(score, newstate, arc, pathLength, prevBest)
-
-            if best is not None:
-                bestitems[node] = best
-                if verbose: print 'best -> {} is {} ({})'.format(best.arc.head, best.arc.label, best.arc.score)
+                            print >>sys.stderr, '  new best ({} > {})'.format(score, bestscore)
+                        bestitems[arc.head] = BestItem(score, newstate, arc, pathLength, prevBest)
 
         # Now follow the backpointers to construct the final sentence
         finalnode = self.node(self.finalstate)
+        if nbest is not None:
+            return self.extractNBest(KBest(lambda node: incoming.get(node, []), self.root), finalnode, nbest)
+
         finalitem = bestitems[finalnode]
-        result = self.extractBest(finalitem, verbose)
+        result = self.extractBest(finalitem, verbose, normalize)
         return result
+
+
+class ArrayNode(object):
+    """A view of a node of an ArrayGraph, which behaves like a Node"""
+
+    __slots__ = ['graph', 'index', 'id']
+
+    def __init__(self, graph, index):
+        self.graph = graph
+        self.index = index
+        self.id = graph.node_id_list[index]
+
+    def __str__(self):
+        return 'NODE[{}]'.format(self.id)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return self.id == other.id
+
+    def getIncomingArcs(self):
+        graph = self.graph
+        arcs = graph.in_arcs[graph.in_offsets[self.index]:graph.in_offsets[self.index+1]]
+        return [ArrayArc(ArrayNode(graph, tail), graph.labels[label], self, score, graph.label_words[label], graph.label_ids_trg[label])
+                for tail, label, score in zip(graph.tails[arcs].tolist(),
+                                              graph.label_ids[arcs].tolist(),
+                                              graph.scores[arcs].tolist())]
+
+    def getOutgoingArcs(self):
+        graph = self.graph
+        begin, end = graph.out_offsets[self.index], graph.out_offsets[self.index+1]
+        return [ArrayArc(self, graph.labels[label], ArrayNode(graph, head), score, graph.label_words[label], graph.label_ids_trg[label])
+                for head, label, score in zip(graph.heads[begin:end].tolist(),
+                                              graph.label_ids[begin:end].tolist(),
+                                              graph.scores[begin:end].tolist())]
+
+class ArrayArc(object):
+    """An arc of an ArrayGraph, created on demand, which behaves like an Arc"""
+
+    __slots__ = ['tail', 'label', 'head', 'score', 'wordlist', 'ids']
+
+    def __init__(self, tail, label, head, score, words, ids=None):
+        self.tail = tail
+        self.label = label
+        self.head = head
+        self.score = score
+        self.wordlist = words
+        self.ids = ids
+
+    def __str__(self):
+        return 'ARC[{} -> {} -> {}, {}]'.format(self.tail, self.label, self.head, self.score)
+
+    def __eq__(self, other):
+        return (self.tail, self.label, self.head) == (other.tail, other.label, other.head)
+
+    def words(self):
+        return self.wordlist
+
+    def numWords(self):
+        return len(self.wordlist)
+
+class ArrayNodeList:
+    """The nodes of an ArrayGraph, sorted by id"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __len__(self):
+        return len(self.graph.node_ids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return ArrayNode(self.graph, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield ArrayNode(self.graph, index)
+
+class ArrayGraph(Graph):
+    """
+    A read-only graph stored in compressed sparse row format, rather than as Node and Arc objects.
+
+    Nodes are numbered densely in order of their ids (node_ids). Arcs are sorted by their tail,
+    and the outgoing arcs of node i are the arcs out_offsets[i] to out_offsets[i+1]. in_arcs lists
+    the arcs sorted by their head, and in_offsets delimits the incoming arcs of each node in it.
+    For each arc, tails, heads, label_ids and scores are kept in numpy arrays; labels holds the
+    distinct label strings.
+
+    Nodes and arcs are handed out as lightweight views, so walk() and beam_search() work unchanged.
+    Only the node ids are also kept as a Python list, for fast lookup by the views.
+
+    The arcs are set all at once when the graph is read or converted; addArc() raises a TypeError.
+    """
+
+    def __init__(self, sentno, search_graph_file = None, segmenter = None):
+        self.sentno = sentno
+        self.finalstate = -1
+        self.segmenter = segmenter
+        self.set_arcs([], [], [], [], [])
+
+        if search_graph_file is not None:
+            self.read_graph(search_graph_file)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Converts a Graph into an ArrayGraph"""
+        return cls.from_arcs(graph.sentno, graph.arcs(), graph.finalstate)
+
+    def load_arcs(self, arcs):
+        """
+        Stores (tail, label, head, score) tuples as arrays. Replaces any previous arcs.
+        If the graph has a segmenter, it is applied once to each distinct label.
+        """
+
+        tails = array('i')
+        heads = array('i')
+        label_ids = array('i')
+        scores = array('f')
+        labeldict = {}
+        for tail, label, head, score in arcs:
+            tails.append(tail)
+            heads.append(head)
+            label_ids.append(labeldict.setdefault(label, len(labeldict)))
+            scores.append(score)
+
+        labels = sorted(labeldict, key=labeldict.get)
+        if self.segmenter is not None:
+            labels = [self.segmenter(label) for label in labels]
+        self.set_arcs(tails, heads, label_ids, scores, labels)
+
+    def set_arcs(self, tails, heads, label_ids, scores, labels):
+        """
+        Replaces the arcs of the graph.
+        tails and heads contain node ids, label_ids index into labels.
+        """
+
+        tails = numpy.asarray(tails, dtype='int32')
+        heads = numpy.asarray(heads, dtype='int32')
+
+        # the root (node 0) always exists
+        node_ids = numpy.unique(numpy.concatenate([[0], tails, heads])).astype('int32')
+        tails = numpy.searchsorted(node_ids, tails).astype('int32')
+        heads = numpy.searchsorted(node_ids, heads).astype('int32')
+
+        # sort arcs by tail; a stable sort keeps the order of the input among the arcs of a node
+        order = numpy.argsort(tails, kind='mergesort')
+        in_arcs = numpy.argsort(heads[order], kind='mergesort').astype('int32')
+        all_nodes = numpy.arange(len(node_ids) + 1)
+
+        self.set_arrays(node_ids,
+                        tails[order],
+                        heads[order],
+                        numpy.asarray(label_ids, dtype='int32')[order],
+                        numpy.asarray(scores, dtype='float32')[order],
+                        numpy.searchsorted(tails[order], all_nodes).astype('int32'),
+                        in_arcs,
+                        numpy.searchsorted(heads[order][in_arcs], all_nodes).astype('int32'),
+                        list(labels))
+
+    def set_arrays(self, node_ids, tails, heads, label_ids, scores, out_offsets, in_arcs, in_offsets, labels):
+        """
+        Sets the arrays of the graph as they are, without sorting them.
+        """
+
+        self.node_ids = node_ids
+        self.node_id_list = node_ids.tolist()
+        self.tails = tails
+        self.heads = heads
+        self.label_ids = label_ids
+        self.scores = scores
+        self.out_offsets = out_offsets
+        self.in_arcs = in_arcs
+        self.in_offsets = in_offsets
+        self.labels = labels
+        self.label_words = [label.split(WORD_DELIM) for label in labels]
+        self.label_ids_trg = [None] * len(labels)
+
+        self.nodelist = ArrayNodeList(self)
+        self.root = self.node(0)
+
+    def numnodes(self):
+        return len(self.node_ids)
+
+    def numarcs(self):
+        return len(self.tails)
+
+    def set_target_ids(self, label2ids):
+        """Resolves each distinct label into target vocabulary ids once (see Graph.set_target_ids())"""
+        self.label_ids_trg = [label2ids(label) for label in self.labels]
+
+    def addArc(self, tail, label, head, score):
+        raise TypeError('ArrayGraph is read-only; build a Graph and convert it with ArrayGraph.from_graph()')
+
+    def to_binary(self):
+        """
+        Serializes the graph into the binary lattice format (see read_lattice()).
+        """
+
+        labels = '\n'.join(self.labels)
+        header = struct.pack(BINARY_HEADER, BINARY_MAGIC, len(self.node_ids), len(self.tails), len(labels), self.finalstate)
+        arrays = [self.node_ids, self.tails, self.heads, self.label_ids, self.out_offsets, self.in_arcs, self.in_offsets]
+        return ''.join([header] +
+                       [a.astype('<i4').tostring() for a in arrays] +
+                       [self.scores.astype('<f4').tostring(), labels])
+
+    @classmethod
+    def from_binary(cls, sentno, data, segmenter = None):
+        """
+        Loads a graph from the binary lattice format. data is any buffer (a string, mmap or buffer());
+        the arrays of the graph are views into it rather than copies. A segmenter is applied to
+        the labels, which are stored only once each.
+        """
+
+        magic, num_nodes, num_arcs, labels_size, finalstate = struct.unpack_from(BINARY_HEADER, data)
+        if magic != BINARY_MAGIC:
+            raise ValueError('not a binary lattice')
+
+        offset = struct.calcsize(BINARY_HEADER)
+        arrays = []
+        for dtype, count in [('<i4', num_nodes), ('<i4', num_arcs), ('<i4', num_arcs), ('<i4', num_arcs),
+                             ('<i4', num_nodes + 1), ('<i4', num_arcs), ('<i4', num_nodes + 1), ('<f4', num_arcs)]:
+            arrays.append(numpy.frombuffer(data, dtype=dtype, count=count, offset=offset))
+            offset += 4 * count
+        node_ids, tails, heads, label_ids, out_offsets, in_arcs, in_offsets, scores = arrays
+        labels = str(data[offset:offset+labels_size]).split('\n')
+        if segmenter is not None:
+            labels = [segmenter(label) for label in labels]
+
+        graph = cls(sentno)
+        graph.finalstate = finalstate
+        graph.set_arrays(node_ids, tails, heads, label_ids, scores, out_offsets, in_arcs, in_offsets, labels)
+        return graph
+
+    def to_graph(self):
+        """Converts the ArrayGraph into a Graph of Node and Arc objects"""
+        graph = Graph(self.sentno)
+        graph.finalstate = self.finalstate
+        for node in self.nodelist:
+            graph.node(node.id)
+        for node in self.nodelist:
+            for arc in node.getOutgoingArcs():
+                graph.addArc(node.id, arc.label, arc.head.id, arc.score)
+        return graph
+
+    def node(self, id):
+        id = int(id)
+        index = numpy.searchsorted(self.node_ids, id)
+        if index == len(self.node_ids) or self.node_ids[index] != id:
+            raise KeyError(id)
+        return ArrayNode(self, index)
+
+
+# binary lattice format: a header (magic, number of nodes, number of arcs, size of the labels, final state),
+# followed by the int32 arrays node_ids, tails, heads, label_ids, out_offsets, in_arcs and in_offsets
+# of an ArrayGraph, its float32 scores, and its labels separated by newlines. All numbers are little-endian.
+BINARY_MAGIC = 'LATBIN01'
+BINARY_HEADER = '<8siiii'
+
+def read_lattice(sentno, data, backend=Graph, segmenter=None):
+    """
+    Loads the lattice of a sentence from a buffer that holds it either in OpenFST text format
+    or in the binary lattice format. Returns an instance of backend (Graph or ArrayGraph).
+    If a segmenter (e.g. a bpe.BPE object) is given, it is applied to the labels.
+    """
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        graph = ArrayGraph.from_binary(sentno, data, segmenter)
+        if backend is not ArrayGraph:
+            graph = graph.to_graph()
+        return graph
+    return backend(sentno, str(data).splitlines(), segmenter)
+
+ARCHIVE_MAGIC = 'LATTICE-ARCHIVE'
+ARCHIVE_VERSION = 1
+
+class LatticeArchive:
+    """
+    Read access to many lattices stored in a single file.
+
+    The archive starts with a text header: a line "LATTICE-ARCHIVE <version> <number of lattices>",
+    followed by one line "<sentno> <offset> <length>" per lattice. The lattices follow the header;
+    offsets count bytes from the end of the header. Only the header is read when the archive is
+    opened; lattices are read lazily, through mmap by default.
+    """
+
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        self.file = open(path, 'rb')
+
+        magic, version, num_entries = self.file.readline().split()
+        if magic != ARCHIVE_MAGIC or int(version) != ARCHIVE_VERSION:
+            raise ValueError('{0} is not a lattice archive (version {1})'.format(path, ARCHIVE_VERSION))
+
+        self.index = {}
+        self.order = []
+        for _ in xrange(int(num_entries)):
+            sentno, offset, length = map(int, self.file.readline().split())
+            self.index[sentno] = (offset, length)
+            self.order.append(sentno)
+        self.data_start = self.file.tell()
+
+        self.mmap = None
+        if use_mmap and os.path.getsize(path) > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, sentno):
+        return sentno in self.index
+
+    def sentnos(self):
+        """The sentence numbers in the order in which they are stored"""
+        return list(self.order)
+
+    def read(self, sentno):
+        """
+        Returns the serialized lattice of a sentence. With mmap, this is a buffer into the
+        mapped file rather than a copy.
+        """
+        offset, length = self.index[sentno]
+        start = self.data_start + offset
+        if self.mmap is not None:
+            return buffer(self.mmap, start, length)
+        self.file.seek(start)
+        return self.file.read(length)
+
+    def graph(self, sentno, backend=Graph, segmenter=None):
+        """Returns the lattice of a sentence as a Graph (or another backend, e.g. ArrayGraph)"""
+        return read_lattice(sentno, self.read(sentno), backend, segmenter)
+
+    def __iter__(self):
+        """Iterates over (sentno, Graph) pairs in storage order, i.e. with sequential I/O"""
+        for sentno in self.order:
+            yield sentno, self.graph(sentno)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+class LatticeArchiveWriter:
+    """
+    Writes a LatticeArchive. Lattices are added one at a time and buffered in a temporary
+    file, because the header with their offsets has to precede them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.size = 0
+        self.data = tempfile.TemporaryFile(prefix='lattice-archive', dir=os.path.dirname(os.path.abspath(path)))
+
+    def add(self, sentno, data):
+        """Adds the serialized lattice (OpenFST text or binary) of a sentence"""
+        self.data.write(data)
+        self.entries.append((sentno, self.size, len(data)))
+        self.size += len(data)
+
+    def close(self):
+        with open(self.path, 'wb') as f:
+            f.write('{0} {1} {2}\n'.format(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(self.entries)))
+            for entry in self.entries:
+                f.write('{0} {1} {2}\n'.format(*entry))
+            self.data.seek(0)
+            shutil.copyfileobj(self.data, f)
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.data.close()
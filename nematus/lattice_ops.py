@@ -0,0 +1,224 @@
+'''
+Operations on lattices, for preparing them for rescoring without OpenFST:
+pruning, epsilon removal, determinization and topological sorting.
+
+Each operation takes a Graph (or ArrayGraph) and returns a new graph of the same class.
+Weights are the scores of the arcs (higher is better), so the operations work in the
+tropical semiring with max in place of min: a path is as good as its best scoring path.
+Lattices are assumed to be acyclic, with a single final state.
+
+preprocess() chains the operations like the OpenFST pipeline
+
+    fstprune | fstrmepsilon | fstdeterminize | fstminimize | fsttopsort
+
+except for minimization.
+'''
+
+from collections import defaultdict, deque
+
+EPSILON = '<eps>'
+
+# residual weights of determinized states are rounded to this many digits,
+# so that subsets that differ only by rounding errors are merged
+RESIDUAL_DIGITS = 5
+
+def _rebuild(graph, arcs, finalstate):
+    return graph.__class__.from_arcs(graph.sentno, arcs, finalstate)
+
+def topological_order(arcs, root=0):
+    '''
+    Returns the ids of all nodes of the arcs, and the root, in topological order, starting
+    with the root. Raises a ValueError if the arcs contain a cycle.
+    '''
+    outarcs = defaultdict(list)
+    indegree = defaultdict(int)
+    indegree[root] = 0
+    for tail, label, head, score in arcs:
+        outarcs[tail].append(head)
+        indegree.setdefault(tail, 0)
+        indegree[head] += 1
+
+    if indegree[root] > 0:
+        raise ValueError('the root of the lattice has incoming arcs')
+
+    # nodes without incoming arcs other than the root are unreachable, but still ordered
+    queue = deque([root] + sorted(node for node, n in indegree.iteritems() if n == 0 and node != root))
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for head in outarcs[node]:
+            indegree[head] -= 1
+            if indegree[head] == 0:
+                queue.append(head)
+
+    if len(order) < len(indegree):
+        raise ValueError('the lattice is not acyclic')
+    return order
+
+def best_scores(arcs, order, root, finalstate):
+    '''
+    Returns the scores of the best paths from the root to each node (forward), and from each node
+    to the final state (backward), as dictionaries. Unreachable nodes are missing.
+    '''
+    outarcs = defaultdict(list)
+    for tail, label, head, score in arcs:
+        outarcs[tail].append((head, score))
+
+    forward = {root: 0.0}
+    for node in order:
+        if node in forward:
+            for head, score in outarcs[node]:
+                if forward[node] + score > forward.get(head, float('-inf')):
+                    forward[head] = forward[node] + score
+
+    backward = {finalstate: 0.0}
+    for node in reversed(order):
+        for head, score in outarcs[node]:
+            if head in backward and score + backward[head] > backward.get(node, float('-inf')):
+                backward[node] = score + backward[head]
+
+    return forward, backward
+
+def prune(graph, threshold):
+    '''
+    Removes all arcs that are not on a path whose score is within threshold of the best path,
+    like fstprune --weight=threshold. Arcs that are on no complete path are removed as well.
+    '''
+    arcs = list(graph.arcs())
+    root = graph.root.id
+    forward, backward = best_scores(arcs, topological_order(arcs, root), root, graph.finalstate)
+    if not root in backward:
+        raise ValueError('the final state of lattice {0} is not reachable'.format(graph.sentno))
+
+    limit = backward[root] - threshold
+    kept = [(tail, label, head, score) for tail, label, head, score in arcs
+            if tail in forward and head in backward and forward[tail] + score + backward[head] >= limit]
+    return _rebuild(graph, kept, graph.finalstate)
+
+def connect(graph):
+    '''
+    Removes all arcs that are not on a path from the root to the final state.
+    '''
+    return prune(graph, float('inf'))
+
+def rmepsilon(graph):
+    '''
+    Removes <eps> arcs: every node gets the non-epsilon arcs of the nodes it reaches through
+    epsilon arcs, with the score of the best epsilon path added, like fstrmepsilon.
+    A Graph has a single final state, so nodes that reach it through epsilon arcs keep one
+    <eps> arc to it, with the score of the best epsilon path.
+    '''
+    arcs = list(graph.arcs())
+    root, finalstate = graph.root.id, graph.finalstate
+    order = topological_order(arcs, root)
+
+    outarcs = defaultdict(list)
+    for arc in arcs:
+        outarcs[arc[0]].append(arc)
+
+    position = dict((node, i) for i, node in enumerate(order))
+    result = []
+    for node in order:
+        # the best epsilon path from node to each node of its epsilon closure, following
+        # the nodes in topological order so that each is final before its arcs are followed
+        closure = {node: 0.0}
+        for current in sorted(_epsilon_reachable(node, outarcs), key=position.get):
+            for tail, label, head, score in outarcs[current]:
+                if label == EPSILON and closure[current] + score > closure.get(head, float('-inf')):
+                    closure[head] = closure[current] + score
+
+        for member, weight in sorted(closure.iteritems(), key=lambda item: position[item[0]]):
+            for tail, label, head, score in outarcs[member]:
+                if label != EPSILON:
+                    result.append((node, label, head, weight + score))
+        if node != finalstate and finalstate in closure:
+            result.append((node, EPSILON, finalstate, closure[finalstate]))
+
+    return connect(_rebuild(graph, result, finalstate))
+
+def _epsilon_reachable(node, outarcs):
+    '''Returns the set of nodes reachable from node through epsilon arcs, including node'''
+    reachable = set([node])
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        for tail, label, head, score in outarcs[current]:
+            if label == EPSILON and not head in reachable:
+                reachable.add(head)
+                stack.append(head)
+    return reachable
+
+def determinize(graph):
+    '''
+    Weighted determinization (Mohri, 1997): returns an equivalent lattice in which no node has
+    two outgoing arcs with the same label, and every string of labels keeps the score of its
+    best path. Each node of the result stands for a set of nodes of the input, each with its
+    residual score, the difference to the best path that reaches it.
+
+    The lattice must be epsilon-free (see rmepsilon()), except for <eps> arcs into the final
+    state, which rmepsilon() keeps. The final state must have no outgoing arcs, and the labels that lead to it must not lead anywhere else from the same set of nodes;
+    this holds when it is only reached through <eos> arcs. Like fstdeterminize, the nodes of the
+    result are numbered in order of discovery, not topologically (see topsort()).
+    '''
+    arcs = list(graph.arcs())
+    root, finalstate = graph.root.id, graph.finalstate
+
+    outarcs = defaultdict(list)
+    for arc in arcs:
+        if arc[1] == EPSILON and arc[2] != finalstate:
+            raise ValueError('lattice {0} has epsilon arcs; remove them before determinizing'.format(graph.sentno))
+        outarcs[arc[0]].append(arc)
+    if outarcs[finalstate]:
+        raise ValueError('the final state of lattice {0} has outgoing arcs'.format(graph.sentno))
+
+    final_subset = ((finalstate, 0.0),)
+    start = ((root, 0.0),)
+    ids = {start: 0, final_subset: 1}
+    queue = deque([start])
+    result = []
+    while queue:
+        subset = queue.popleft()
+
+        # the best score of every node reached with each label
+        reached = defaultdict(dict)
+        for node, residual in subset:
+            for tail, label, head, score in outarcs[node]:
+                heads = reached[label]
+                if residual + score > heads.get(head, float('-inf')):
+                    heads[head] = residual + score
+
+        for label in sorted(reached):
+            heads = reached[label]
+            weight = max(heads.itervalues())
+            next_subset = tuple(sorted((head, round(score - weight, RESIDUAL_DIGITS))
+                                       for head, score in heads.iteritems()))
+            if finalstate in heads and next_subset != final_subset:
+                raise ValueError('label {0} of lattice {1} leads both to the final state and elsewhere'.format(label, graph.sentno))
+
+            if not next_subset in ids:
+                ids[next_subset] = len(ids)
+                queue.append(next_subset)
+            result.append((ids[subset], label, ids[next_subset], weight))
+
+    return _rebuild(graph, result, ids[final_subset])
+
+def topsort(graph):
+    '''
+    Renumbers the nodes in topological order, starting with the root as node 0, like fsttopsort.
+    walk() relies on node ids being in topological order.
+    '''
+    arcs = list(graph.arcs())
+    order = topological_order(arcs, graph.root.id)
+    ids = dict((node, i) for i, node in enumerate(order))
+    return _rebuild(graph, [(ids[tail], label, ids[head], score) for tail, label, head, score in arcs],
+                    ids.get(graph.finalstate, graph.finalstate))
+
+def preprocess(graph, threshold=None):
+    '''
+    Prepares a lattice for rescoring: prunes it (if a threshold is given), removes epsilon arcs,
+    determinizes it and sorts it topologically.
+    '''
+    if threshold is not None:
+        graph = prune(graph, threshold)
+    return topsort(determinize(rmepsilon(graph)))
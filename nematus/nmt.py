@@ -221,8 +221,6 @@ def build_encoder(tparams, options, trng, use_noise, x_mask=None, sampling=False
 
 # build a training model
 def build_model(tparams, options):
-    opt_ret = dict()
-
     trng = RandomStreams(1234)
     use_noise = theano.shared(numpy.float32(0.))
 
@@ -234,7 +232,26 @@ def build_model(tparams, options):
     y_mask.tag.test_value = numpy.ones(shape=(8, 10)).astype('float32')
 
     x, ctx = build_encoder(tparams, options, trng, use_noise, x_mask, sampling=False)
-    n_samples = x.shape[2]
+
+    # mean of the context (across time) will be used to initialize decoder rnn
+    ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+
+    # or you can use the last state of forward + backward encoder rnns
+    # ctx_mean = concatenate([proj[0][-1], projr[0][-1]], axis=proj[0].ndim-2)
+
+    opt_ret, cost = build_decoder(tparams, options, trng, use_noise, ctx, x_mask, y, y_mask, ctx_mean=ctx_mean)
+
+    #print "Print out in build_model()"
+    #print opt_ret
+    return trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost
+
+
+# build the decoder of a training model on top of the encoder context.
+# The initial decoder state is computed from ctx_mean, unless it is given as init_state.
+def build_decoder(tparams, options, trng, use_noise, ctx, x_mask, y, y_mask, ctx_mean=None, init_state=None):
+    opt_ret = dict()
+
+    n_samples = y.shape[1]
     n_timesteps_trg = y.shape[0]
 
     if options['use_dropout']:
@@ -255,18 +272,13 @@ def build_model(tparams, options):
         emb_dropout_d = theano.shared(numpy.array([1.]*2, dtype='float32'))
         ctx_dropout_d = theano.shared(numpy.array([1.]*4, dtype='float32'))
 
-    # mean of the context (across time) will be used to initialize decoder rnn
-    ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+    if init_state is None:
+        if options['use_dropout']:
+            ctx_mean *= shared_dropout_layer((n_samples, 2*options['dim']), use_noise, trng, retain_probability_hidden, scaled)
 
-    # or you can use the last state of forward + backward encoder rnns
-    # ctx_mean = concatenate([proj[0][-1], projr[0][-1]], axis=proj[0].ndim-2)
-
-    if options['use_dropout']:
-        ctx_mean *= shared_dropout_layer((n_samples, 2*options['dim']), use_noise, trng, retain_probability_hidden, scaled)
-
-    # initial decoder state
-    init_state = get_layer_constr('ff')(tparams, ctx_mean, options,
-                                    prefix='ff_state', activ='tanh')
+        # initial decoder state
+        init_state = get_layer_constr('ff')(tparams, ctx_mean, options,
+                                        prefix='ff_state', activ='tanh')
 
     # word embedding (target), we will shift the target sequence one time step
     # to the right. This is done because of the bi-gram connections in the
@@ -334,13 +346,86 @@ def build_model(tparams, options):
     cost = cost.reshape([y.shape[0], y.shape[1]])
     cost = (cost * y_mask).sum(0)
 
-    #print "Print out in build_model()"
-    #print opt_ret
-    return trng, use_noise, x, x_mask, y, y_mask, opt_ret, cost
+    return opt_ret, cost
+
+
+# build a scoring model that takes the output of the encoder as input
+# (the initial decoder state and context returned by f_init of build_sampler),
+# so that the encoder can be run once for many target sentences
+def build_decoder_cost(tparams, options):
+    trng = RandomStreams(1234)
+    use_noise = theano.shared(numpy.float32(0.))
+
+    ctx = tensor.tensor3('ctx', dtype='float32')
+    ctx.tag.test_value = numpy.random.rand(5, 10, 2*options['dim']).astype('float32')
+    x_mask = tensor.matrix('x_mask', dtype='float32')
+    x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype('float32')
+    init_state = tensor.matrix('init_state', dtype='float32')
+    init_state.tag.test_value = numpy.random.rand(10, options['dim']).astype('float32')
+    y = tensor.matrix('y', dtype='int64')
+    y.tag.test_value = (numpy.random.rand(8, 10)*100).astype('int64')
+    y_mask = tensor.matrix('y_mask', dtype='float32')
+    y_mask.tag.test_value = numpy.ones(shape=(8, 10)).astype('float32')
+
+    opt_ret, cost = build_decoder(tparams, options, trng, use_noise, ctx, x_mask, y, y_mask, init_state=init_state)
+
+    return trng, use_noise, ctx, x_mask, init_state, y, y_mask, opt_ret, cost
 
 
-# build a sampler
-def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
+# build the encoder of a sampler: f_init returns the initial decoder state and the context of a source sentence.
+# If batched, f_init takes a batch of padded source sentences and their mask, as prepared by prepare_data().
+def build_init(tparams, options, use_noise, trng, batched=False, precompute_context=False):
+
+    x_mask = None
+    if batched:
+        x_mask = tensor.matrix('x_mask', dtype='float32')
+        x_mask.tag.test_value = numpy.ones(shape=(5, 10)).astype('float32')
+
+    x, ctx = build_encoder(tparams, options, trng, use_noise, x_mask=x_mask, sampling=True)
+
+    # get the input for decoder rnn initializer mlp
+    if batched:
+        ctx_mean = (ctx * x_mask[:, :, None]).sum(0) / x_mask.sum(0)[:, None]
+    else:
+        ctx_mean = ctx.mean(0)
+    # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
+
+    if options['use_dropout'] and options['model_version'] < 0.1:
+        ctx_mean *= 1-options['dropout_hidden']
+
+    init_state = get_layer_constr('ff')(tparams, ctx_mean, options,
+                                    prefix='ff_state', activ='tanh')
+
+    print >>sys.stderr, 'Building f_init...',
+    inps = [x, x_mask] if batched else [x]
+    outs = [init_state, ctx]
+    if precompute_context:
+        # the projection of the context for the attention model does not depend on the target words,
+        # so it is computed once per source sentence rather than at every decoder step
+        if options['use_dropout'] and options['model_version'] < 0.1:
+            pctx_ = tensor.dot(ctx*(1-options['dropout_hidden']), tparams[pp('decoder', 'Wc_att')])
+        else:
+            pctx_ = tensor.dot(ctx, tparams[pp('decoder', 'Wc_att')])
+        pctx_ += tparams[pp('decoder', 'b_att')]
+        outs.append(pctx_)
+    f_init = theano.function(inps, outs, name='f_init', profile=profile)
+    print >>sys.stderr, 'Done'
+
+    return x, ctx, f_init
+
+
+# build a sampler.
+# If batched, f_init takes a batch of source sentences and their mask (see build_init()),
+# and f_next takes the mask of the context of each hypothesis as its last input.
+# If precompute_context, f_init also returns the projected context, and f_next takes the context and
+# projected context of each source sentence (not of each hypothesis), followed by the index of the
+# sentence of each hypothesis: f_next(y, ctx, pctx, init_state, hyp_sentences[, context_mask]).
+# The context mask is then also given per sentence.
+# If shortlist, f_next takes the ids of the target words that the output layer is restricted to as its
+# last input (see shortlist.py). Its probabilities are then over these words, in the same order, and its
+# samples are target word ids.
+def build_sampler(tparams, options, use_noise, trng, return_alignment=False, batched=False, precompute_context=False,
+                  shortlist=False):
 
     if options['use_dropout'] and options['model_version'] < 0.1:
         retain_probability_emb = 1-options['dropout_embedding']
@@ -356,27 +441,26 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
         emb_dropout_d = theano.shared(numpy.array([1.]*2, dtype='float32'))
         ctx_dropout_d = theano.shared(numpy.array([1.]*4, dtype='float32'))
 
-    x, ctx = build_encoder(tparams, options, trng, use_noise, x_mask=None, sampling=True)
+    x, ctx, f_init = build_init(tparams, options, use_noise, trng, batched=batched,
+                                precompute_context=precompute_context)
     n_samples = x.shape[2]
 
-    # get the input for decoder rnn initializer mlp
-    ctx_mean = ctx.mean(0)
-    # ctx_mean = concatenate([proj[0][-1],projr[0][-1]], axis=proj[0].ndim-2)
-
-    if options['use_dropout'] and options['model_version'] < 0.1:
-        ctx_mean *= retain_probability_hidden
-
-    init_state = get_layer_constr('ff')(tparams, ctx_mean, options,
-                                    prefix='ff_state', activ='tanh')
-
-    print >>sys.stderr, 'Building f_init...',
-    outs = [init_state, ctx]
-    f_init = theano.function([x], outs, name='f_init', profile=profile)
-    print >>sys.stderr, 'Done'
-
     # x: 1 x 1
     y = tensor.vector('y_sampler', dtype='int64')
     init_state = tensor.matrix('init_state', dtype='float32')
+    context_mask = tensor.matrix('context_mask', dtype='float32') if batched else None
+
+    if precompute_context:
+        pctx = tensor.tensor3('pctx', dtype='float32')
+        hyp_sentences = tensor.vector('hyp_sentences', dtype='int64')
+        # select the context of each hypothesis
+        hyp_ctx = ctx.take(hyp_sentences, axis=1)
+        hyp_pctx = pctx.take(hyp_sentences, axis=1)
+        hyp_context_mask = context_mask.take(hyp_sentences, axis=1) if batched else None
+    else:
+        hyp_ctx = ctx
+        hyp_pctx = None
+        hyp_context_mask = context_mask
 
     # if it's the first word, emb should be all zero and it is indicated by -1
     decoder_embedding_suffix = '' if options['tie_encoder_decoder_embeddings'] else '_dec'
@@ -391,7 +475,9 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
     # apply one step of conditional gru with attention
     proj = get_layer_constr(options['decoder'])(tparams, emb, options,
                                             prefix='decoder',
-                                            mask=None, context=ctx,
+                                            mask=None, context=hyp_ctx,
+                                            context_mask=hyp_context_mask,
+                                            pctx_=hyp_pctx,
                                             one_step=True,
                                             init_state=init_state,
                                             emb_dropout=emb_dropout_d,
@@ -427,19 +513,37 @@ def build_sampler(tparams, options, use_noise, trng, return_alignment=False):
         logit *= retain_probability_hidden
 
     logit_W = tparams['Wemb' + decoder_embedding_suffix].T if options['tie_decoder_embeddings'] else None
+    logit_b = None
+    if shortlist:
+        # only compute the rows of the output layer for the words in the shortlist
+        shortlist_ids = tensor.vector('shortlist', dtype='int64')
+        if options['tie_decoder_embeddings']:
+            logit_W = tparams['Wemb' + decoder_embedding_suffix][shortlist_ids].T
+        else:
+            logit_W = tparams[pp('ff_logit', 'W')].take(shortlist_ids, axis=1)
+        logit_b = tparams[pp('ff_logit', 'b')][shortlist_ids]
     logit = get_layer_constr('ff')(tparams, logit, options,
-                            prefix='ff_logit', activ='linear', W=logit_W)
+                            prefix='ff_logit', activ='linear', W=logit_W, b=logit_b)
 
     # compute the softmax probability
     next_probs = tensor.nnet.softmax(logit)
 
     # sample from softmax distribution to get the sample
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
+    if shortlist:
+        next_sample = shortlist_ids[next_sample]
 
     # compile a function to do the whole thing above, next word probability,
     # sampled word for the next target, next hidden state to be used
     print >>sys.stderr, 'Building f_next..',
-    inps = [y, ctx, init_state]
+    if precompute_context:
+        inps = [y, ctx, pctx, init_state, hyp_sentences]
+    else:
+        inps = [y, ctx, init_state]
+    if batched:
+        inps.append(context_mask)
+    if shortlist:
+        inps.append(shortlist_ids)
     outs = [next_probs, next_sample, next_state]
 
     if return_alignment:
@@ -651,14 +755,19 @@ def build_full_sampler(tparams, options, use_noise, trng, greedy=False):
 
 # generate sample, either with stochastic sampling or beam search. Note that,
 # this function iteratively calls f_init and f_next functions.
+# If f_next was built with a shortlist (see build_sampler()), shortlist holds the target word ids to restrict it to.
+# Shortlists start with the ids 0 (eos) and 1 (UNK), and are only supported in beam search.
 def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
                stochastic=True, argmax=False, return_alignment=False, suppress_unk=False,
-               return_hyp_graph=False):
+               return_hyp_graph=False, shortlist=None):
 
     # k is the beam size we have
     if k > 1 and argmax:
         assert not stochastic, \
             'Beam search does not support stochastic sampling with argmax'
+    if shortlist is not None:
+        assert not stochastic, 'Sampling does not support shortlists'
+        assert shortlist[0] == 0 and shortlist[1] == 1, 'Shortlists must start with eos and UNK'
 
     sample = []
     sample_score = []
@@ -678,32 +787,70 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
 
     dead_k = 0
 
-    hyp_samples=[ [] for i in xrange(live_k) ]
-    word_probs=[ [] for i in xrange(live_k) ]
     hyp_scores = numpy.zeros(live_k).astype('float32')
-    hyp_states = []
-    if return_alignment:
-        hyp_alignment = [[] for _ in xrange(live_k)]
+
+    if stochastic:
+        # in sampling, each live hypothesis keeps its words and their probabilities in lists
+        hyp_samples=[ [] for i in xrange(live_k) ]
+        word_probs=[ [] for i in xrange(live_k) ]
+        if return_alignment:
+            hyp_alignment = [[] for _ in xrange(live_k)]
+    else:
+        # In beam search, the k-best hypotheses of each time step are kept in preallocated arrays:
+        # their last word, its probability and the column of the hypothesis they extend in the previous
+        # time step (back pointer). Complete hypotheses are recovered by following the back pointers.
+        tokens = numpy.zeros((maxlen, k), dtype='int64')
+        token_probs = numpy.zeros((maxlen, k), dtype='float32')
+        back_pointers = numpy.zeros((maxlen, k), dtype='int64')
+        if return_alignment:
+            step_alignments = numpy.zeros((maxlen, k, x.shape[1]), dtype='float32')
+        # column of each live hypothesis in the last time step
+        live_indices = numpy.zeros(1, dtype='int64')
+        last_step = -1
+
+    def _backtrace(t, col):
+        # the words, word probabilities and attention weights of the hypothesis in column col of time step t
+        hyp = []
+        hyp_word_probs = []
+        hyp_alignment = []
+        while t >= 0:
+            hyp.append(tokens[t, col])
+            hyp_word_probs.append(token_probs[t, col].tolist())
+            if return_alignment:
+                hyp_alignment.append(step_alignments[t, col])
+            col = back_pointers[t, col]
+            t -= 1
+        return hyp[::-1], hyp_word_probs[::-1], hyp_alignment[::-1]
 
     # for ensemble decoding, we keep track of states and probability distribution
     # for each model in the ensemble
     num_models = len(f_init)
     next_state = [None]*num_models
     ctx0 = [None]*num_models
+    pctx0 = [None]*num_models
     next_p = [None]*num_models
     dec_alphas = [None]*num_models
     # get initial state of decoder rnn and encoder context
+    # (and the projected context, if f_init was built with precompute_context)
     for i in xrange(num_models):
         ret = f_init[i](x)
         next_state[i] = numpy.tile( ret[0] , (live_k,1))
         ctx0[i] = ret[1]
+        if len(ret) > 2:
+            pctx0[i] = ret[2]
     next_w = -1 * numpy.ones((live_k,)).astype('int64')  # bos indicator
 
     # x is a sequence of word ids followed by 0, eos id
     for ii in xrange(maxlen):
         for i in xrange(num_models):
-            ctx = numpy.tile(ctx0[i], [live_k, 1])
-            inps = [next_w, ctx, next_state[i]]
+            if pctx0[i] is not None:
+                # all hypotheses share the context of the single source sentence
+                inps = [next_w, ctx0[i], pctx0[i], next_state[i], numpy.zeros(live_k, dtype='int64')]
+            else:
+                ctx = numpy.tile(ctx0[i], [live_k, 1])
+                inps = [next_w, ctx, next_state[i]]
+            if shortlist is not None:
+                inps.append(shortlist)
             ret = f_next[i](*inps)
             # dimension of dec_alpha (k-beam-size, number-of-input-hidden-units)
             next_p[i], next_w_tmp, next_state[i] = ret[0], ret[1], ret[2]
@@ -777,82 +924,66 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
             # index of each k-best hypothesis
             trans_indices = ranks_flat / voc_size
             word_indices = ranks_flat % voc_size
+            if shortlist is not None:
+                word_indices = shortlist[word_indices]
             costs = cand_flat[ranks_flat]
 
-            new_hyp_samples = []
-            new_hyp_scores = numpy.zeros(k-dead_k).astype('float32')
-            new_word_probs = []
-            new_hyp_states = []
+            # store the k-best hypotheses of this time step
+            n_best = len(ranks_flat)
+            tokens[ii, :n_best] = word_indices
+            token_probs[ii, :n_best] = probs_flat[ranks_flat]
+            back_pointers[ii, :n_best] = live_indices[trans_indices]
             if return_alignment:
-                # holds the history of attention weights for each time step for each of the surviving hypothesis
-                # dimensions (live_k * target_words * source_hidden_units]
-                # at each time step we append the attention weights corresponding to the current target word
-                new_hyp_alignment = [[] for _ in xrange(k-dead_k)]
+                # extend the history with current attention weights
+                step_alignments[ii, :n_best] = mean_alignment[trans_indices]
+            last_step = ii
 
-            # ti -> index of k-best hypothesis
-            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
-                new_hyp_samples.append(hyp_samples[ti]+[wi])
-                new_word_probs.append(word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()])
-                new_hyp_scores[idx] = copy.copy(costs[idx])
-                new_hyp_states.append([copy.copy(next_state[i][ti]) for i in xrange(num_models)])
-                if return_alignment:
-                    # get history of attention weights for the current hypothesis
-                    new_hyp_alignment[idx] = copy.copy(hyp_alignment[ti])
-                    # extend the history with current attention weights
-                    new_hyp_alignment[idx].append(mean_alignment[ti])
-
-
-            # check the finished samples
-            new_live_k = 0
-            hyp_samples = []
-            hyp_scores = []
-            hyp_states = []
-            word_probs = []
-            if return_alignment:
-                hyp_alignment = []
+            if return_hyp_graph:
+                for idx in xrange(n_best):
+                    hyp = _backtrace(ii, idx)[0]
+                    hyp_graph.add(hyp[-1], hyp[:-1], word_prob=token_probs[ii, idx].tolist(), cost=costs[idx])
 
             # sample and sample_score hold the k-best translations and their scores
-            for idx in xrange(len(new_hyp_samples)):
-                if return_hyp_graph:
-                    word, history = new_hyp_samples[idx][-1], new_hyp_samples[idx][:-1]
-                    score = new_hyp_scores[idx]
-                    word_prob = new_word_probs[idx][-1]
-                    hyp_graph.add(word, history, word_prob=word_prob, cost=score)
-                if new_hyp_samples[idx][-1] == 0:
-                    sample.append(copy.copy(new_hyp_samples[idx]))
-                    sample_score.append(new_hyp_scores[idx])
-                    sample_word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        alignment.append(new_hyp_alignment[idx])
-                    dead_k += 1
-                else:
-                    new_live_k += 1
-                    hyp_samples.append(copy.copy(new_hyp_samples[idx]))
-                    hyp_scores.append(new_hyp_scores[idx])
-                    hyp_states.append(copy.copy(new_hyp_states[idx]))
-                    word_probs.append(new_word_probs[idx])
-                    if return_alignment:
-                        hyp_alignment.append(new_hyp_alignment[idx])
-            hyp_scores = numpy.array(hyp_scores)
+            finished = numpy.flatnonzero(word_indices == 0)
+            for idx in finished:
+                hyp, hyp_word_probs, hyp_alignment = _backtrace(ii, idx)
+                sample.append(hyp)
+                sample_score.append(costs[idx])
+                sample_word_probs.append(hyp_word_probs)
+                if return_alignment:
+                    alignment.append(hyp_alignment)
+            dead_k += len(finished)
+
+            live_indices = numpy.flatnonzero(word_indices != 0)
+            hyp_scores = costs[live_indices]
 
-            live_k = new_live_k
+            live_k = len(live_indices)
 
-            if new_live_k < 1:
+            if live_k < 1:
                 break
             if dead_k >= k:
                 break
 
-            next_w = numpy.array([w[-1] for w in hyp_samples])
-            next_state = [numpy.array(state) for state in zip(*hyp_states)]
+            next_w = word_indices[live_indices]
+            next_state = [state[trans_indices[live_indices]] for state in next_state]
 
     # dump every remaining one
     if not argmax and live_k > 0:
-        for idx in xrange(live_k):
-            sample.append(hyp_samples[idx])
-            sample_score.append(hyp_scores[idx])
-            sample_word_probs.append(word_probs[idx])
-            if return_alignment:
-                alignment.append(hyp_alignment[idx])
+        if stochastic:
+            for idx in xrange(live_k):
+                sample.append(hyp_samples[idx])
+                sample_score.append(hyp_scores[idx])
+                sample_word_probs.append(word_probs[idx])
+                if return_alignment:
+                    alignment.append(hyp_alignment[idx])
+        else:
+            for idx, col in enumerate(live_indices):
+                hyp, hyp_word_probs, hyp_alignment = _backtrace(last_step, col)
+                sample.append(hyp)
+                sample_score.append(hyp_scores[idx])
+                sample_word_probs.append(hyp_word_probs)
+                if return_alignment:
+                    alignment.append(hyp_alignment)
 
     if not return_alignment:
         alignment = [None for i in range(len(sample))]
@@ -860,14 +991,185 @@ def gen_sample(f_init, f_next, x, trng=None, k=1, maxlen=30,
     return sample, sample_score, sample_word_probs, alignment, hyp_graph
 
 
-# calculate the log probablities on a given corpus using translation model
+# beam search for a batch of source sentences, with a sampler built with batched=True.
+# x and x_mask hold the source sentences as prepared by prepare_data(), each followed by eos.
+# The k hypotheses of every sentence are decoded together, with one call of f_next per model and time step.
+# A shortlist (see gen_sample()) is shared by all sentences of the batch.
+# Returns the lists sample, sample_score, sample_word_probs and alignment of gen_sample() for each sentence.
+def gen_sample_batch(f_init, f_next, x, x_mask, k=1, maxlen=30, return_alignment=False, suppress_unk=False,
+                     shortlist=None):
+
+    if shortlist is not None:
+        assert shortlist[0] == 0 and shortlist[1] == 1, 'Shortlists must start with eos and UNK'
+
+    n_sentences = x.shape[2]
+    lengths = x_mask.sum(0).astype('int64')
+
+    sample = [[] for _ in xrange(n_sentences)]
+    sample_score = [[] for _ in xrange(n_sentences)]
+    sample_word_probs = [[] for _ in xrange(n_sentences)]
+    alignment = [[] for _ in xrange(n_sentences)]
+    dead_k = numpy.zeros(n_sentences, dtype='int64')
+
+    # every hypothesis belongs to a sentence; there is one empty hypothesis per sentence to begin with
+    hyp_sentences = numpy.arange(n_sentences)
+    hyp_samples = [[] for _ in xrange(n_sentences)]
+    word_probs = [[] for _ in xrange(n_sentences)]
+    hyp_scores = numpy.zeros(n_sentences).astype('float32')
+    hyp_alignment = [[] for _ in xrange(n_sentences)]
+
+    # for ensemble decoding, we keep track of states and probability distribution
+    # for each model in the ensemble
+    num_models = len(f_init)
+    next_state = [None]*num_models
+    ctx0 = [None]*num_models
+    pctx0 = [None]*num_models
+    next_p = [None]*num_models
+    dec_alphas = [None]*num_models
+    # get initial state of decoder rnn and encoder context of all sentences
+    # (and the projected context, if f_init was built with precompute_context)
+    for i in xrange(num_models):
+        ret = f_init[i](x, x_mask)
+        next_state[i] = ret[0]
+        ctx0[i] = ret[1]
+        if len(ret) > 2:
+            pctx0[i] = ret[2]
+    next_w = -1 * numpy.ones((n_sentences,)).astype('int64')  # bos indicator
+
+    for ii in xrange(maxlen):
+        for i in xrange(num_models):
+            if pctx0[i] is not None:
+                # f_next selects the context of the sentence of each hypothesis itself
+                inps = [next_w, ctx0[i], pctx0[i], next_state[i], hyp_sentences, x_mask]
+            else:
+                # the context of each hypothesis is that of its sentence
+                ctx = ctx0[i][:, hyp_sentences]
+                inps = [next_w, ctx, next_state[i], x_mask[:, hyp_sentences]]
+            if shortlist is not None:
+                inps.append(shortlist)
+            ret = f_next[i](*inps)
+            next_p[i], next_state[i] = ret[0], ret[2]
+            if return_alignment:
+                dec_alphas[i] = ret[3]
+
+            if suppress_unk:
+                next_p[i][:,1] = -numpy.inf
+
+        cand_scores = hyp_scores[:, None] - sum(numpy.log(next_p))
+        probs = sum(next_p)/num_models
+        voc_size = next_p[0].shape[1]
+
+        #averaging the attention weights accross models
+        if return_alignment:
+            mean_alignment = sum(dec_alphas)/num_models
+
+        new_hyp_sentences = []
+        new_hyp_samples = []
+        new_hyp_scores = []
+        new_word_probs = []
+        new_hyp_alignment = []
+        # index of the hypothesis that each surviving hypothesis extends
+        new_trans_indices = []
+
+        # select the k-best extensions of the hypotheses of each sentence that is not finished
+        for s in numpy.unique(hyp_sentences):
+            rows = numpy.flatnonzero(hyp_sentences == s)
+            cand_flat = cand_scores[rows].flatten()
+            probs_flat = probs[rows].flatten()
+            ranks_flat = cand_flat.argpartition(k-dead_k[s]-1)[:(k-dead_k[s])]
+
+            trans_indices = rows[ranks_flat / voc_size]
+            word_indices = ranks_flat % voc_size
+            if shortlist is not None:
+                word_indices = shortlist[word_indices]
+            costs = cand_flat[ranks_flat]
+
+            # ti -> index of k-best hypothesis
+            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+                new_sample = hyp_samples[ti] + [wi]
+                new_word_prob = word_probs[ti] + [probs_flat[ranks_flat[idx]].tolist()]
+                if return_alignment:
+                    # attention weights over the source words of this sentence (without padding)
+                    new_alignment = hyp_alignment[ti] + [mean_alignment[ti][:lengths[s]]]
+
+                if wi == 0:
+                    sample[s].append(new_sample)
+                    sample_score[s].append(costs[idx])
+                    sample_word_probs[s].append(new_word_prob)
+                    if return_alignment:
+                        alignment[s].append(new_alignment)
+                    dead_k[s] += 1
+                else:
+                    new_hyp_sentences.append(s)
+                    new_hyp_samples.append(new_sample)
+                    new_hyp_scores.append(costs[idx])
+                    new_word_probs.append(new_word_prob)
+                    if return_alignment:
+                        new_hyp_alignment.append(new_alignment)
+                    new_trans_indices.append(ti)
+
+        hyp_sentences = numpy.array(new_hyp_sentences, dtype='int64')
+        hyp_samples = new_hyp_samples
+        hyp_scores = numpy.array(new_hyp_scores, dtype='float32')
+        word_probs = new_word_probs
+        hyp_alignment = new_hyp_alignment
+
+        if len(hyp_samples) < 1:
+            break
+
+        next_w = numpy.array([w[-1] for w in hyp_samples])
+        next_state = [state[new_trans_indices] for state in next_state]
+
+    # dump every remaining one
+    for idx, s in enumerate(hyp_sentences):
+        sample[s].append(hyp_samples[idx])
+        sample_score[s].append(hyp_scores[idx])
+        sample_word_probs[s].append(word_probs[idx])
+        if return_alignment:
+            alignment[s].append(hyp_alignment[idx])
+
+    if not return_alignment:
+        alignment = [[None for i in range(len(sample[s]))] for s in xrange(n_sentences)]
+
+    return sample, sample_score, sample_word_probs, alignment
+
+
+# calculate the log probablities of one batch prepared by prepare_data(),
+# and the alignments (as json strings) in optional save weights mode
+def batch_log_probs(f_log_probs, x, x_mask, y, y_mask, normalize=False, alignweights=False):
+    alignments_json = []
+
+    ### in optional save weights mode.
+    if alignweights:
+        pprobs, attention = f_log_probs(x, x_mask, y, y_mask)
+        for jdata in get_alignments(attention, x_mask, y_mask):
+            alignments_json.append(jdata)
+    else:
+        pprobs = f_log_probs(x, x_mask, y, y_mask)
+
+    # normalize scores according to output length
+    if normalize:
+        lengths = numpy.array([numpy.count_nonzero(s) for s in y_mask.T])
+        pprobs /= lengths
+
+    return pprobs, alignments_json
+
+
+# calculate the log probablities on a given corpus using translation model.
+# If the iterator returns the line numbers of its batches (TextIterator with return_index=True),
+# the results are put back in corpus order.
 def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, normalize=False, alignweights=False):
     probs = []
     n_done = 0
 
     alignments_json = []
+    indices = []
+
+    for batch in iterator:
+        x, y = batch[:2]
+        if len(batch) > 2:
+            indices.extend(batch[2])
 
-    for x, y in iterator:
         #ensure consistency in number of factors
         if len(x[0][0]) != options['factors']:
             sys.stderr.write('Error: mismatch between number of factors in settings ({0}), and number in validation corpus ({1})\n'.format(options['factors'], len(x[0][0])))
@@ -879,18 +1181,8 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, norma
                                             n_words_src=options['n_words_src'],
                                             n_words=options['n_words'])
 
-        ### in optional save weights mode.
-        if alignweights:
-            pprobs, attention = f_log_probs(x, x_mask, y, y_mask)
-            for jdata in get_alignments(attention, x_mask, y_mask):
-                alignments_json.append(jdata)
-        else:
-            pprobs = f_log_probs(x, x_mask, y, y_mask)
-
-        # normalize scores according to output length
-        if normalize:
-            lengths = numpy.array([numpy.count_nonzero(s) for s in y_mask.T])
-            pprobs /= lengths
+        pprobs, alignments = batch_log_probs(f_log_probs, x, x_mask, y, y_mask, normalize, alignweights)
+        alignments_json.extend(alignments)
 
         for pp in pprobs:
             probs.append(pp)
@@ -898,6 +1190,12 @@ def pred_probs(f_log_probs, prepare_data, options, iterator, verbose=True, norma
         if verbose:
             print >>sys.stderr, '%d samples computed' % (n_done)
 
+    if indices:
+        order = numpy.argsort(indices, kind='mergesort')
+        probs = [probs[i] for i in order]
+        if alignweights:
+            alignments_json = [alignments_json[i] for i in order]
+
     return numpy.array(probs), alignments_json
 
 
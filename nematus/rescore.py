@@ -4,26 +4,85 @@ Rescoring an n-best list of translations using a translation model.
 import sys
 import argparse
 import tempfile
+from itertools import groupby
 
 import numpy
 import json
 
 from data_iterator import TextIterator
-from util import load_dict, load_config
+from util import load_dict, load_config, EncoderCache
 from alignment_util import *
 from compat import fill_options
 
 from theano_util import (load_params, init_theano_params)
-from nmt import (pred_probs, build_model, prepare_data, init_params)
+from nmt import (pred_probs, build_decoder_cost, build_init, prepare_data, init_params)
 
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import theano
 
-def rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights):
+def encode_batch(f_init, encoder_cache, x, x_mask):
+    '''
+    Returns the initial decoder states and the (padded) context of a batch prepared by prepare_data().
+    The source sentences are encoded through the encoder cache, so that a source sentence is only
+    encoded once for all its translations; those not in the cache are encoded in one batch.
+    '''
+    lengths = x_mask.sum(0).astype('int64')
+    outputs = encoder_cache.encode_batch(f_init, x, x_mask)
+    ctx = numpy.zeros((x.shape[1], x.shape[2], outputs[0][1].shape[2]), dtype='float32')
+    for i, (init_state, ctx_i) in enumerate(outputs):
+        ctx[:lengths[i], i] = ctx_i[:, 0]
+    return numpy.concatenate([init_state for init_state, ctx_i in outputs]), ctx
+
+def score_hypotheses(f_init, f_cost, encoder_cache, source, targets, batch_size, normalize=False, alignweights=False):
+    '''
+    Scores the translations (targets) of one source sentence, given as lists of word ids as returned by TextIterator.
+    The source sentence is encoded once, and its context is shared by all translations, so that only the decoder
+    runs for each batch of translations.
+    The translations are batched by length; scores and alignments are returned in the order of targets.
+    Returns the scores, and the alignments in optional save weights mode.
+    '''
+    seq = source + [[0] * len(source[0])]
+    init_state, ctx = encoder_cache.encode_batch(f_init, numpy.array(seq).T.reshape([len(seq[0]), len(seq), 1]),
+                                                 numpy.ones((len(seq), 1), dtype='float32'))[0]
+
+    order = sorted(xrange(len(targets)), key=lambda i: len(targets[i]))
+    scores = []
+    alignments = []
+    for start in xrange(0, len(targets), batch_size):
+        batch = [targets[i] for i in order[start:start+batch_size]]
+        _, x_mask, y, y_mask = prepare_data([source] * len(batch), batch)
+        inps = [numpy.tile(ctx, [1, len(batch), 1]), x_mask, numpy.tile(init_state, [len(batch), 1]), y, y_mask]
+
+        if alignweights:
+            pprobs, attention = f_cost(*inps)
+            alignments.extend(get_alignments(attention, x_mask, y_mask))
+        else:
+            pprobs = f_cost(*inps)
+
+        # normalize scores according to output length
+        if normalize:
+            lengths = numpy.array([numpy.count_nonzero(s) for s in y_mask.T])
+            pprobs /= lengths
+
+        scores.extend(pprobs)
+
+    # back to the order of targets
+    position = numpy.argsort(order)
+    scores = [scores[i] for i in position]
+    if alignweights:
+        alignments = [alignments[i] for i in position]
+
+    return scores, alignments
+
+def rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights, encoder_cache_size=64,
+                  shared_source=False):
 
     trng = RandomStreams(1234)
 
     fs_log_probs = []
+    fs_init = []
+    fs_cost = []
+    encoder_caches = []
 
     for model, option in zip(models, options):
 
@@ -34,21 +93,32 @@ def rescore_model(source_file, nbest_file, saveto, models, options, b, normalize
         tparams = init_theano_params(params)
 
         trng, use_noise, \
-            x, x_mask, y, y_mask, \
+            ctx, x_mask, init_state, y, y_mask, \
             opt_ret, \
             cost = \
-            build_model(tparams, option)
-        inps = [x, x_mask, y, y_mask]
+            build_decoder_cost(tparams, option)
+        inps = [ctx, x_mask, init_state, y, y_mask]
         use_noise.set_value(0.)
 
         if alignweights:
             sys.stderr.write("\t*** Save weight mode ON, alignment matrix will be saved.\n")
             outputs = [cost, opt_ret['dec_alphas']]
-            f_log_probs = theano.function(inps, outputs)
+            f_cost = theano.function(inps, outputs)
         else:
-            f_log_probs = theano.function(inps, cost)
+            f_cost = theano.function(inps, cost)
+
+        # the encoder runs separately, once per distinct source sentence
+        _, _, f_init = build_init(tparams, option, use_noise, trng, batched=True)
+        encoder_cache = EncoderCache(encoder_cache_size * 1024**2)
+
+        def f_log_probs(x, x_mask, y, y_mask, f_init=f_init, f_cost=f_cost, encoder_cache=encoder_cache):
+            init_state, ctx = encode_batch(f_init, encoder_cache, x, x_mask)
+            return f_cost(ctx, x_mask, init_state, y, y_mask)
 
         fs_log_probs.append(f_log_probs)
+        fs_init.append(f_init)
+        fs_cost.append(f_cost)
+        encoder_caches.append(encoder_cache)
 
     def _score(pairs, alignweights=False):
         # sample given an input sequence and obtain scores
@@ -61,6 +131,34 @@ def rescore_model(source_file, nbest_file, saveto, models, options, b, normalize
 
         return scores, alignments
 
+    def _score_shared_source(nbest_lines, alignweights=False):
+        # encode each source sentence once, and score all its translations (consecutive lines of the n-best list) with its context
+        source_dicts = [load_dict(d) for d in options[0]['dictionaries'][:-1]]
+        target_dict = load_dict(options[0]['dictionaries'][-1])
+
+        def _id(word, dictionary, n_words):
+            # same mapping as TextIterator: unknown words and words outside the vocabulary size are UNK
+            if word in dictionary and not (n_words > 0 and dictionary[word] >= n_words):
+                return dictionary[word]
+            return 1
+
+        scores = [[] for _ in models]
+        alignments = [[] for _ in models]
+        for idx, group in groupby(nbest_lines, key=lambda line: int(line.split(' ||| ')[0])):
+            source = [[_id(f, source_dicts[i], options[0]['n_words_src']) for (i, f) in enumerate(w.split('|'))]
+                      for w in lines[idx].split()]
+            if source and len(source[0]) != options[0]['factors']:
+                sys.stderr.write('Error: mismatch between number of factors in settings ({0}), and number in source text ({1})\n'.format(options[0]['factors'], len(source[0])))
+                sys.exit(1)
+            targets = [[_id(w, target_dict, options[0]['n_words']) for w in line.split(' ||| ')[1].split()] for line in group]
+            for i in xrange(len(models)):
+                score, alignment = score_hypotheses(fs_init[i], fs_cost[i], encoder_caches[i], source, targets, b,
+                                                    normalize=normalize, alignweights=alignweights)
+                scores[i].extend(score)
+                alignments[i].extend(alignment)
+
+        return scores, alignments
+
     lines = source_file.readlines()
     nbest_lines = nbest_file.readlines()
 
@@ -68,39 +166,45 @@ def rescore_model(source_file, nbest_file, saveto, models, options, b, normalize
         temp_name = saveto.name + ".json"
         align_OUT = tempfile.NamedTemporaryFile(prefix=temp_name)
 
-    with tempfile.NamedTemporaryFile(prefix='rescore-tmpin') as tmp_in, tempfile.NamedTemporaryFile(prefix='rescore-tmpout') as tmp_out:
-        for line in nbest_lines:
-            linesplit = line.split(' ||| ')
-            idx = int(linesplit[0])   ##index from the source file. Starting from 0.
-            tmp_in.write(lines[idx])
-            tmp_out.write(linesplit[1] + '\n')
-
-        tmp_in.seek(0)
-        tmp_out.seek(0)
-        pairs = TextIterator(tmp_in.name, tmp_out.name,
-                        options[0]['dictionaries'][:-1], options[0]['dictionaries'][1],
-                         n_words_source=options[0]['n_words_src'], n_words_target=options[0]['n_words'],
-                         batch_size=b,
-                         maxlen=float('inf'),
-                         sort_by_length=False) #TODO: sorting by length could be more efficient, but we'd have to synchronize scores with n-best list after
-
-
-        scores, alignments = _score(pairs, alignweights)
-
-        for i, line in enumerate(nbest_lines):
-            score_str = ' '.join(map(str,[s[i] for s in scores]))
-            saveto.write('{0} {1}\n'.format(line.strip(), score_str))
-
-        ### optional save weights mode.
-        if alignweights:
-            for line in alignments:
-                align_OUT.write(line + "\n")
+    if shared_source:
+        scores, alignments = _score_shared_source(nbest_lines, alignweights)
+    else:
+        with tempfile.NamedTemporaryFile(prefix='rescore-tmpin') as tmp_in, tempfile.NamedTemporaryFile(prefix='rescore-tmpout') as tmp_out:
+            for line in nbest_lines:
+                linesplit = line.split(' ||| ')
+                idx = int(linesplit[0])   ##index from the source file. Starting from 0.
+                tmp_in.write(lines[idx])
+                tmp_out.write(linesplit[1] + '\n')
+
+            tmp_in.seek(0)
+            tmp_out.seek(0)
+            pairs = TextIterator(tmp_in.name, tmp_out.name,
+                            options[0]['dictionaries'][:-1], options[0]['dictionaries'][1],
+                             n_words_source=options[0]['n_words_src'], n_words_target=options[0]['n_words'],
+                             batch_size=b,
+                             maxlen=float('inf'),
+                             sort_by_length=True,
+                             return_index=True) # pred_probs() restores the order of the n-best list
+
+            scores, alignments = _score(pairs, alignweights)
+
+    if verbose:
+        sys.stderr.write("Encoder cache: {0}\n".format(encoder_caches[0].stats()))
+
+    for i, line in enumerate(nbest_lines):
+        score_str = ' '.join(map(str,[s[i] for s in scores]))
+        saveto.write('{0} {1}\n'.format(line.strip(), score_str))
+
+    ### optional save weights mode.
     if alignweights:
+        # alignments are those of the first model
+        for line in alignments[0]:
+            align_OUT.write(line + "\n")
         combine_source_target_text(source_file, nbest_file, saveto.name, align_OUT)
         align_OUT.close()
 
 def main(models, source_file, nbest_file, saveto, b=80,
-         normalize=False, verbose=False, alignweights=False):
+         normalize=False, verbose=False, alignweights=False, encoder_cache_size=64, shared_source=False):
 
     # load model model_options
     options = []
@@ -109,7 +213,8 @@ def main(models, source_file, nbest_file, saveto, b=80,
 
         fill_options(options[-1])
 
-    rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights)
+    rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights, encoder_cache_size,
+                  shared_source)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -131,8 +236,13 @@ if __name__ == "__main__":
                         help="Output file (default: standard output)")
     parser.add_argument('--walign', '-w',required = False,action="store_true",
                         help="Whether to store the alignment weights or not. If specified, weights will be saved in <input>.alignment")
+    parser.add_argument('--shared-source', action="store_true",
+                        help="Encode each source sentence once, and score all its translations (consecutive lines of the n-best list) in batches that share its context")
+    parser.add_argument('--encoder-cache', type=int, default=64, metavar='MB',
+                        help="Memory budget of the cache of encoder outputs, so that each source sentence is encoded once for all its translations (default: %(default)s)")
 
     args = parser.parse_args()
 
     main(args.models, args.source, args.input,
-         args.output, b=args.b, normalize=args.n, verbose=args.v, alignweights=args.walign)
+         args.output, b=args.b, normalize=args.n, verbose=args.v, alignweights=args.walign,
+         encoder_cache_size=args.encoder_cache, shared_source=args.shared_source)
@@ -31,7 +31,8 @@ from nmt import (pred_probs, build_model, prepare_data, init_params)
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import theano
 
-from arcscorer import ArcScorer
+from multiprocessing import Process, Queue
+from Queue import Empty
 from lattice import *
 
 reload(sys)
@@ -40,56 +41,194 @@ sys.stdin = codecs.getreader('utf-8')(sys.stdin)
 sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
 sys.stdout.encoding = 'utf-8'
 
-def main(models, source_file, graph_file_pattern, begin, end, saveto, search_type ,b=80,
-         normalize=False, beam=12, verbose=False, alignweights=False):
+GRAPH_BACKENDS = {'object': Graph, 'array': ArrayGraph}
 
-    sourcelines = source_file.readlines()
+def rescore_graph_model(queue, rqueue, pid, models, graph_file_pattern, search_type, beam_options, verbose, state_cache_size, graph_backend, bpe_codes, nbest, n_threads, normalize, interpolation, encoder_cache_size):
 
     scorer = None
     if models is not None and len(models) > 0:
-        if len(models) > 1:
-            sys.stderr.write("* WARNING: only using first model for now")
+        from arcscorer import ArcScorer
+        scorer = ArcScorer(models, state_cache_size=state_cache_size, n_threads=n_threads,
+                            encoder_cache_size=encoder_cache_size)
+    search_scorer = scorer
+    if interpolation is not None:
+        search_scorer = InterpolatedScorer(scorer, **interpolation)
 
-        scorer = ArcScorer(models[0])
+    # segmentations of lattice labels are cached across all sentences of this process
+    segmenter = None
+    if bpe_codes is not None:
+        from bpe import BPE
+        segmenter = BPE.from_path(bpe_codes)
 
+    # without a {} pattern, all lattices are read from a single archive
+    archive = None
     if not '{}' in graph_file_pattern:
-        print "* FATAL: no {} pattern found in file spec"
-        sys.exit(1)
+        archive = LatticeArchive(graph_file_pattern)
+
+    def _missing(sentno):
+        result = (sentno, '-Infinity', 'NULL')
+        return [result] if nbest is not None else result
+
+    def _rescore(sentno, source):
+        if archive is not None:
+            if not sentno in archive:
+                sys.stderr.write("* WARNING: couldn't find sentence {} in {}\n".format(sentno, graph_file_pattern))
+                return _missing(sentno)
 
-    for sentno in range(begin, end+1):
-        if not os.path.exists(graph_file_pattern.format(sentno)):
-            sys.stderr.write("* WARNING: couldn't find file {}\n".format(graph_file_pattern.format(sentno)))
-            print sentno, '-Infinity', 'NULL'
+            if verbose: print >>sys.stderr, "[{}] Processing graph from archive {}...".format(sentno, graph_file_pattern)
+            graph = archive.graph(sentno, GRAPH_BACKENDS[graph_backend], segmenter)
+        else:
+            graph_file = graph_file_pattern.format(sentno)
+            if not os.path.exists(graph_file):
+                sys.stderr.write("* WARNING: couldn't find file {}\n".format(graph_file))
+                return _missing(sentno)
 
-        graph_file = graph_file_pattern.format(sentno)
-        if verbose: print "[{}] Processing graph file {}...".format(sentno, graph_file)
-        graph = Graph(sentno, open(graph_file))
+            if verbose: print >>sys.stderr, "[{}] Processing graph file {}...".format(sentno, graph_file)
+            with open(graph_file, 'rb') as f:
+                graph = read_lattice(sentno, f.read(), GRAPH_BACKENDS[graph_backend], segmenter)
 
         if (scorer):
-            scorer.set_source_sentence(sourcelines[sentno])
+            scorer.set_source_sentence(source)
+            scorer.prepare_graph(graph)
+
+        graph_scorer = search_scorer
+        if interpolation is not None and scorer is None:
+            # without a model, the arc scores are interpolated with themselves
+            graph_scorer = InterpolatedScorer(graph, **interpolation)
 
         if search_type == 'complete':
-            result = graph.walk(scorer, verbose = verbose)
+            result = graph.walk(graph_scorer, normalize = normalize, verbose = verbose, nbest = nbest)
         elif search_type == 'stack':
-            result = graph.beam_search(scorer, verbose = verbose, beam = beam)
+            result = graph.beam_search(graph_scorer, verbose = verbose, nbest = nbest, normalize = normalize, **beam_options)
+
+        if verbose and scorer is not None:
+            sys.stderr.write("[{}] softmax memo: {}\n".format(sentno, scorer.memo_stats()))
+            if scorer.state_cache is not None:
+                sys.stderr.write("[{}] state cache: {}\n".format(sentno, scorer.state_cache.stats()))
+
+        return result
 
-        print result[0], result[1], result[2]
+    while True:
+        req = queue.get()
+        if req is None:
+            break
+
+        idx, sentno, source = req
+        if verbose:
+            sys.stderr.write('{0} - {1}\n'.format(pid, sentno))
+        result = _rescore(sentno, source)
+
+        rqueue.put((idx, result))
+
+    if scorer is not None and scorer.state_cache is not None:
+        sys.stderr.write("State cache of process {0}: {1}\n".format(pid, scorer.state_cache.stats()))
+    if scorer is not None and scorer.encoder_caches is not None:
+        sys.stderr.write("Encoder cache of process {0}: {1}\n".format(pid, scorer.encoder_caches[0].stats()))
+    if scorer is not None:
+        sys.stderr.write("Target vocabulary of process {0}: {1}\n".format(pid, scorer.vocab_stats()))
+    if verbose and segmenter is not None:
+        sys.stderr.write("BPE cache of process {0}: {1}\n".format(pid, segmenter.stats()))
+
+    return
+
+
+def main(models, source_file, graph_file_pattern, begin, end, saveto, search_type ,b=80,
+         normalize=False, beam=12, verbose=False, alignweights=False, state_cache_size=0, n_process=1,
+         graph_backend='object', bpe_codes=None, beam_threshold=None, recombine=None, nbest=None, n_threads=1,
+         nmt_weight=1., arc_weight=0., word_penalty=0., encoder_cache_size=0):
+
+    sourcelines = source_file.readlines()
+
+    if not '{}' in graph_file_pattern:
+        try:
+            LatticeArchive(graph_file_pattern).close()
+        except (IOError, ValueError):
+            print >>sys.stderr, "* FATAL: no {} pattern found in file spec, and it is not a lattice archive"
+            sys.exit(1)
+
+    beam_options = {'beam': beam, 'threshold': beam_threshold, 'history': recombine}
+    interpolation = None
+    if (nmt_weight, arc_weight, word_penalty) != (1., 0., 0.):
+        interpolation = {'scorer_weight': nmt_weight, 'arc_weight': arc_weight, 'word_penalty': word_penalty}
+
+    # create input and output queues for processes
+    queue = Queue()
+    rqueue = Queue()
+    processes = [None] * n_process
+    for midx in xrange(n_process):
+        processes[midx] = Process(
+            target=rescore_graph_model,
+            args=(queue, rqueue, midx, models, graph_file_pattern, search_type, beam_options, verbose, state_cache_size, graph_backend, bpe_codes, nbest, n_threads, normalize, interpolation, encoder_cache_size))
+        processes[midx].start()
+
+    def _send_jobs():
+        n_samples = 0
+        for sentno in range(begin, min(end, len(sourcelines) - 1) + 1):
+            queue.put((n_samples, sentno, sourcelines[sentno]))
+            n_samples += 1
+        return n_samples
+
+    def _finish_processes():
+        for midx in xrange(n_process):
+            queue.put(None)
+
+    def _retrieve_jobs(n_samples):
+        results = [None] * n_samples
+        out_idx = 0
+        for idx in xrange(n_samples):
+            resp = None
+            while resp is None:
+                try:
+                    resp = rqueue.get(True, 5)
+                # if queue is empty after 5s, check if processes are still alive
+                except Empty:
+                    for midx in xrange(n_process):
+                        if not processes[midx].is_alive():
+                            # kill all other processes and raise exception if one dies
+                            queue.cancel_join_thread()
+                            rqueue.cancel_join_thread()
+                            for idx in xrange(n_process):
+                                processes[idx].terminate()
+                            sys.stderr.write("Error: rescoring worker process {0} crashed with exitcode {1}".format(processes[midx].pid, processes[midx].exitcode))
+                            sys.exit(1)
+            results[resp[0]] = resp[1]
+            while out_idx < n_samples and results[out_idx] != None:
+                yield results[out_idx]
+                out_idx += 1
+
+    n_samples = _send_jobs()
+    _finish_processes()
+
+    for result in _retrieve_jobs(n_samples):
+        if nbest is not None:
+            # same format as translate.py --n-best, but with the lattice scores (log probabilities)
+            for sentno, score, text in result:
+                print '{0} ||| {1} ||| {2}'.format(sentno, text, score)
+        else:
+            print result[0], result[1], result[2]
         sys.stdout.flush()
-    
+
+    for midx in xrange(n_process):
+        processes[midx].join()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', type=int, default=80,
                         help="Minibatch size (default: %(default)s))")
+    parser.add_argument('-p', type=int, default=1,
+                        help="Number of processes (default: %(default)s))")
     parser.add_argument('-n', action="store_true",
                         help="Normalize scores by sentence length")
     parser.add_argument('-v', action="store_true", help="verbose mode.")
     parser.add_argument('--models', '-m', type=str, nargs = '+', required=False,
                         help="model to use. Provide multiple models (with same vocabulary) for ensemble decoding")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads per process that run the models of an ensemble concurrently (default: %(default)s)")
     parser.add_argument('--source', '-s', type=argparse.FileType('r'),
                         required=True, metavar='PATH',
                         help="Source text file")
     parser.add_argument('--input', '-i', type=str,
-                        default='-', help="Input graph or graph pattern (default: standard input)")
+                        default='-', help="Input graph pattern with {} for the sentence number, or lattice archive (default: standard input)")
     parser.add_argument('--output', '-o', type=str,
                         default='-', help="Output file (default: standard output)")
     parser.add_argument('--walign', '-w', required = False,action="store_true",
@@ -100,8 +239,34 @@ if __name__ == "__main__":
                         help="Last sentence number")
     parser.add_argument('--beam', dest='beam', type=int, default=12,
                         help="The beam size for stack decoing")
+    parser.add_argument('--nmt-weight', type=float, default=1.,
+                        help="Weight of the NMT log-probability of each arc (default: %(default)s)")
+    parser.add_argument('--arc-weight', type=float, default=0.,
+                        help="Weight of the score read in on each arc, e.g. the Moses transition score (default: %(default)s)")
+    parser.add_argument('--word-penalty', type=float, default=0.,
+                        help="Score added for each target word (default: %(default)s)")
+    parser.add_argument('--n-best', type=int, default=None, metavar='K',
+                        help="Write the K best paths of each lattice, in the format 'id ||| text ||| score', ranked by unnormalized scores (cannot be combined with -n)")
+    parser.add_argument('--beam-threshold', type=float, default=None, metavar='T',
+                        help="In stack decoding, drop hypotheses whose score is more than T below the best one in their stack")
+    parser.add_argument('--recombine', type=int, default=None, metavar='N',
+                        help="In stack decoding, recombine hypotheses that reach the same lattice node with the same last N target words")
     parser.add_argument('--search', choices=['complete','stack'], default='complete', help="Search method")
+    parser.add_argument('--state-cache', type=int, default=0, metavar='MB',
+                        help="Memory budget of the cache of decoder states shared between lattice paths; 0 disables it (default: %(default)s)")
+    parser.add_argument('--encoder-cache', type=int, default=0, metavar='MB',
+                        help="Memory budget of the cache of encoder outputs, so that repeated source sentences are encoded once; 0 disables it (default: %(default)s)")
+    parser.add_argument('--graph-backend', choices=sorted(GRAPH_BACKENDS), default='object',
+                        help="In-memory representation of lattices: Node and Arc objects, or compact numpy arrays (default: %(default)s)")
+    parser.add_argument('--bpe-codes', type=str, default=None, metavar='PATH',
+                        help="Segment lattice labels into subword units with these BPE codes (from subword-nmt) when loading lattices")
     args = parser.parse_args()
+    if args.n and args.n_best is not None:
+        parser.error('n-best lists are ranked by unnormalized scores; --n-best cannot be combined with -n')
 
     main(args.models, args.source, args.input, args.begin, args.end, args.output, 
-         args.search, b=args.b, normalize=args.n, beam=args.beam, verbose=args.v, alignweights=args.walign)
+         args.search, b=args.b, normalize=args.n, beam=args.beam, verbose=args.v, alignweights=args.walign,
+         state_cache_size=args.state_cache, n_process=args.p, graph_backend=args.graph_backend,
+         bpe_codes=args.bpe_codes, beam_threshold=args.beam_threshold, recombine=args.recombine,
+         nbest=args.n_best, n_threads=args.threads, nmt_weight=args.nmt_weight, arc_weight=args.arc_weight,
+         word_penalty=args.word_penalty, encoder_cache_size=args.encoder_cache)
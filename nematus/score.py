@@ -4,97 +4,178 @@ produce the score, and optionally alignment for each pair.
 """
 
 import sys
+import os
 import argparse
 import tempfile
 
 import numpy
 import json
 
+from multiprocessing import Process, Queue
+from Queue import Empty
+
 from data_iterator import TextIterator
 from util import load_dict, load_config
 from alignment_util import *
 from compat import fill_options
 
 from theano_util import (load_params, init_theano_params)
-from nmt import (pred_probs, build_model, prepare_data, init_params)
+from nmt import (batch_log_probs, build_model, prepare_data, init_params)
 
-from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import theano
 
-def rescore_model(source_file, target_file, saveto, models, options, b, normalize, verbose, alignweights):
-
-    trng = RandomStreams(1234)
-
-    fs_log_probs = []
-
-    for model, option in zip(models, options):
-
-        # load model parameters and set theano shared variables
-        param_list = numpy.load(model).files
-        param_list = dict.fromkeys([key for key in param_list if not key.startswith('adam_')], 0)
-        params = load_params(model, param_list)
-        tparams = init_theano_params(params)
-
-        trng, use_noise, \
-            x, x_mask, y, y_mask, \
-            opt_ret, \
-            cost = \
-            build_model(tparams, option)
-        inps = [x, x_mask, y, y_mask]
-        use_noise.set_value(0.)
-
-        if alignweights:
-            sys.stderr.write("\t*** Save weight mode ON, alignment matrix will be saved.\n")
-            outputs = [cost, opt_ret['dec_alphas']]
-            f_log_probs = theano.function(inps, outputs)
-        else:
-            f_log_probs = theano.function(inps, cost)
+def load_scorer(model, option, alignweights=False):
+    '''
+    Loads a model and builds the function that returns the log probabilities of a batch prepared by prepare_data()
+    (and the attention weights, in optional save weights mode)
+    '''
+    # load model parameters and set theano shared variables
+    param_list = numpy.load(model).files
+    param_list = dict.fromkeys([key for key in param_list if not key.startswith('adam_')], 0)
+    params = load_params(model, param_list)
+    tparams = init_theano_params(params)
+
+    trng, use_noise, \
+        x, x_mask, y, y_mask, \
+        opt_ret, \
+        cost = \
+        build_model(tparams, option)
+    inps = [x, x_mask, y, y_mask]
+    use_noise.set_value(0.)
 
-        fs_log_probs.append(f_log_probs)
-
-    def _score(pairs, alignweights=False):
-        # sample given an input sequence and obtain scores
-        scores = []
-        alignments = []
-        for i, f_log_probs in enumerate(fs_log_probs):
-            score, alignment = pred_probs(f_log_probs, prepare_data, options[i], pairs, normalize=normalize, alignweights = alignweights)
-            scores.append(score)
-            alignments.append(alignment)
-
-        return scores, alignments
+    if alignweights:
+        sys.stderr.write("\t*** Save weight mode ON, alignment matrix will be saved.\n")
+        outputs = [cost, opt_ret['dec_alphas']]
+        return theano.function(inps, outputs)
+    else:
+        return theano.function(inps, cost)
+
+def score_model(queue, rqueue, model, option, normalize, alignweights):
+    '''Worker process that scores the batches it receives with one model of an ensemble'''
+    f_log_probs = load_scorer(model, option, alignweights)
+
+    while True:
+        req = queue.get()
+        if req is None:
+            break
+
+        x, x_mask, y, y_mask = req
+        rqueue.put(batch_log_probs(f_log_probs, x, x_mask, y, y_mask, normalize, alignweights))
+
+    return
+
+def rescore_model(source_file, target_file, saveto, models, options, b, normalize, verbose, alignweights, start_line=0,
+                  parallel_models=False):
+
+    if parallel_models:
+        # one worker process per model; each batch is sent to all of them and scored concurrently
+        queues = [Queue() for model in models]
+        rqueues = [Queue() for model in models]
+        processes = [None] * len(models)
+        for midx, (model, option) in enumerate(zip(models, options)):
+            processes[midx] = Process(
+                target=score_model,
+                args=(queues[midx], rqueues[midx], model, option, normalize, alignweights))
+            processes[midx].start()
+
+        def _retrieve(midx):
+            while True:
+                try:
+                    return rqueues[midx].get(True, 5)
+                # if queue is empty after 5s, check if the process is still alive
+                except Empty:
+                    if not processes[midx].is_alive():
+                        # kill all other processes if one dies
+                        for queue in queues + rqueues:
+                            queue.cancel_join_thread()
+                        for process in processes:
+                            process.terminate()
+                        sys.stderr.write("Error: scoring worker process {0} crashed with exitcode {1}\n".format(processes[midx].pid, processes[midx].exitcode))
+                        sys.exit(1)
+
+        def _score(x, x_mask, y, y_mask):
+            for queue in queues:
+                queue.put((x, x_mask, y, y_mask))
+            return [_retrieve(midx) for midx in xrange(len(models))]
+
+    else:
+        fs_log_probs = [load_scorer(model, option, alignweights) for model, option in zip(models, options)]
+
+        def _score(x, x_mask, y, y_mask):
+            return [batch_log_probs(f_log_probs, x, x_mask, y, y_mask, normalize, alignweights)
+                    for f_log_probs in fs_log_probs]
 
     pairs = TextIterator(source_file.name, target_file.name,
                     options[0]['dictionaries'][:-1], options[0]['dictionaries'][1],
                      n_words_source=options[0]['n_words_src'], n_words_target=options[0]['n_words'],
                      batch_size=b,
                      maxlen=float('inf'),
-                     sort_by_length=False) #TODO: sorting by length could be more efficient, but we'd want to resort after
-
-    scores, alignments = _score(pairs, alignweights)
+                     sort_by_length=True,
+                     return_index=True,
+                     skip_lines=start_line)
 
-    source_file.seek(0)
+    # target sentences are read alongside the scores, for verbose output
     target_file.seek(0)
-    source_lines = source_file.readlines()
-    target_lines = target_file.readlines()
+    target_lines = iter(target_file)
+    for _ in xrange(start_line):
+        next(target_lines, None)
 
-    for i, line in enumerate(target_lines):
-        score_str = ' '.join(map(str,[s[i] for s in scores]))
-        if verbose:
-            saveto.write('{0} '.format(line.strip()))
-        saveto.write('{0}\n'.format(score_str))
+    if alignweights:
+        temp_name = saveto.name + ".json"
+        align_OUT = tempfile.NamedTemporaryFile(prefix=temp_name)
+
+    # Batches are sorted by length within each maxibatch of TextIterator. Scores are kept until all scores
+    # before them are written, so that they are written in corpus order; at most one maxibatch is pending.
+    pending = {}
+    next_idx = start_line
+    n_done = 0
+    for x, y, index in pairs:
+        #ensure consistency in number of factors
+        if len(x[0][0]) != options[0]['factors']:
+            sys.stderr.write('Error: mismatch between number of factors in settings ({0}), and number in source text ({1})\n'.format(options[0]['factors'], len(x[0][0])))
+            sys.exit(1)
+
+        x, x_mask, y, y_mask = prepare_data(x, y,
+                                            n_words_src=options[0]['n_words_src'],
+                                            n_words=options[0]['n_words'])
+
+        # each batch is prepared once and scored with all models
+        results = _score(x, x_mask, y, y_mask)
+        scores = [pprobs for pprobs, alignment in results]
+        alignments = [alignment for pprobs, alignment in results]
+
+        for i, idx in enumerate(index):
+            # alignments are those of the first model
+            pending[idx] = ([s[i] for s in scores], alignments[0][i] if alignweights else None)
+
+        while next_idx in pending:
+            score, alignment = pending.pop(next_idx)
+            score_str = ' '.join(map(str, score))
+            if verbose:
+                saveto.write('{0} '.format(next(target_lines).strip()))
+            saveto.write('{0}\n'.format(score_str))
+            if alignweights:
+                align_OUT.write(alignment + "\n")
+            next_idx += 1
+        saveto.flush()
+
+        n_done += len(index)
+        print >>sys.stderr, '%d samples computed' % (n_done)
+
+    if parallel_models:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
 
     ### optional save weights mode.
     if alignweights:
-        ### writing out the alignments.
-        temp_name = saveto.name + ".json"
-        with tempfile.NamedTemporaryFile(prefix=temp_name) as align_OUT:
-            for line in all_alignments:
-                align_OUT.write(line + "\n")
-            ### combining the actual source and target words.
-            combine_source_target_text_1to1(source_file, target_file, saveto.name, align_OUT)
+        ### combining the actual source and target words.
+        combine_source_target_text_1to1(source_file, target_file, saveto.name, align_OUT)
+        align_OUT.close()
 
 def main(models, source_file, nbest_file, saveto, b=80,
-         normalize=False, verbose=False, alignweights=False):
+         normalize=False, verbose=False, alignweights=False, start_line=0, parallel_models=False):
 
     # load model model_options
     options = []
@@ -103,7 +184,8 @@ def main(models, source_file, nbest_file, saveto, b=80,
 
         fill_options(options[-1])
 
-    rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights)
+    rescore_model(source_file, nbest_file, saveto, models, options, b, normalize, verbose, alignweights, start_line,
+                  parallel_models)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -120,13 +202,34 @@ if __name__ == "__main__":
     parser.add_argument('--target', '-t', type=argparse.FileType('r'),
                         required=True, metavar='PATH',
                         help="Target text file")
-    parser.add_argument('--output', '-o', type=argparse.FileType('w'),
-                        default=sys.stdout, metavar='PATH',
-                        help="Output file (default: standard output)")
+    parser.add_argument('--output', '-o', type=str,
+                        metavar='PATH',
+                        help="Output file (default: standard output); appended to with --start-line")
     parser.add_argument('--walign', '-w',required = False,action="store_true",
                         help="Whether to store the alignment weights or not. If specified, weights will be saved in <target>.alignment")
+    parser.add_argument('--parallel-models', action="store_true",
+                        help="Score each batch with the models of an ensemble concurrently, in one worker process per model")
+    parser.add_argument('--start-line', type=int, default=0, metavar='N',
+                        help="Skip the first N sentence pairs, e.g. to resume an interrupted run with the same --output, which must hold the scores of these N pairs; the scores of the remaining pairs are appended to it (default: %(default)s)")
 
     args = parser.parse_args()
+    if args.walign and args.start_line:
+        parser.error('--walign requires scoring the whole corpus; it cannot be combined with --start-line')
+
+    if args.output is None:
+        output = sys.stdout
+    elif args.start_line:
+        # resume an interrupted run: keep the scores written so far
+        if not os.path.exists(args.output):
+            parser.error('--start-line {0} resumes a run, but {1} does not exist'.format(args.start_line, args.output))
+        with open(args.output) as previous:
+            num_lines = sum(1 for line in previous)
+        if num_lines != args.start_line:
+            parser.error('--start-line {0} does not match the {1} lines of scores in {2}'.format(args.start_line, num_lines, args.output))
+        output = open(args.output, 'a')
+    else:
+        output = open(args.output, 'w')
 
     main(args.models, args.source, args.target,
-         args.output, b=args.b, normalize=args.n, verbose=args.v, alignweights=args.walign)
+         output, b=args.b, normalize=args.n, verbose=args.v, alignweights=args.walign,
+         start_line=args.start_line, parallel_models=args.parallel_models)
@@ -0,0 +1,124 @@
+'''
+Conversion of Moses search graphs into lattices.
+
+The Moses search graph is obtained by adding the flags "-osg FILE" to Moses. It holds the
+search graphs of all sentences of a test set, one hypothesis per line:
+
+1 hyp=0 stack=0
+1 hyp=119 stack=1 back=0 score=-1.158 transition=-1.158 forward=141 fscore=-1.788 covered=2-2 out=all @-@
+1 hyp=977 stack=2 back=76 score=-1.721 transition=-1.221 recombined=1457 forward=4021 fscore=-1.405 covered=2-2 out=everything the
+...
+
+Every hypothesis with a back pointer becomes an arc from the back pointer to the hypothesis
+(or to the hypothesis it was recombined with), labeled with its output phrase and scored with
+its transition score. Hypotheses that complete a translation (forward=-1) get an extra arc,
+labeled with the end-of-sentence symbol, to a single final state.
+
+The file is read once, sentence by sentence; the lines of a sentence must be contiguous, as
+Moses writes them.
+
+Nodes are renumbered in topological order, as walk() requires: hypothesis ids are not, since a
+hypothesis can be recombined with a hypothesis that has a lower id than its back pointer.
+'''
+
+from itertools import groupby
+
+from lattice import Graph, WORD_DELIM
+from lattice_ops import topological_order
+
+def parse_line(line):
+    '''
+    Splits a line of a Moses search graph into its sentence number and a dictionary of its fields.
+    The output phrase (out=) is the last field and may contain spaces.
+    '''
+    fields, _, out = line.rstrip('\r\n').partition(' out=')
+    fields = fields.split()
+    attrs = dict(field.split('=', 1) for field in fields[1:])
+    attrs['out'] = out
+    return int(fields[0]), attrs
+
+def search_graph_arcs(lines, eos_label='<eos>', source_words=None):
+    '''
+    Converts the lines of the search graph of one sentence into lattice arcs.
+    Returns a list of (tail, label, head, score) tuples and the final state, with nodes
+    numbered in topological order from the initial hypothesis (node 0).
+    If source_words (the tokens of the source sentence) are given, each tuple has a fifth
+    element: the covered source phrase, joined like the labels.
+    A sentence without complete hypotheses (or without any lines) gets the empty translation:
+    an end-of-sentence arc from the initial hypothesis.
+    '''
+    arcs = []
+    end_nodes = set()
+    max_node = 0
+    for line in lines:
+        sentno, attrs = parse_line(line)
+        if not 'back' in attrs:
+            # the initial hypothesis
+            continue
+
+        tail = int(attrs['back'])
+        head = int(attrs.get('recombined', attrs['hyp']))
+        label = WORD_DELIM.join(attrs['out'].split()) or '<eps>'
+        arc = (tail, label, head, float(attrs['transition']))
+        if source_words is not None:
+            begin, end = attrs['covered'].split('-')
+            arc += (WORD_DELIM.join(source_words[int(begin):int(end)+1]),)
+        arcs.append(arc)
+
+        if attrs['forward'] == '-1':
+            end_nodes.add(head)
+        max_node = max(max_node, tail, head)
+
+    if not end_nodes:
+        end_nodes.add(0)
+
+    # add an end-of-sentence arc from every end node to a common final state
+    finalstate = max_node + 1
+    for node in sorted(end_nodes):
+        arc = (node, eos_label, finalstate, 0.0)
+        if source_words is not None:
+            arc += (eos_label,)
+        arcs.append(arc)
+
+    # renumber the nodes in topological order
+    ids = dict((node, i) for i, node in enumerate(topological_order([arc[:4] for arc in arcs])))
+    arcs = [(ids[arc[0]], arc[1], ids[arc[2]]) + arc[3:] for arc in arcs]
+    return arcs, ids.get(finalstate, finalstate)
+
+def write_fst(arcs, finalstate, fst_file, keys_file):
+    '''
+    Writes lattice arcs as returned by search_graph_arcs() as an FST in OpenFST text format,
+    and its symbol table. With a covered source phrase on each arc, it is written as the input
+    label, and the output phrase as the output label; otherwise both are the output phrase.
+    '''
+    #create an indexer for all the labels
+    indexer = {'<eps>': 0}
+    def get_index(word):
+        if not word in indexer:
+            indexer[word] = len(indexer)
+        return indexer[word]
+
+    for arc in arcs:
+        tail, label, head, score = arc[:4]
+        get_index(label)
+        if len(arc) > 4:
+            coverage = arc[4]
+            get_index(coverage)
+        else:
+            coverage = label
+        fst_file.write(u'{0} {1} {2} {3} {4}\n'.format(tail, head, coverage, label, 0.0 - score))
+    fst_file.write(u'{0}'.format(finalstate))
+
+    #make the keys file for the symbol table
+    for key in indexer:
+        keys_file.write(u'{0} {1}\n'.format(key, indexer[key]))
+
+def read_search_graphs(search_graph_file, backend=Graph, eos_label='<eos>'):
+    '''
+    Reads a Moses search graph with any number of sentences in a single pass,
+    yielding (sentno, graph) pairs. graph is an instance of backend (Graph or ArrayGraph).
+    '''
+    lines = (line for line in search_graph_file if line.strip())
+    for sentno, lines in groupby(lines, key=lambda line: int(line.split(None, 1)[0])):
+        arcs, finalstate = search_graph_arcs(lines, eos_label)
+        yield sentno, backend.from_arcs(sentno, arcs, finalstate)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+'''
+Translation server: keeps the worker processes of translate.py, with their models loaded and
+their Theano functions compiled, running between requests.
+
+Clients POST source text (one sentence per line, tokenized like the input of translate.py)
+to the server, either as plain text or as a JSON object {"text": "..."} (with the header
+"Content-Type: application/json"), and receive a JSON object with the output of translate.py
+for these sentences:
+
+    {"translation": "...", "alignment": "..."}
+
+"alignment" is only present if the server was started with --alignment. Sentences of requests
+that arrive within --batch-wait seconds of each other are decoded together, in batches of
+--batch-size sentences of similar length.
+
+    curl --data-binary @input.txt http://localhost:8080/
+
+Malformed requests are answered with HTTP status 400, and all requests with 500 once a worker
+process has crashed.
+'''
+
+import sys
+import time
+import json
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from multiprocessing import Queue
+from Queue import Empty
+from Queue import Queue as ThreadQueue
+from StringIO import StringIO
+
+from translate import (load_models, load_dictionaries, load_shortlist, start_processes, words2seq,
+                       write_translation)
+
+
+class TranslationRequest(object):
+    '''The sentences of one client request, and their translations as they arrive'''
+
+    def __init__(self, source_sentences, seqs):
+        self.source_sentences = source_sentences
+        self.seqs = seqs
+        self.translations = [None] * len(seqs)
+        self.remaining = len(seqs)
+        self.done = threading.Event()
+
+
+class TranslationService(object):
+    '''
+    Translates sentences with a pool of translate.py workers that is started once.
+    translate() may be called from several threads; a dispatcher thread sends the sentences
+    of all pending requests to the workers, and a collector thread hands their translations
+    back to the requests.
+    '''
+
+    # seconds between checks whether the workers are still alive, while no translation arrives
+    poll_interval = 5
+
+    def __init__(self, models, k=5, normalize=False, n_process=5, chr_level=False, verbose=False, nbest=False,
+                 suppress_unk=False, a_json=False, print_word_probabilities=False, return_alignment=False,
+                 batch_size=1, batch_wait=0.01, shortlist_table=None, shortlist_per_word=100, shortlist_frequent=0):
+        self.options = load_models(models)
+        self.word_dicts, word_dict_trg, self.word_idict_trg = load_dictionaries(self.options)
+        shortlist = load_shortlist(self.options, self.word_dicts, word_dict_trg, shortlist_table,
+                                   shortlist_per_word, shortlist_frequent)
+
+        self.chr_level = chr_level
+        self.verbose = verbose
+        self.nbest = nbest
+        self.a_json = a_json
+        self.print_word_probabilities = print_word_probabilities
+        self.return_alignment = return_alignment
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        # the workers are forked before any thread is started
+        queue = Queue()
+        rqueue = Queue()
+        processes = start_processes(queue, rqueue, n_process, models, self.options, k, normalize,
+                                    verbose, nbest, return_alignment, suppress_unk, False, batch_size, shortlist)
+        self.start_threads(queue, rqueue, processes)
+
+    def start_threads(self, queue, rqueue, processes):
+        '''
+        Starts the dispatcher and collector threads, which send sentences to the workers through
+        queue and receive their translations through rqueue, as translate_model() does
+        '''
+        self.queue = queue
+        self.rqueue = rqueue
+        self.processes = processes
+
+        # requests waiting to be sent to the workers
+        self.pending = ThreadQueue()
+        # the request and position of each sentence sent to the workers, by job id
+        self.jobs = {}
+        self.next_id = 0
+        # set if the workers crashed; guarded by lock, like jobs
+        self.error = None
+        self.lock = threading.Lock()
+        self.closed = False
+
+        self.threads = [threading.Thread(target=target) for target in (self._dispatch, self._collect)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        '''Stops the dispatcher and collector threads, and terminates the workers'''
+        self.closed = True
+        self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
+        for process in self.processes:
+            process.terminate()
+
+    def translate(self, text):
+        '''
+        Translates the lines of text, and returns the output (and alignments) that translate.py
+        would write for them. Raises a ValueError if the input is malformed.
+        '''
+        source_sentences = []
+        seqs = []
+        for line in text.splitlines():
+            if self.chr_level:
+                words = list(line.decode('utf-8').strip())
+            else:
+                words = line.strip().split()
+            seqs.append(words2seq(words, self.word_dicts, self.options[0]['factors']))
+            source_sentences.append(words)
+
+        request = TranslationRequest(source_sentences, seqs)
+        if seqs and self.error is None:
+            self.pending.put(request)
+            request.done.wait()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+        output = StringIO()
+        alignment = StringIO() if self.return_alignment else None
+        for i, trans in enumerate(request.translations):
+            write_translation(output, i, trans, source_sentences[i], self.word_idict_trg, nbest=self.nbest,
+                              print_word_probabilities=self.print_word_probabilities, save_alignment=alignment,
+                              a_json=self.a_json)
+
+        response = {'translation': output.getvalue()}
+        if alignment is not None:
+            response['alignment'] = alignment.getvalue()
+        return response
+
+    def _dispatch(self):
+        while True:
+            # wait for a request, then for the requests that arrive shortly after it
+            requests = [self.pending.get()]
+            if requests[0] is None:
+                return
+            deadline = time.time() + self.batch_wait
+            while True:
+                timeout = deadline - time.time()
+                try:
+                    request = self.pending.get(timeout > 0, max(timeout, 0))
+                except Empty:
+                    break
+                if request is None:
+                    # closed: stop after this batch
+                    self.pending.put(None)
+                    break
+                requests.append(request)
+
+            with self.lock:
+                if self.error is not None:
+                    for request in requests:
+                        request.done.set()
+                    continue
+
+                sentences = []
+                for request in requests:
+                    for position, seq in enumerate(request.seqs):
+                        self.jobs[self.next_id] = (request, position)
+                        sentences.append((self.next_id, seq))
+                        self.next_id += 1
+
+            if self.batch_size > 1:
+                # batches of sentences of similar length, to save padding
+                sentences.sort(key=lambda sentence: len(sentence[1]))
+            for start in xrange(0, len(sentences), self.batch_size):
+                batch = sentences[start:start+self.batch_size]
+                self.queue.put(([idx for idx, seq in batch], [seq for idx, seq in batch]))
+
+    def _collect(self):
+        while not self.closed:
+            try:
+                resp = self.rqueue.get(True, self.poll_interval)
+            # if queue is empty, check if processes are still alive
+            except Empty:
+                for process in self.processes:
+                    if not process.is_alive():
+                        self._fail("translate worker process {0} crashed with exitcode {1}".format(process.pid, process.exitcode))
+                        return
+                continue
+
+            for idx, trans in zip(*resp):
+                with self.lock:
+                    request, position = self.jobs.pop(idx)
+                request.translations[position] = trans
+                request.remaining -= 1
+                if request.remaining == 0:
+                    request.done.set()
+
+    def _fail(self, message):
+        # stop all workers, and answer all requests (including those still to come) with an error
+        sys.stderr.write('Error: {0}\n'.format(message))
+        with self.lock:
+            self.error = message
+            for request, position in self.jobs.values():
+                request.done.set()
+            self.jobs.clear()
+        for process in self.processes:
+            process.terminate()
+
+
+class TranslationRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        try:
+            response = self.server.service.translate(self.read_text())
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except RuntimeError as e:
+            self.send_error(500, str(e))
+            return
+
+        body = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_text(self):
+        '''Returns the source text of the request. Raises a ValueError if it is malformed.'''
+        text = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if self.headers.gettype() == 'application/json':
+            request = json.loads(text)
+            if not isinstance(request, dict) or not isinstance(request.get('text'), basestring):
+                raise ValueError('expected a JSON object with a "text" string')
+            text = request['text']
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+        return text
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TranslationServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server that handles each request in a thread, so that concurrent requests can be batched'''
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, TranslationRequestHandler)
+        self.service = service
+
+
+def main(models, host='localhost', port=8080, **kwargs):
+    service = TranslationService(models, **kwargs)
+    server = TranslationServer((host, port), service)
+    sys.stderr.write('Serving translations on {0}:{1} ...\n'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    service.close()
+    sys.stderr.write('Done\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', type=int, default=5,
+                        help="Beam size (default: %(default)s))")
+    parser.add_argument('-p', type=int, default=1,
+                        help="Number of processes (default: %(default)s))")
+    parser.add_argument('-n', action="store_true",
+                        help="Normalize scores by sentence length")
+    parser.add_argument('-c', action="store_true", help="Character-level")
+    parser.add_argument('-v', action="store_true", help="verbose mode.")
+    parser.add_argument('--models', '-m', type=str, nargs = '+', required=True,
+                        help="model to use. Provide multiple models (with same vocabulary) for ensemble decoding")
+    parser.add_argument('--host', default='localhost',
+                        help="Host name or address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="Port to listen on (default: %(default)s)")
+    parser.add_argument('--alignment', action="store_true",
+                        help="Return alignment weights")
+    parser.add_argument('--json_alignment', action="store_true",
+                        help="Return alignment in json format")
+    parser.add_argument('--n-best', action="store_true",
+                        help="Return n-best lists (of size k)")
+    parser.add_argument('--suppress-unk', action="store_true", help="Suppress hypotheses containing UNK.")
+    parser.add_argument('--print-word-probabilities', '-wp',action="store_true", help="Return probabilities of each word")
+    parser.add_argument('--batch-size', '-b', type=int, default=1,
+                        help="Number of sentences that each process decodes together in one beam search (default: %(default)s)")
+    parser.add_argument('--batch-wait', type=float, default=0.01, metavar='SECONDS',
+                        help="Time to wait for more requests to translate together with a request (default: %(default)s)")
+    parser.add_argument('--shortlist', metavar='PATH',
+                        help="Lexical table ('source target score' per line) to restrict the output layer to the candidate translations of the source words")
+    parser.add_argument('--shortlist-per-word', type=int, default=100, metavar='N',
+                        help="Number of candidate translations of each source word in the shortlist (default: %(default)s)")
+    parser.add_argument('--shortlist-frequent', type=int, default=0, metavar='N',
+                        help="Add the N most frequent target words to the shortlist of every sentence; without --shortlist, restrict the output layer to them (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    main(args.models, host=args.host, port=args.port, k=args.k, normalize=args.n, n_process=args.p,
+         chr_level=args.c, verbose=args.v, nbest=args.n_best, suppress_unk=args.suppress_unk,
+         print_word_probabilities=args.print_word_probabilities, return_alignment=args.alignment or args.json_alignment,
+         a_json=args.json_alignment, batch_size=args.batch_size, batch_wait=args.batch_wait,
+         shortlist_table=args.shortlist, shortlist_per_word=args.shortlist_per_word,
+         shortlist_frequent=args.shortlist_frequent)
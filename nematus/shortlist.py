@@ -0,0 +1,63 @@
+'''
+Vocabulary shortlists for decoding.
+
+A shortlist restricts the output layer of the decoder to the target words that are likely
+to occur in the translation of a source sentence: the most frequent target words, and the
+candidate translations of each source word in a lexical table, e.g. one extracted from
+word alignments. The softmax is then computed over a few thousand words rather than the
+whole target vocabulary (see build_sampler(..., shortlist=True)).
+
+The lexical table has one entry per line:
+
+    source_word target_word score
+
+where higher scores are better (probabilities or log-probabilities both work, only the
+ranking of the candidates of each source word matters).
+'''
+
+from collections import defaultdict
+
+import numpy
+
+class Shortlist(object):
+    '''
+    Selects the target words of the output layer for source sentences.
+    Shortlists are sorted arrays of target word ids that start with 0 (<eos>) and 1 (UNK).
+    '''
+
+    def __init__(self, word_dict_src, word_dict_trg, n_words_trg, lexical_table=None, per_word=100, frequent=0):
+        '''
+        word_dict_src and word_dict_trg map words to ids; ids of target words at or above
+        n_words_trg are outside of the vocabulary of the model and never selected.
+        lexical_table is an open file in the format above, with UTF-8 encoded words like the
+        keys of the dictionaries; the per_word best candidates of each source word are kept.
+        The ids of target dictionaries built with build_dictionary.py are sorted by frequency;
+        the target words with ids 2 to frequent+1 (the most frequent ones) are always selected.
+        '''
+        self.base = numpy.arange(min(frequent + 2, n_words_trg), dtype='int64')
+
+        candidates = defaultdict(list)
+        if lexical_table is not None:
+            for line in lexical_table:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                source, target, score = fields
+                if source in word_dict_src and target in word_dict_trg and word_dict_trg[target] < n_words_trg:
+                    candidates[word_dict_src[source]].append((float(score), word_dict_trg[target]))
+
+        # candidate target ids of each source id
+        self.candidates = {}
+        for source_id, entries in candidates.iteritems():
+            entries.sort(reverse=True)
+            self.candidates[source_id] = numpy.array([target_id for score, target_id in entries[:per_word]], dtype='int64')
+
+    @classmethod
+    def from_path(cls, path, word_dict_src, word_dict_trg, n_words_trg, per_word=100, frequent=0):
+        with open(path) as lexical_table:
+            return cls(word_dict_src, word_dict_trg, n_words_trg, lexical_table, per_word, frequent)
+
+    def select(self, source_ids):
+        '''Returns the shortlist for a sequence of source word ids (of one or more sentences)'''
+        selected = [self.candidates[source_id] for source_id in set(source_ids) if source_id in self.candidates]
+        return numpy.unique(numpy.concatenate([self.base] + selected))
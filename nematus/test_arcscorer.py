@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy
+from StringIO import StringIO
+
+from arcscorer import ArcScorer
+from lattice import Graph
+from searchgraph import search_graph_arcs, write_fst
+
+VOCAB_SIZE = 7
+DIM = 3
+
+# a lattice over the target words w2 to w6, with arcs of several words and shared prefixes
+FST = """0 1 w2 w2 1.0
+0 2 w3 w3 0.5
+1 3 w4|w5 w4|w5 1.0
+2 3 w4 w4 2.0
+1 4 w6 w6 3.0
+3 4 <eos> <eos> 0
+2 5 w2|w4 w2|w4 0
+5 4 <eos> <eos> 0
+4
+"""
+
+class StubModel(object):
+    """
+    A small random model with the interface of the functions returned by
+    build_sampler(..., precompute_context=True), which counts its encoder runs and decoder steps
+    """
+    def __init__(self, seed):
+        rng = numpy.random.RandomState(seed)
+        self.embeddings = rng.randn(VOCAB_SIZE, DIM).astype('float32')
+        self.output = rng.randn(DIM, VOCAB_SIZE).astype('float32')
+        self.init_calls = 0
+        self.next_rows = 0
+
+    def f_init(self, x):
+        self.init_calls += 1
+        ctx = self.embeddings[x[0]]
+        return numpy.tanh(ctx.mean(0)), ctx, 2 * ctx
+
+    def f_next(self, y, ctx, pctx, state, hyp_sentences):
+        self.next_rows += len(y)
+        emb = numpy.where(y[:, None] < 0, 0, self.embeddings[numpy.maximum(y, 0)])
+        state = numpy.tanh(state + emb + ctx[:, hyp_sentences].sum(0) + pctx[:, hyp_sentences].mean(0)).astype('float32')
+        logits = state.dot(self.output)
+        probs = numpy.exp(logits - logits.max(1, keepdims=True))
+        probs /= probs.sum(1, keepdims=True)
+        return probs.astype('float32'), probs.argmax(1), state
+
+class StubArcScorer(ArcScorer):
+    """An ArcScorer of stub models rather than of models loaded from disk"""
+    def __init__(self, models, **kwargs):
+        self.fs_init = [model.f_init for model in models]
+        self.fs_next = [model.f_next for model in models]
+        self.options = [{'n_words': VOCAB_SIZE}]
+        self.word_dict = {'x': 2, 'y': 3}
+        self.word_dict_trg = dict(('w{0}'.format(i), i) for i in range(2, VOCAB_SIZE))
+        self.word_dict_trg['UNK'] = 1
+        self.init_caches(**kwargs)
+
+class TestArcScorer(unittest.TestCase):
+    """
+    Regression tests for the caches of the NMT scorer of lattice arcs
+    """
+    def search(self, scorer):
+        scorer.set_source_sentence('x y x')
+        graph = Graph(0, StringIO(FST))
+        scorer.prepare_graph(graph)
+        return graph.walk(scorer), graph.beam_search(scorer, verbose=False), graph.walk(scorer, nbest=3)
+
+    def assertSearchEqual(self, first, second):
+        for result1, result2 in zip(first[:2] + tuple(first[2]), second[:2] + tuple(second[2])):
+            self.assertEqual(result1[2], result2[2])
+            self.assertAlmostEqual(result1[1], result2[1], places=5)
+
+    def test_cached(self):
+        uncached_model, cached_model = StubModel(1), StubModel(1)
+        uncached = self.search(StubArcScorer([uncached_model]))
+        scorer = StubArcScorer([cached_model], state_cache_size=1, encoder_cache_size=1)
+        cached = self.search(scorer)
+        self.assertSearchEqual(cached, uncached)
+
+        # the second and third search are served by the state cache and the memo
+        self.assertTrue(scorer.memo_hits > 0)
+        self.assertTrue(scorer.state_cache.hits > 0)
+        self.assertTrue(cached_model.next_rows < uncached_model.next_rows)
+
+        # the encoder runs once per distinct source sentence
+        self.assertSearchEqual(self.search(scorer), uncached)
+        self.assertEqual(cached_model.init_calls, 1)
+        self.assertEqual(scorer.encoder_caches[0].hits, 1)
+
+    def test_evicted(self):
+        uncached = StubArcScorer([StubModel(1)])
+        # room for the softmax row and decoder state of two steps
+        scorer = StubArcScorer([StubModel(1)], state_cache_size=2 * 4 * (VOCAB_SIZE + DIM) / 1024.**2)
+        arc = Graph(0, StringIO(FST)).root.getOutgoingArcs()[0]
+        for s in uncached, scorer:
+            s.set_source_sentence('x y x')
+            s.prepare_graph(Graph(0, StringIO(FST)))
+
+        expected = uncached.score(None, arc)
+        state, score = scorer.score(None, arc)
+        self.assertAlmostEqual(score, expected[1])
+        # three more steps evict the first one from the cache and from the memo
+        for i in range(3):
+            state, score = scorer.score(state, arc)
+        self.assertEqual(len(scorer.state_cache), 2)
+
+        misses = scorer.memo_misses
+        state, score = scorer.score(None, arc)
+        self.assertEqual(scorer.memo_misses, misses + 1)
+        self.assertAlmostEqual(score, expected[1])
+        # the rescored step gets a new decoder state id, so its successors are not confused with others
+        self.assertNotEqual(state['id'], expected[0]['id'])
+        self.assertAlmostEqual(scorer.score(state, arc)[1], uncached.score(expected[0], arc)[1])
+
+    def test_per_sentence_fst(self):
+        # an FST written by searchgraph_to_fst.py ends with <eos> arcs, which are scored as the end of sentence
+        search_graph = ["0 hyp=0 stack=0\n",
+                        "0 hyp=1 stack=1 back=0 score=-1 transition=-1 forward=-1 fscore=-1 covered=0-0 out=w2 w3\n"]
+        for source_words in None, ['x']:
+            fst, keys = StringIO(), StringIO()
+            write_fst(*search_graph_arcs(search_graph, source_words=source_words) + (fst, keys))
+            graph = Graph(0, StringIO(fst.getvalue()))
+            StubArcScorer([StubModel(1)]).prepare_graph(graph)
+            self.assertEqual([arc.ids for node in graph.nodelist for arc in node.getOutgoingArcs()], [(2, 3), (0,)])
+
+    def test_ensemble(self):
+        graph = Graph(0, StringIO(FST))
+        paths = list(self.paths(graph, graph.root))
+        self.assertEqual(len(paths), 4)
+        for n_threads in 1, 2:
+            ensemble = StubArcScorer([StubModel(1), StubModel(2)], n_threads=n_threads, state_cache_size=1)
+            self.assertEqual(ensemble.pool is not None, n_threads > 1)
+            scorers = [ensemble, StubArcScorer([StubModel(1)]), StubArcScorer([StubModel(2)])]
+            for scorer in scorers:
+                scorer.set_source_sentence('x y x')
+                scorer.prepare_graph(graph)
+
+            # the log-probabilities of the models are summed along each path
+            for path in paths:
+                scores = []
+                for scorer in scorers:
+                    state, total = None, 0.
+                    for arc in path:
+                        state, score = scorer.score(state, arc)
+                        total += score
+                    scores.append(total)
+                self.assertAlmostEqual(scores[0], scores[1] + scores[2], places=5)
+
+    def paths(self, graph, node):
+        '''Yields the arcs of each path from node to the final state'''
+        if node.id == graph.finalstate:
+            yield []
+        for arc in node.getOutgoingArcs():
+            for path in self.paths(graph, arc.head):
+                yield [arc] + path
+
+if __name__ == '__main__':
+    unittest.main()
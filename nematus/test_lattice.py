@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+from StringIO import StringIO
+
+from lattice import Graph, ArrayGraph, LatticeArchive, LatticeArchiveWriter, BestItem, Stack, InterpolatedScorer, read_lattice
+from searchgraph import read_search_graphs, search_graph_arcs
+from lattice_ops import prune, rmepsilon, determinize, topsort, preprocess
+from bpe import BPE
+from util import EncoderCache
+from shortlist import Shortlist
+
+# a small lattice in OpenFST text format: three paths from 0 to the final state 4
+FST = """0 1 a a 1.0
+0 2 b b 0.5
+1 3 c|d c|d 1.0
+2 3 e e 2.0
+1 4 f f 4.0
+3 4 <eos> <eos> 0
+4
+"""
+
+# a lattice with an epsilon arc and two arcs labeled a from the root
+NONDETERMINISTIC_FST = """0 1 a a 1.0
+0 2 a a 2.0
+1 3 <eps> <eps> 0.5
+2 3 b b 1.0
+1 3 b b 3.0
+3 4 <eos> <eos> 0
+4
+"""
+
+# the Moses search graphs of two sentences, as written with -osg
+SEARCH_GRAPH = """0 hyp=0 stack=0
+0 hyp=1 stack=1 back=0 score=-1 transition=-1 forward=3 fscore=-2 covered=0-0 out=a
+0 hyp=2 stack=1 back=0 score=-0.5 transition=-0.5 forward=4 fscore=-2 covered=1-1 out=b
+0 hyp=3 stack=2 back=1 score=-2 transition=-1 forward=-1 fscore=-2 covered=1-1 out=c d
+0 hyp=4 stack=2 back=2 score=-2.5 transition=-2 recombined=3 forward=-1 fscore=-2.5 covered=0-0 out=e
+1 hyp=0 stack=0
+1 hyp=5 stack=1 back=0 score=-1 transition=-1 forward=-1 fscore=-1 covered=0-0 out=x
+"""
+
+class BatchCountingScorer(object):
+    """
+    Scores an arc with the negated number of its words, and records the size of every batch
+    """
+    def __init__(self):
+        self.batches = []
+
+    def score_batch(self, pairs):
+        self.batches.append(len(pairs))
+        return [(None, -float(arc.numWords())) for state, arc in pairs]
+
+class TestLattice(unittest.TestCase):
+    """
+    Regression tests for search over lattices
+    """
+    def setUp(self):
+        self.graph = Graph(0, StringIO(FST))
+
+    def test_walk(self):
+        sentno, score, text = self.graph.walk()
+        self.assertEqual(text, 'a c d <eos>')
+        self.assertAlmostEqual(score, -2.0)
+
+    def test_beam_search(self):
+        sentno, score, text = self.graph.beam_search(verbose=False)
+        self.assertEqual(text, 'a c d <eos>')
+        self.assertAlmostEqual(score, -2.0)
+
+    def test_verbose_output(self):
+        # diagnostics go to stderr, so that they do not mix with the results on stdout
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            self.graph.walk(verbose=True)
+            self.graph.beam_search(verbose=True)
+            output, diagnostics = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        self.assertEqual(output, '')
+        self.assertIn('BESTARC', diagnostics)
+
+    def test_walk_batches_outgoing_arcs(self):
+        scorer = BatchCountingScorer()
+        sentno, score, text = self.graph.walk(scorer)
+        self.assertEqual(scorer.batches, [2, 2, 1, 1])
+        self.assertEqual(text, 'a f')
+        self.assertAlmostEqual(score, -2.0)
+
+class TestStack(unittest.TestCase):
+    """
+    Regression tests for pruning and recombination in the stacks of beam search
+    """
+    def test_histogram_pruning(self):
+        stack = Stack(2)
+        for score in [-2., -1., -3., -0.5]:
+            stack.push(BestItem(score = score))
+        self.assertEqual([item.score for item in stack.items()], [-0.5, -1.])
+        self.assertEqual(stack.num_pruned, 2)
+
+    def test_threshold_pruning(self):
+        stack = Stack(10, threshold = 0.9)
+        for score in [-2., -1., -3., -1.5]:
+            stack.push(BestItem(score = score))
+        self.assertEqual([item.score for item in stack.items()], [-1., -1.5])
+
+    def test_recombination(self):
+        stack = Stack(10)
+        first, second, third = BestItem(score = -2.), BestItem(score = -1.), BestItem(score = -3.)
+        stack.push(first, key = (3, ('b',)))
+        stack.push(second, key = (3, ('b',)))
+        stack.push(third, key = (3, ('b',)))
+        self.assertEqual(stack.items(), [second])
+        self.assertEqual(second.recombined, [first, third])
+
+    def test_beam_search(self):
+        graph = Graph(0, StringIO(NONDETERMINISTIC_FST))
+        self.assertEqual(graph.beam_search(verbose=False, beam=1), (0, -1.5, 'a <eos>'))
+        self.assertEqual(graph.beam_search(verbose=False, threshold=0.5), (0, -1.5, 'a <eos>'))
+        self.assertEqual(graph.beam_search(verbose=False, history=0), (0, -1.5, 'a <eos>'))
+
+        # the two paths 'a b' reach node 3 with the same last word
+        scorer = BatchCountingScorer()
+        graph.beam_search(scorer, verbose=False, history=1)
+        self.assertEqual(scorer.batches, [2, 3, 2, 0])
+
+class TestNBest(unittest.TestCase):
+    """
+    Regression tests for n-best extraction
+    """
+    def test_walk(self):
+        for backend in Graph, ArrayGraph:
+            graph = backend(0, StringIO(FST))
+            self.assertEqual(graph.walk(nbest=5), [(0, -2.0, 'a c d <eos>'), (0, -2.5, 'b e <eos>'), (0, -5.0, 'a f')])
+            self.assertEqual(graph.walk(nbest=1), [graph.walk()])
+
+    def test_beam_search_recombined(self):
+        # with recombination on the node alone, both paths 'a b' are recombined into 'a <eps>' at node 3
+        graph = Graph(0, StringIO(NONDETERMINISTIC_FST))
+        self.assertEqual(graph.beam_search(verbose=False, history=0, nbest=2),
+                         [(0, -1.5, 'a <eos>'), (0, -3.0, 'a b <eos>')])
+        self.assertEqual(len(graph.beam_search(verbose=False, history=0, nbest=10)), 3)
+
+class TestScoring(unittest.TestCase):
+    """
+    Regression tests for length normalization and score interpolation in lattice search
+    """
+    def test_normalize(self):
+        graph = Graph(0, StringIO("0 1 x x 1.0\n0 3 y|z|w y|z|w 1.2\n1 2 <eos> <eos> 0\n3 2 <eos> <eos> 0\n2\n"))
+        self.assertEqual(graph.walk(), (0, -1.0, 'x <eos>'))
+        self.assertEqual(graph.beam_search(verbose=False), (0, -1.0, 'x <eos>'))
+        self.assertAlmostEqual(graph.walk(normalize=True)[1], -0.3)
+        self.assertEqual(graph.walk(normalize=True)[2], 'y z w <eos>')
+        self.assertEqual(graph.beam_search(verbose=False, normalize=True)[2], 'y z w <eos>')
+
+    def test_normalize_nbest(self):
+        # the raw and the normalized scores rank the two paths in opposite orders
+        for backend in Graph, ArrayGraph:
+            graph = backend(0, StringIO("0 1 x x 1.0\n0 3 y|z|w y|z|w 1.2\n1 2 <eos> <eos> 0\n3 2 <eos> <eos> 0\n2\n"))
+            self.assertEqual([text for sentno, score, text in graph.walk(nbest=2)], ['x <eos>', 'y z w <eos>'])
+            self.assertEqual(graph.walk(normalize=True)[2], 'y z w <eos>')
+            # so n-best lists, which are ranked by raw scores, are not extracted with normalize
+            self.assertRaises(ValueError, graph.walk, normalize=True, nbest=2)
+            self.assertRaises(ValueError, graph.beam_search, verbose=False, normalize=True, nbest=2)
+
+    def test_interpolation(self):
+        graph = Graph(0, StringIO(FST))
+        scorer = InterpolatedScorer(graph, word_penalty=-1.)
+        self.assertEqual(graph.walk(scorer), (0, -5.5, 'b e <eos>'))
+        self.assertEqual(graph.beam_search(scorer, verbose=False), (0, -5.5, 'b e <eos>'))
+
+        # the scores of BatchCountingScorer (-1 per word) interpolated with the arc scores
+        scorer = InterpolatedScorer(BatchCountingScorer(), scorer_weight=0.5, arc_weight=2.)
+        self.assertEqual(graph.walk(scorer), (0, -6.0, 'a c d <eos>'))
+
+    def test_word_penalty_epsilon(self):
+        # the word penalty does not count <eps> as a word
+        graph = Graph(0, StringIO(NONDETERMINISTIC_FST))
+        scorer = InterpolatedScorer(graph, word_penalty=-1.)
+        self.assertEqual(graph.walk(scorer), (0, -3.5, 'a <eos>'))
+
+class TestTargetIds(unittest.TestCase):
+    """
+    Arcs share the target ids resolved once per distinct label
+    """
+    def test_set_target_ids(self):
+        for backend in Graph, ArrayGraph:
+            graph = backend(0, StringIO(FST))
+            resolved = []
+            def label2ids(label):
+                resolved.append(label)
+                return tuple(len(word) for word in label.split('|'))
+            graph.set_target_ids(label2ids)
+            self.assertEqual(sorted(resolved), ['<eos>', 'a', 'b', 'c|d', 'e', 'f'])
+            ids = dict((arc.label, arc.ids) for node in graph.nodelist for arc in node.getOutgoingArcs())
+            self.assertEqual(ids['c|d'], (1, 1))
+            self.assertEqual(ids['<eos>'], (5,))
+
+class TestArrayGraph(unittest.TestCase):
+    """
+    The array-backed graph must behave like the object graph
+    """
+    def setUp(self):
+        self.graph = Graph(0, StringIO(FST))
+        self.array_graph = ArrayGraph(0, StringIO(FST))
+
+    def test_structure(self):
+        self.assertEqual(self.array_graph.numnodes(), self.graph.numnodes())
+        self.assertEqual(self.array_graph.numarcs(), self.graph.numarcs())
+        self.assertEqual(self.array_graph.finalstate, 4)
+        self.assertRaises(TypeError, self.array_graph.addArc, 4, 'g', 5, 0.)
+        for node, array_node in zip(self.graph.nodelist, self.array_graph.nodelist):
+            self.assertEqual(node.id, array_node.id)
+            self.assertEqual(map(str, node.getOutgoingArcs()), map(str, array_node.getOutgoingArcs()))
+            self.assertEqual(sorted(map(str, node.getIncomingArcs())), sorted(map(str, array_node.getIncomingArcs())))
+
+    def test_from_graph(self):
+        converted = ArrayGraph.from_graph(self.graph)
+        self.assertEqual(list(converted.node_ids), list(self.array_graph.node_ids))
+        self.assertEqual([converted.labels[l] for l in converted.label_ids],
+                         [self.array_graph.labels[l] for l in self.array_graph.label_ids])
+
+    def test_search(self):
+        self.assertEqual(self.array_graph.walk(), self.graph.walk())
+        self.assertEqual(self.array_graph.beam_search(verbose=False), self.graph.beam_search(verbose=False))
+        self.assertEqual(self.array_graph.walk(BatchCountingScorer()), self.graph.walk(BatchCountingScorer()))
+
+class TestBinaryLattice(unittest.TestCase):
+    """
+    Round trip of lattices through the binary format
+    """
+    def setUp(self):
+        self.array_graph = ArrayGraph(0, StringIO(FST))
+        self.data = self.array_graph.to_binary()
+
+    def test_round_trip(self):
+        loaded = ArrayGraph.from_binary(0, self.data)
+        self.assertEqual(loaded.finalstate, 4)
+        self.assertEqual(loaded.labels, self.array_graph.labels)
+        for name in ['node_ids', 'tails', 'heads', 'label_ids', 'scores', 'out_offsets', 'in_arcs', 'in_offsets']:
+            self.assertEqual(list(getattr(loaded, name)), list(getattr(self.array_graph, name)))
+        self.assertEqual(loaded.walk(), self.array_graph.walk())
+
+    def test_read_lattice(self):
+        self.assertEqual(read_lattice(0, self.data, ArrayGraph).beam_search(verbose=False), (0, -2.0, 'a c d <eos>'))
+        graph = read_lattice(0, self.data)
+        self.assertTrue(isinstance(graph, Graph))
+        self.assertEqual(graph.walk(), (0, -2.0, 'a c d <eos>'))
+        self.assertEqual(read_lattice(0, FST).walk(), (0, -2.0, 'a c d <eos>'))
+
+class TestLatticeArchive(unittest.TestCase):
+    """
+    Round trip of lattices through a single-file archive
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'lattices')
+        with LatticeArchiveWriter(self.path) as writer:
+            writer.add(5, FST)
+            writer.add(2, FST.replace('f f 4.0', 'f f 0.0'))
+            writer.add(7, ArrayGraph(7, StringIO(FST)).to_binary())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        for use_mmap in [True, False]:
+            archive = LatticeArchive(self.path, use_mmap=use_mmap)
+            self.assertEqual(archive.sentnos(), [5, 2, 7])
+            self.assertTrue(2 in archive)
+            self.assertFalse(3 in archive)
+            self.assertEqual(str(archive.read(5)), FST)
+            self.assertEqual(archive.graph(5).walk(), Graph(5, StringIO(FST)).walk())
+            self.assertEqual(archive.graph(2, ArrayGraph).walk(), (2, -1.0, 'a f'))
+            self.assertEqual(archive.graph(7).walk(), (7, -2.0, 'a c d <eos>'))
+            self.assertEqual([sentno for sentno, graph in archive], [5, 2, 7])
+            archive.close()
+
+class TestSearchGraph(unittest.TestCase):
+    """
+    Regression tests for the conversion of Moses search graphs
+    """
+    def test_arcs(self):
+        lines = SEARCH_GRAPH.splitlines(True)[:5]
+        arcs, finalstate = search_graph_arcs(lines, source_words=['s0', 's1'])
+        self.assertEqual(finalstate, 4)
+        self.assertEqual(arcs, [(0, 'a', 1, -1.0, 's0'),
+                                (0, 'b', 2, -0.5, 's1'),
+                                (1, 'c|d', 3, -1.0, 's1'),
+                                (2, 'e', 3, -2.0, 's0'),
+                                (3, '<eos>', 4, 0.0, '<eos>')])
+
+    def test_read(self):
+        for backend in Graph, ArrayGraph:
+            graphs = list(read_search_graphs(StringIO(SEARCH_GRAPH), backend=backend))
+            self.assertEqual([sentno for sentno, graph in graphs], [0, 1])
+            self.assertEqual(graphs[0][1].walk(), (0, -2.0, 'a c d <eos>'))
+            self.assertEqual(graphs[1][1].walk(), (1, -1.0, 'x <eos>'))
+
+    def test_empty(self):
+        # a sentence without a complete hypothesis gets a lattice of the empty translation
+        self.assertEqual(search_graph_arcs([]), ([(0, '<eos>', 1, 0.0)], 1))
+        arcs, finalstate = search_graph_arcs(["2 hyp=0 stack=0\n"], source_words=['x'])
+        self.assertEqual(arcs, [(0, '<eos>', 1, 0.0, '<eos>')])
+        self.assertEqual(Graph.from_arcs(2, [arc[:4] for arc in arcs], finalstate).walk(), (2, 0.0, '<eos>'))
+
+    def test_recombination_order(self):
+        # hypothesis 4 extends hypothesis 3, and is recombined with hypothesis 2
+        search_graph = StringIO("""0 hyp=0 stack=0
+0 hyp=1 stack=1 back=0 score=-0.1 transition=-0.1 forward=2 fscore=-5 covered=0-0 out=x
+0 hyp=2 stack=2 back=1 score=-5 transition=-4.9 forward=-1 fscore=-5 covered=1-1 out=y
+0 hyp=3 stack=1 back=0 score=-0.1 transition=-0.1 forward=4 fscore=-0.2 covered=1-1 out=z
+0 hyp=4 stack=2 back=3 score=-0.2 transition=-0.1 recombined=2 forward=-1 fscore=-0.2 covered=0-0 out=w
+""")
+        sentno, graph = next(read_search_graphs(search_graph))
+        self.assertTrue(all(tail < head for tail, label, head, score in graph.arcs()))
+        self.assertEqual(graph.walk(), graph.beam_search(verbose=False))
+        self.assertEqual(graph.walk()[2], 'z w <eos>')
+        self.assertAlmostEqual(graph.walk()[1], -0.2)
+
+
+class TestLatticeOps(unittest.TestCase):
+    """
+    Regression tests for pruning, epsilon removal, determinization and topological sorting
+    """
+    def setUp(self):
+        self.graph = Graph(0, StringIO(NONDETERMINISTIC_FST))
+
+    def test_prune(self):
+        pruned = prune(self.graph, 1.0)
+        self.assertEqual(list(pruned.arcs()), [(0, 'a', 1, -1.0), (1, '<eps>', 3, -0.5), (3, '<eos>', 4, 0.0)])
+        self.assertEqual(prune(self.graph, 10.0).numarcs(), self.graph.numarcs())
+
+    def test_rmepsilon(self):
+        graph = rmepsilon(self.graph)
+        self.assertFalse([arc for arc in graph.arcs() if arc[1] == '<eps>'])
+        self.assertIn((1, '<eos>', 4, -0.5), list(graph.arcs()))
+        self.assertEqual(graph.walk(), (0, -1.5, 'a <eos>'))
+
+    def test_determinize(self):
+        for backend in Graph, ArrayGraph:
+            graph = topsort(determinize(rmepsilon(backend.from_graph(self.graph) if backend is ArrayGraph else self.graph)))
+            self.assertEqual(sorted(graph.arcs()), [(0, 'a', 1, -1.0), (1, '<eos>', 3, -0.5),
+                                                    (1, 'b', 2, -2.0), (2, '<eos>', 3, 0.0)])
+            self.assertEqual(graph.finalstate, 3)
+            self.assertEqual(graph.walk(), (0, -1.5, 'a <eos>'))
+        self.assertRaises(ValueError, determinize, self.graph)
+
+    def test_topsort(self):
+        graph = topsort(Graph(0, StringIO("0 5 x x 1\n5 2 y y 1\n2 7 <eos> <eos> 0\n7\n")))
+        self.assertEqual(list(graph.arcs()), [(0, 'x', 1, -1.0), (1, 'y', 2, -1.0), (2, '<eos>', 3, 0.0)])
+        self.assertEqual(graph.finalstate, 3)
+        self.assertEqual(graph.walk(), (0, -2.0, 'x y <eos>'))
+
+    def test_preprocess(self):
+        graph = preprocess(self.graph, threshold=1.0)
+        self.assertEqual(list(graph.arcs()), [(0, 'a', 1, -1.0), (1, '<eos>', 2, -0.5)])
+
+    def test_epsilon_into_final_state(self):
+        for backend in Graph, ArrayGraph:
+            graph = backend(0, StringIO("0 1 a a 0.5\n1 2 <eps> <eps> 0.1\n0 2 b b 0.2\n2\n"))
+            self.assertIn((1, '<eps>', 2), [arc[:3] for arc in rmepsilon(graph).arcs()])
+            graph = preprocess(graph)
+            self.assertEqual(sorted(arc[:3] for arc in graph.arcs()), [(0, 'a', 1), (0, 'b', 2), (1, '<eps>', 2)])
+            sentno, score, text = graph.walk()
+            self.assertEqual(text, 'b')
+            self.assertAlmostEqual(score, -0.2)
+        self.assertRaises(ValueError, determinize, Graph(0, StringIO("0 1 <eps> <eps> 0.5\n1 2 a a 0.1\n2\n")))
+
+
+class TestBPE(unittest.TestCase):
+    """
+    Regression tests for BPE segmentation of lattice labels
+    """
+    def setUp(self):
+        self.bpe = BPE(StringIO("#version: 0.2\nl o\nlo w</w>\ne r</w>\n"))
+
+    def test_segment_label(self):
+        self.assertEqual(self.bpe.segment_label('low|lower'), 'low|lo@@|w@@|er')
+        self.assertEqual(self.bpe.segment_label('<eos>'), '<eos>')
+        self.assertEqual(self.bpe.segment_label('<eps>'), '<eps>')
+        self.assertEqual(len(self.bpe.label_cache), 3)
+
+    def test_segment_lattice(self):
+        fst = "0 1 low|lower low|lower 1.0\n1 2 <eos> <eos> 0\n2\n"
+        for backend in Graph, ArrayGraph:
+            graph = read_lattice(0, fst, backend, self.bpe)
+            self.assertEqual([arc.numWords() for arc in graph.root.getOutgoingArcs()], [4])
+            self.assertEqual(graph.walk(), (0, -1.0, 'low lo@@ w@@ er <eos>'))
+
+        binary = ArrayGraph(0, StringIO(fst)).to_binary()
+        graph = read_lattice(0, binary, ArrayGraph, self.bpe)
+        self.assertEqual(graph.labels, ['low|lo@@|w@@|er', '<eos>'])
+
+class TestEncoderCache(unittest.TestCase):
+    """
+    Regression tests for the cache of encoder outputs
+    """
+    def test_encode_once(self):
+        calls = []
+        def f_init(x):
+            calls.append(x.shape)
+            return numpy.ones((1, 2)), numpy.ones((x.shape[1], 1, 4))
+
+        cache = EncoderCache(1024)
+        sentence = numpy.array([[[5], [7], [0]]])
+        init_state, ctx = cache.encode(f_init, sentence)
+        self.assertEqual((init_state.dtype, ctx.dtype, ctx.shape), (numpy.float32, numpy.float32, (3, 1, 4)))
+        cache.encode(f_init, sentence.copy())
+        self.assertEqual(calls, [(1, 3, 1)])
+        cache.encode(f_init, numpy.array([[[5], [0]]]))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.bytes, (2 + 12) * 4 + (2 + 8) * 4)
+
+    def test_projected_context(self):
+        def f_init(x):
+            return numpy.ones((1, 2)), numpy.ones((x.shape[1], 1, 4)), numpy.ones((x.shape[1], 1, 3))
+
+        cache = EncoderCache(1024)
+        outputs = cache.encode(f_init, numpy.array([[[5], [0]]]))
+        self.assertEqual([output.shape for output in outputs], [(1, 2), (2, 1, 4), (2, 1, 3)])
+        self.assertEqual(cache.bytes, (2 + 8 + 6) * 4)
+
+    def test_encode_batch(self):
+        # the context of each word is its id, and the initial state the sum of the ids of the sentence
+        def f_init(x):
+            return x[0].sum(0)[:, None] * numpy.ones((1, 2)), x[0][:, :, None] * numpy.ones(4)
+        batches = []
+        def f_init_batched(x, x_mask):
+            batches.append(x.shape[2])
+            self.assertTrue((x[0] * (1 - x_mask) == 0).all())
+            return f_init(x)
+
+        cache = EncoderCache(1024)
+        cache.encode(f_init, numpy.array([[[5], [0]]]))
+        # a batch of four sentences as padded by prepare_data(): one in the cache, and one repeated
+        x = numpy.array([[[5, 6, 6, 7], [0, 8, 8, 0], [0, 0, 0, 0]]])
+        x_mask = numpy.array([[1, 1, 1, 1], [1, 1, 1, 1], [0, 1, 1, 0]], dtype='float32')
+        outputs = cache.encode_batch(f_init_batched, x, x_mask)
+        self.assertEqual(batches, [2])
+        for i, (init_state, ctx) in enumerate(outputs):
+            expected = cache.encode(f_init, x[:, :int(x_mask[:, i].sum()), i:i+1])
+            self.assertEqual(ctx.shape, expected[1].shape)
+            self.assertTrue((init_state == expected[0]).all() and (ctx == expected[1]).all())
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(batches, [2])
+
+class TestShortlist(unittest.TestCase):
+    """
+    Regression tests for vocabulary shortlists
+    """
+    def setUp(self):
+        self.word_dict_src = {'haus': 2, 'das': 3, 'rare': 50}
+        self.word_dict_trg = {'the': 2, 'house': 3, 'home': 4, 'building': 5, 'oov': 9}
+        table = StringIO("haus house 0.6\nhaus home 0.3\nhaus building 0.1\n"
+                         "das the 0.9\nhaus oov 0.8\nunknown the 1.0\nbroken line\n")
+        self.shortlist = Shortlist(self.word_dict_src, self.word_dict_trg, 8, table, per_word=2, frequent=1)
+
+    def test_select(self):
+        self.assertEqual(self.shortlist.select([2, 1, 0]).tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(self.shortlist.select([3, 0]).tolist(), [0, 1, 2])
+        self.assertEqual(self.shortlist.select([3, 2, 3, 0]).tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(self.shortlist.select([]).dtype, numpy.int64)
+
+    def test_frequent_only(self):
+        shortlist = Shortlist(self.word_dict_src, self.word_dict_trg, 8, frequent=100)
+        self.assertEqual(shortlist.select([2, 0]).tolist(), range(8))
+
+if __name__ == '__main__':
+    unittest.main()
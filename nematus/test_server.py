@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import urllib2
+import threading
+import unittest
+
+from Queue import Queue, Empty
+
+from server import TranslationService, TranslationServer
+
+WORD_DICT = {'a': 2, 'b': 3, 'c': 4}
+WORD_IDICT_TRG = {0: '<eos>', 1: 'UNK', 2: 'A', 3: 'B', 4: 'C'}
+
+class StubProcess(object):
+    """A worker process that is alive until it is terminated, or dead from the start"""
+    def __init__(self, alive=True):
+        self.pid = 1234
+        self.exitcode = None if alive else 1
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.alive = False
+
+class StubTranslationService(TranslationService):
+    """
+    A TranslationService whose worker is a thread that 'translates' each word into upper case.
+    It waits until num_sentences sentences have arrived, and then answers them in reverse order.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, num_sentences=0, alive=True, batch_size=2, batch_wait=0.2):
+        self.options = [{'factors': 1}]
+        self.word_dicts = [WORD_DICT]
+        self.word_idict_trg = WORD_IDICT_TRG
+        self.chr_level = False
+        self.verbose = False
+        self.nbest = False
+        self.a_json = False
+        self.print_word_probabilities = False
+        self.return_alignment = False
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self.batches = []
+        queue, rqueue = Queue(), Queue()
+        if alive:
+            worker = threading.Thread(target=self._work, args=(queue, rqueue, num_sentences))
+            worker.daemon = True
+            worker.start()
+        self.start_threads(queue, rqueue, [StubProcess(alive)])
+
+    def _work(self, queue, rqueue, num_sentences):
+        jobs = []
+        while len(jobs) < num_sentences:
+            try:
+                idxs, seqs = queue.get(True, 5)
+            except Empty:
+                break
+            self.batches.append(len(seqs))
+            jobs.extend(zip(idxs, seqs))
+        for idx, seq in reversed(jobs):
+            rqueue.put(([idx], [([w[0] for w in seq], 0., [], None, None)]))
+
+class TestTranslationServer(unittest.TestCase):
+    """
+    Tests of the HTTP translation server, with a stub worker
+    """
+    def start(self, service):
+        self.server = TranslationServer(('localhost', 0), service)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.service.close()
+
+    def post(self, body, content_type='text/plain'):
+        '''Returns the status and the body of the response to a request with body'''
+        url = 'http://localhost:{0}/'.format(self.server.server_address[1])
+        request = urllib2.Request(url, body, {'Content-Type': content_type})
+        try:
+            response = urllib2.urlopen(request, timeout=10)
+            return response.getcode(), response.read()
+        except urllib2.HTTPError as e:
+            return e.code, e.read()
+
+    def test_concurrent_requests(self):
+        self.start(StubTranslationService(num_sentences=4))
+        responses = {}
+        def client(name, body):
+            responses[name] = self.post(body)
+        clients = [threading.Thread(target=client, args=('first', 'a b\nc\n')),
+                   threading.Thread(target=client, args=('second', 'b\na c b\n'))]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+        # the translations come back in reverse order, and are restored to the order of each request
+        self.assertEqual(responses['first'], (200, json.dumps({'translation': 'A B\nC\n'})))
+        self.assertEqual(responses['second'], (200, json.dumps({'translation': 'B\nA C B\n'})))
+        # the sentences of both requests were dispatched together, in batches of at most two
+        self.assertEqual(self.server.service.batches, [2, 2])
+
+    def test_json_request(self):
+        self.start(StubTranslationService(num_sentences=2))
+        status, body = self.post(json.dumps({'text': 'a\nc b'}), 'application/json')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {'translation': 'A\nC B\n'})
+
+    def test_malformed_request(self):
+        self.start(StubTranslationService())
+        self.assertEqual(self.post('{"text": "a b"', 'application/json')[0], 400)
+        self.assertEqual(self.post(json.dumps({'source': 'a b'}), 'application/json')[0], 400)
+        # a word with two factors, for a model with one
+        self.assertEqual(self.post('a|b c')[0], 400)
+
+    def test_dead_worker(self):
+        self.start(StubTranslationService(alive=False))
+        start = time.time()
+        self.assertEqual(self.post('a b')[0], 500)
+        # requests after the crash fail right away
+        self.assertEqual(self.post('c')[0], 500)
+        self.assertTrue(time.time() - start < 5)
+
+if __name__ == '__main__':
+    unittest.main()
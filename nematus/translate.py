@@ -14,12 +14,14 @@ from Queue import Empty
 from util import load_dict, load_config
 from compat import fill_options
 from hypgraph import HypGraphRenderer
+from shortlist import Shortlist
 
 
-def translate_model(queue, rqueue, pid, models, options, k, normalize, verbose, nbest, return_alignment, suppress_unk, return_hyp_graph):
+def translate_model(queue, rqueue, pid, models, options, k, normalize, verbose, nbest, return_alignment, suppress_unk, return_hyp_graph, batch_size=1,
+                    shortlist=None):
 
     from theano_util import (load_params, init_theano_params)
-    from nmt import (build_sampler, gen_sample, init_params)
+    from nmt import (build_sampler, gen_sample, gen_sample_batch, init_params)
 
     from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
     from theano import shared
@@ -39,19 +41,44 @@ def translate_model(queue, rqueue, pid, models, options, k, normalize, verbose,
         tparams = init_theano_params(params)
 
         # word index
-        f_init, f_next = build_sampler(tparams, option, use_noise, trng, return_alignment=return_alignment)
+        f_init, f_next = build_sampler(tparams, option, use_noise, trng, return_alignment=return_alignment,
+                                       batched=batch_size > 1, precompute_context=True,
+                                       shortlist=shortlist is not None)
 
         fs_init.append(f_init)
         fs_next.append(f_next)
 
+    def _shortlist(seqs):
+        # the target words of the output layer for the (first factors of the) source words
+        if shortlist is None:
+            return None
+        return shortlist.select([w[0] for seq in seqs for w in seq])
+
     def _translate(seq):
         # sample given an input sequence and obtain scores
         sample, score, word_probs, alignment, hyp_graph = gen_sample(fs_init, fs_next,
                                    numpy.array(seq).T.reshape([len(seq[0]), len(seq), 1]),
                                    trng=trng, k=k, maxlen=200,
                                    stochastic=False, argmax=False, return_alignment=return_alignment,
-                                   suppress_unk=suppress_unk, return_hyp_graph=return_hyp_graph)
-
+                                   suppress_unk=suppress_unk, return_hyp_graph=return_hyp_graph,
+                                   shortlist=_shortlist([seq]))
+        return _select(sample, score, word_probs, alignment, hyp_graph)
+
+    def _translate_batch(seqs):
+        # pad the source sentences (each followed by eos) into one batch
+        x = numpy.zeros((len(seqs[0][0]), max(len(seq) for seq in seqs), len(seqs))).astype('int64')
+        x_mask = numpy.zeros(x.shape[1:]).astype('float32')
+        for idx, seq in enumerate(seqs):
+            x[:, :len(seq), idx] = zip(*seq)
+            x_mask[:len(seq), idx] = 1.
+
+        samples, scores, word_probs, alignments = gen_sample_batch(fs_init, fs_next, x, x_mask,
+                                   k=k, maxlen=200, return_alignment=return_alignment,
+                                   suppress_unk=suppress_unk, shortlist=_shortlist(seqs))
+        return [_select(sample, numpy.array(score), word_prob, alignment, None)
+                for sample, score, word_prob, alignment in zip(samples, scores, word_probs, alignments)]
+
+    def _select(sample, score, word_probs, alignment, hyp_graph):
         # normalize scores according to sequence lengths
         if normalize:
             lengths = numpy.array([len(s) for s in sample])
@@ -67,12 +94,15 @@ def translate_model(queue, rqueue, pid, models, options, k, normalize, verbose,
         if req is None:
             break
 
-        idx, x = req[0], req[1]
+        idxs, xs = req[0], req[1]
         if verbose:
-            sys.stderr.write('{0} - {1}\n'.format(pid,idx))
-        seq = _translate(x)
+            sys.stderr.write('{0} - {1}\n'.format(pid,idxs[0]))
+        if batch_size > 1:
+            seqs = _translate_batch(xs)
+        else:
+            seqs = [_translate(x) for x in xs]
 
-        rqueue.put((idx, seq))
+        rqueue.put((idxs, seqs))
 
     return
 
@@ -103,15 +133,18 @@ def print_matrices(mm, file):
     print >>file, "\n"
 
 
-def main(models, source_file, saveto, save_alignment=None, k=5,
-         normalize=False, n_process=5, chr_level=False, verbose=False, nbest=False, suppress_unk=False, a_json=False, print_word_probabilities=False, return_hyp_graph=False):
-    # load model model_options
+def load_models(models):
+    '''Returns the options of each model'''
     options = []
     for model in models:
         options.append(load_config(model))
 
         fill_options(options[-1])
+    return options
+
 
+def load_dictionaries(options):
+    '''Returns the source dictionary of each factor, and the target dictionary and its inverse'''
     dictionaries = options[0]['dictionaries']
 
     dictionaries_source = dictionaries[:-1]
@@ -142,15 +175,52 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
     word_idict_trg[0] = '<eos>'
     word_idict_trg[1] = 'UNK'
 
-    # create input and output queues for processes
-    queue = Queue()
-    rqueue = Queue()
+    return word_dicts, word_dict_trg, word_idict_trg
+
+
+def load_shortlist(options, word_dicts, word_dict_trg, shortlist_table=None, shortlist_per_word=100, shortlist_frequent=0):
+    '''Returns the Shortlist that restricts the output layer for each sentence, or None'''
+    if shortlist_table is not None:
+        return Shortlist.from_path(shortlist_table, word_dicts[0], word_dict_trg, options[0]['n_words'],
+                                   per_word=shortlist_per_word, frequent=shortlist_frequent)
+    elif shortlist_frequent > 0:
+        return Shortlist(word_dicts[0], word_dict_trg, options[0]['n_words'], frequent=shortlist_frequent)
+    return None
+
+
+def start_processes(queue, rqueue, n_process, models, options, k, normalize, verbose, nbest, return_alignment,
+                    suppress_unk, return_hyp_graph, batch_size=1, shortlist=None):
+    '''Starts n_process workers (see translate_model()) that read jobs from queue and write translations to rqueue'''
     processes = [None] * n_process
     for midx in xrange(n_process):
         processes[midx] = Process(
             target=translate_model,
-            args=(queue, rqueue, midx, models, options, k, normalize, verbose, nbest, save_alignment is not None, suppress_unk, return_hyp_graph))
+            args=(queue, rqueue, midx, models, options, k, normalize, verbose, nbest, return_alignment, suppress_unk, return_hyp_graph, batch_size,
+                  shortlist))
         processes[midx].start()
+    return processes
+
+
+def words2seq(words, word_dicts, factors):
+    '''
+    Converts the words of a source sentence (with factors separated by '|') into the input of
+    translate_model(): a list of factor ids per word, followed by eos.
+    Raises a ValueError if a word does not have the given number of factors.
+    '''
+    x = []
+    for w in words:
+        w = w.split('|')
+        if len(w) != factors:
+            raise ValueError('expected {0} factors, but input word has {1}'.format(factors, len(w)))
+        x.append([word_dicts[i][f] if f in word_dicts[i] else 1 for (i,f) in enumerate(w)])
+
+    x += [[0]*factors]
+    return x
+
+
+def write_translation(saveto, i, trans, source_words, word_idict_trg, nbest=False, print_word_probabilities=False,
+                      save_alignment=None, a_json=False, return_hyp_graph=False):
+    '''Writes the translation of the i-th sentence, as returned by translate_model(), like translate.py does'''
 
     # utility function
     def _seqs2words(cc):
@@ -161,27 +231,94 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
             ww.append(word_idict_trg[w])
         return ' '.join(ww)
 
+    if nbest:
+        samples, scores, word_probs, alignment, hyp_graph = trans
+        if return_hyp_graph:
+            renderer = HypGraphRenderer(hyp_graph)
+            renderer.wordify(word_idict_trg)
+            renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
+        order = numpy.argsort(scores)
+        for j in order:
+            if print_word_probabilities:
+                probs = " ||| " + " ".join("{0}".format(prob) for prob in word_probs[j])
+            else:
+                probs = ""
+            saveto.write('{0} ||| {1} ||| {2}{3}\n'.format(i, _seqs2words(samples[j]), scores[j], probs))
+            # print alignment matrix for each hypothesis
+            # header: sentence id ||| translation ||| score ||| source ||| source_token_count+eos translation_token_count+eos
+            if save_alignment is not None:
+              if a_json:
+                print_matrix_json(alignment[j], source_words, _seqs2words(samples[j]).split(), i, i+j,save_alignment)
+              else:
+                save_alignment.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
+                                    i, _seqs2words(samples[j]), scores[j], ' '.join(source_words) , len(source_words)+1, len(samples[j])))
+                print_matrix(alignment[j], save_alignment)
+    else:
+        samples, scores, word_probs, alignment, hyp_graph = trans
+        if return_hyp_graph:
+            renderer = HypGraphRenderer(hyp_graph)
+            renderer.wordify(word_idict_trg)
+            renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
+        saveto.write(_seqs2words(samples) + "\n")
+        if print_word_probabilities:
+            for prob in word_probs:
+                saveto.write("{} ".format(prob))
+            saveto.write('\n')
+        if save_alignment is not None:
+          if a_json:
+            print_matrix_json(alignment, source_words, _seqs2words(trans[0]).split(), i, i,save_alignment)
+          else:
+            save_alignment.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
+                                  i, _seqs2words(trans[0]), 0, ' '.join(source_words) , len(source_words)+1, len(trans[0])))
+            print_matrix(alignment, save_alignment)
+
+
+def main(models, source_file, saveto, save_alignment=None, k=5,
+         normalize=False, n_process=5, chr_level=False, verbose=False, nbest=False, suppress_unk=False, a_json=False, print_word_probabilities=False, return_hyp_graph=False,
+         batch_size=1, shortlist_table=None, shortlist_per_word=100, shortlist_frequent=0):
+    # load model model_options
+    options = load_models(models)
+
+    word_dicts, word_dict_trg, word_idict_trg = load_dictionaries(options)
+
+    # restrict the output layer to a shortlist of target words for each sentence
+    shortlist = load_shortlist(options, word_dicts, word_dict_trg, shortlist_table, shortlist_per_word, shortlist_frequent)
+
+    # create input and output queues for processes
+    queue = Queue()
+    rqueue = Queue()
+    processes = start_processes(queue, rqueue, n_process, models, options, k, normalize, verbose, nbest,
+                                save_alignment is not None, suppress_unk, return_hyp_graph, batch_size, shortlist)
+
     def _send_jobs(f):
         source_sentences = []
+        seqs = []
         for idx, line in enumerate(f):
             if chr_level:
                 words = list(line.decode('utf-8').strip())
             else:
                 words = line.strip().split()
 
-            x = []
-            for w in words:
-                w = [word_dicts[i][f] if f in word_dicts[i] else 1 for (i,f) in enumerate(w.split('|'))]
-                if len(w) != options[0]['factors']:
-                    sys.stderr.write('Error: expected {0} factors, but input word has {1}\n'.format(options[0]['factors'], len(w)))
-                    for midx in xrange(n_process):
-                        processes[midx].terminate()
-                    sys.exit(1)
-                x.append(w)
+            try:
+                x = words2seq(words, word_dicts, options[0]['factors'])
+            except ValueError as e:
+                sys.stderr.write('Error: {0}\n'.format(e))
+                for midx in xrange(n_process):
+                    processes[midx].terminate()
+                sys.exit(1)
 
-            x += [[0]*options[0]['factors']]
-            queue.put((idx, x))
+            if batch_size > 1:
+                seqs.append(x)
+            else:
+                queue.put(([idx], [x]))
             source_sentences.append(words)
+
+        if batch_size > 1:
+            # batches of sentences of similar length, to save padding
+            order = sorted(xrange(len(seqs)), key=lambda i: len(seqs[i]))
+            for start in xrange(0, len(order), batch_size):
+                idxs = order[start:start+batch_size]
+                queue.put((idxs, [seqs[i] for i in idxs]))
         return idx+1, source_sentences
 
     def _finish_processes():
@@ -191,7 +328,8 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
     def _retrieve_jobs(n_samples):
         trans = [None] * n_samples
         out_idx = 0
-        for idx in xrange(n_samples):
+        idx = 0
+        while idx < n_samples:
             resp = None
             while resp is None:
                 try:
@@ -207,9 +345,11 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
                                 processes[idx].terminate()
                             sys.stderr.write("Error: translate worker process {0} crashed with exitcode {1}".format(processes[midx].pid, processes[midx].exitcode))
                             sys.exit(1)
-            trans[resp[0]] = resp[1]
-            if verbose and numpy.mod(idx, 10) == 0:
-                sys.stderr.write('Sample {0} / {1} Done\n'.format((idx+1), n_samples))
+            for sidx, seq in zip(*resp):
+                trans[sidx] = seq
+                if verbose and numpy.mod(idx, 10) == 0:
+                    sys.stderr.write('Sample {0} / {1} Done\n'.format((idx+1), n_samples))
+                idx += 1
             while out_idx < n_samples and trans[out_idx] != None:
                 yield trans[out_idx]
                 out_idx += 1
@@ -219,46 +359,9 @@ def main(models, source_file, saveto, save_alignment=None, k=5,
     _finish_processes()
 
     for i, trans in enumerate(_retrieve_jobs(n_samples)):
-        if nbest:
-            samples, scores, word_probs, alignment, hyp_graph = trans
-            if return_hyp_graph:
-                renderer = HypGraphRenderer(hyp_graph)
-		renderer.wordify(word_idict_trg)
-                renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
-            order = numpy.argsort(scores)
-            for j in order:
-                if print_word_probabilities:
-                    probs = " ||| " + " ".join("{0}".format(prob) for prob in word_probs[j])
-                else:
-                    probs = ""
-                saveto.write('{0} ||| {1} ||| {2}{3}\n'.format(i, _seqs2words(samples[j]), scores[j], probs))
-                # print alignment matrix for each hypothesis
-                # header: sentence id ||| translation ||| score ||| source ||| source_token_count+eos translation_token_count+eos
-                if save_alignment is not None:
-                  if a_json:
-                    print_matrix_json(alignment[j], source_sentences[i], _seqs2words(samples[j]).split(), i, i+j,save_alignment)
-                  else:
-                    save_alignment.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
-                                        i, _seqs2words(samples[j]), scores[j], ' '.join(source_sentences[i]) , len(source_sentences[i])+1, len(samples[j])))
-                    print_matrix(alignment[j], save_alignment)
-        else:
-            samples, scores, word_probs, alignment, hyp_graph = trans
-            if return_hyp_graph:
-                renderer = HypGraphRenderer(hyp_graph)
-		renderer.wordify(word_idict_trg)
-                renderer.save_png(return_hyp_graph, detailed=True, highlight_best=True)
-            saveto.write(_seqs2words(samples) + "\n")
-            if print_word_probabilities:
-                for prob in word_probs:
-                    saveto.write("{} ".format(prob))
-                saveto.write('\n')
-            if save_alignment is not None:
-              if a_json:
-                print_matrix_json(alignment, source_sentences[i], _seqs2words(trans[0]).split(), i, i,save_alignment)
-              else:
-                save_alignment.write('{0} ||| {1} ||| {2} ||| {3} ||| {4} {5}\n'.format(
-                                      i, _seqs2words(trans[0]), 0, ' '.join(source_sentences[i]) , len(source_sentences[i])+1, len(trans[0])))
-                print_matrix(alignment, save_alignment)
+        write_translation(saveto, i, trans, source_sentences[i], word_idict_trg, nbest=nbest,
+                          print_word_probabilities=print_word_probabilities, save_alignment=save_alignment,
+                          a_json=a_json, return_hyp_graph=return_hyp_graph)
 
     sys.stderr.write('Done\n')
 
@@ -291,10 +394,22 @@ if __name__ == "__main__":
     parser.add_argument('--suppress-unk', action="store_true", help="Suppress hypotheses containing UNK.")
     parser.add_argument('--print-word-probabilities', '-wp',action="store_true", help="Print probabilities of each word")
     parser.add_argument('--search_graph', '-sg', help="Output file for search graph rendered as PNG image")
+    parser.add_argument('--batch-size', '-b', type=int, default=1,
+                        help="Number of sentences that each process decodes together in one beam search (default: %(default)s)")
+    parser.add_argument('--shortlist', metavar='PATH',
+                        help="Lexical table ('source target score' per line) to restrict the output layer to the candidate translations of the source words")
+    parser.add_argument('--shortlist-per-word', type=int, default=100, metavar='N',
+                        help="Number of candidate translations of each source word in the shortlist (default: %(default)s)")
+    parser.add_argument('--shortlist-frequent', type=int, default=0, metavar='N',
+                        help="Add the N most frequent target words to the shortlist of every sentence; without --shortlist, restrict the output layer to them (default: %(default)s)")
 
     args = parser.parse_args()
+    if args.search_graph and args.batch_size > 1:
+        parser.error('--search_graph is not supported with --batch-size')
 
     main(args.models, args.input,
          args.output, k=args.k, normalize=args.n, n_process=args.p,
          chr_level=args.c, verbose=args.v, nbest=args.n_best, suppress_unk=args.suppress_unk, 
-         print_word_probabilities = args.print_word_probabilities, save_alignment=args.output_alignment, a_json=args.json_alignment, return_hyp_graph=args.search_graph)
+         print_word_probabilities = args.print_word_probabilities, save_alignment=args.output_alignment, a_json=args.json_alignment, return_hyp_graph=args.search_graph,
+         batch_size=args.batch_size, shortlist_table=args.shortlist, shortlist_per_word=args.shortlist_per_word,
+         shortlist_frequent=args.shortlist_frequent)
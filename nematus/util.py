@@ -5,6 +5,7 @@ Utility functions
 import sys
 import json
 import cPickle as pkl
+from collections import OrderedDict
 
 #json loads strings as unicode; we currently still work with Python 2 strings, and need conversion
 def unicode_to_utf8(d):
@@ -41,4 +42,114 @@ def seqs2words(seq, inverse_target_dictionary):
             words.append(inverse_target_dictionary[w])
         else:
             words.append('UNK')
-    return ' '.join(words)
\ No newline at end of file
+    return ' '.join(words)
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache whose capacity is a memory budget (in bytes) rather than a number of entries.
+    sizeof(value) gives the number of bytes taken by a value; by default, values are numpy arrays.
+    """
+    def __init__(self, max_bytes, sizeof=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof is not None else lambda value: value.nbytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            value, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-insert to mark as most recently used
+        self.entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def clear(self):
+        """Removes all entries, but keeps the hit and miss counters"""
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.
+        return '{0} hits, {1} misses ({2:.1%} hit rate), {3} entries, {4:.1f} MB'.format(
+            self.hits, self.misses, hit_rate, len(self.entries), self.bytes / 1024.**2)
+
+
+class EncoderCache(LRUCache):
+    """
+    LRU cache of encoder outputs, keyed by the token ids of the source sentence.
+    Each value is the tuple of outputs of f_init (the initial decoder state, the context and, with a sampler
+    built with precompute_context, the projected context), stored as float32 arrays.
+    """
+    def __init__(self, max_bytes):
+        LRUCache.__init__(self, max_bytes, sizeof=lambda value: sum(output.nbytes for output in value))
+
+    def encode(self, f_init, x):
+        """
+        Returns f_init(x) for a single source sentence x (an array of shape factors x length x 1),
+        running the encoder only if the sentence is not in the cache.
+        """
+        key = self._key(x)
+        value = self.get(key)
+        if value is None:
+            value = tuple(output.astype('float32') for output in f_init(x))
+            self.put(key, value)
+        return value
+
+    def encode_batch(self, f_init, x, x_mask):
+        """
+        Returns the value of encode() for each source sentence of a batch prepared by prepare_data(),
+        given an f_init built with build_init(..., batched=True). The sentences that are not in the
+        cache are encoded together, in a single call of f_init.
+        """
+        lengths = x_mask.sum(0).astype('int64')
+        values = [None] * len(lengths)
+        # the positions in the batch of each sentence that is not in the cache
+        missing = OrderedDict()
+        for i, length in enumerate(lengths):
+            key = self._key(x[:, :length, i:i+1])
+            if key in missing:
+                missing[key].append(i)
+                continue
+            values[i] = self.get(key)
+            if values[i] is None:
+                missing[key] = [i]
+
+        if missing:
+            first = [positions[0] for positions in missing.itervalues()]
+            maxlen = lengths[first].max()
+            outputs = f_init(x[:, :maxlen, first], x_mask[:maxlen, first])
+            for j, (key, positions) in enumerate(missing.iteritems()):
+                # the initial decoder state, and the outputs over the source words without padding
+                length = lengths[positions[0]]
+                value = (outputs[0][j:j+1].astype('float32'),) + \
+                        tuple(output[:length, j:j+1].astype('float32') for output in outputs[1:])
+                self.put(key, value)
+                for i in positions:
+                    values[i] = value
+        return values
+
+    @staticmethod
+    def _key(x):
+        return tuple(tuple(word) for word in x[:, :, 0].T.tolist())
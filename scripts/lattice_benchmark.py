@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares memory use and speed of the object-based lattice (lattice.Graph) with the
+array-based one (lattice.ArrayGraph) on a random lattice in OpenFST text format, and
+with an ArrayGraph loaded from the binary lattice format.
+
+Each backend is measured in its own process, so that the peak memory of one does not
+hide the other.
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import argparse
+import tempfile
+
+from multiprocessing import Process, Queue
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nematus'))
+from lattice import Graph, ArrayGraph, read_lattice
+
+
+def write_lattice(f, num_nodes, arcs_per_node, vocab_size):
+    """Writes a random lattice whose node ids are in topological order"""
+    vocab = ['w{0}'.format(i) for i in xrange(vocab_size)]
+    for tail in xrange(num_nodes - 1):
+        for _ in xrange(arcs_per_node):
+            head = min(num_nodes - 1, tail + random.randint(1, 5))
+            label = '|'.join(random.choice(vocab) for _ in xrange(random.randint(1, 3)))
+            f.write('{0} {1} {2} {2} {3:.4f}\n'.format(tail, head, label, random.random()))
+    f.write('{0}\n'.format(num_nodes - 1))
+
+
+def load_binary(sentno, f):
+    return read_lattice(sentno, f.read(), ArrayGraph)
+
+
+def measure(backend, path, queue):
+    # ru_maxrss is in kilobytes on Linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    graph = backend(0, open(path, 'rb'))
+    load_time = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    graph.walk()
+    walk_time = time.time() - start
+
+    queue.put((graph.numnodes(), graph.numarcs(), load_time, walk_time, (rss_after - rss_before) / 1024.))
+
+
+def main(num_nodes, arcs_per_node, vocab_size):
+    random.seed(1234)
+    with tempfile.NamedTemporaryFile(prefix='lattice-benchmark') as f, \
+            tempfile.NamedTemporaryFile(prefix='lattice-benchmark') as binary:
+        write_lattice(f, num_nodes, arcs_per_node, vocab_size)
+        f.flush()
+        binary.write(ArrayGraph(0, open(f.name)).to_binary())
+        binary.flush()
+
+        print '{0:<12} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9}'.format('backend', 'nodes', 'arcs', 'load (s)', 'walk (s)', 'mem (MB)')
+        for name, backend, path in [('Graph', Graph, f.name),
+                                    ('ArrayGraph', ArrayGraph, f.name),
+                                    ('binary', load_binary, binary.name)]:
+            queue = Queue()
+            process = Process(target=measure, args=(backend, path, queue))
+            process.start()
+            nodes, arcs, load_time, walk_time, memory = queue.get()
+            process.join()
+            print '{0:<12} {1:>9} {2:>9} {3:>9.2f} {4:>9.2f} {5:>9.1f}'.format(name, nodes, arcs, load_time, walk_time, memory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=100000,
+                        help="Number of nodes in the lattice (default: %(default)s)")
+    parser.add_argument('--arcs-per-node', type=int, default=10,
+                        help="Number of outgoing arcs per node (default: %(default)s)")
+    parser.add_argument('--vocab', type=int, default=5000,
+                        help="Number of distinct target words (default: %(default)s)")
+    args = parser.parse_args()
+
+    main(args.nodes, args.arcs_per_node, args.vocab)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Packs per-sentence lattices in OpenFST text format (e.g. as written by gen_lattice.sh)
+into a single lattice archive that rescore_graph.py can read with one open.
+With --binary, the lattices are converted into the binary lattice format, which
+loads without parsing.
+
+Example:
+
+    python pack_lattices.py --pattern 'lattices/test.osg.{}.p=4.bpe.fst.txt' --output test.lattices
+"""
+
+import os
+import re
+import sys
+import glob
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nematus'))
+from lattice import LatticeArchiveWriter, ArrayGraph
+
+
+def main(pattern, output, binary=False):
+    if not '{}' in pattern:
+        sys.stderr.write('Error: no {} pattern found in file spec\n')
+        sys.exit(1)
+
+    # find the files matching the pattern, and the sentence number of each
+    prefix, suffix = pattern.split('{}', 1)
+    sentno_re = re.compile(re.escape(prefix) + r'(\d+)' + re.escape(suffix) + '$')
+    files = []
+    for path in glob.glob(prefix + '*' + suffix):
+        match = sentno_re.match(path)
+        if match:
+            files.append((int(match.group(1)), path))
+    files.sort()
+
+    with LatticeArchiveWriter(output) as archive:
+        for sentno, path in files:
+            with open(path, 'rb') as f:
+                if binary:
+                    archive.add(sentno, ArrayGraph(sentno, f).to_binary())
+                else:
+                    archive.add(sentno, f.read())
+
+    sys.stderr.write('Packed {0} lattices into {1}\n'.format(len(files), output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pattern', '-p', type=str, required=True,
+                        help="Input lattice files, with {} in place of the sentence number")
+    parser.add_argument('--output', '-o', type=str, required=True,
+                        help="Output lattice archive")
+    parser.add_argument('--binary', '-b', action='store_true',
+                        help="Store lattices in the binary lattice format rather than as OpenFST text")
+    args = parser.parse_args()
+
+    main(args.pattern, args.output, binary=args.binary)
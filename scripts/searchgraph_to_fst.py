@@ -2,159 +2,134 @@
 # -*- coding: utf-8 -*-
 
 """
-Takes a single Moses search graph on STDIN and writes out a corresponding FST and dictionary.
+Converts a Moses search graph (as written with "-osg FILE"), which may hold the search graphs
+of many sentences, into lattices. The input is read once.
+
+By default, an FST in OpenFST text format and a symbol table are written for each sentence
+(<prefix>.<sentno>.fst.txt and <prefix>.<sentno>.keys). With --archive, all lattices are
+written into a single lattice archive instead, which rescore_graph.py reads directly.
+With --optimize, the lattices in the archive are also pruned, made epsilon-free, determinized
+and sorted topologically (see lattice_ops.py), in --processes parallel processes.
+
+Sentences are numbered from 0. Moses writes no search graph for some sentences (e.g. empty
+ones); they get a lattice with only the empty translation, so that there is a lattice for every
+sentence up to the last one in the search graph, or up to --num-sentences.
 """
 
+import os
 import sys
 import codecs
 import argparse
 
-reload(sys)
-sys.setdefaultencoding('utf-8')
-sys.stdin = codecs.getreader('utf-8')(sys.stdin)
-sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
-sys.stdout.encoding = 'utf-8'
+from itertools import groupby
+from StringIO import StringIO
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nematus'))
+from lattice import Graph, ArrayGraph, LatticeArchiveWriter
+from searchgraph import search_graph_arcs, write_fst
+from lattice_ops import preprocess
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--prefix', type=str, default='graph',
                     help="prefix to use in naming output graphs")
 parser.add_argument('--input', type=str, default=None,
-                    help="The file with corresponding input sentences")
+                    help="The file with corresponding input sentences, whose covered phrases become the input labels of the per-sentence FSTs")
+parser.add_argument('--num-sentences', type=int, default=None, metavar='N',
+                    help="Number of sentences to write lattices for (default: the number of lines of --input, if given)")
+parser.add_argument('--search-graph', type=argparse.FileType('r'), default=sys.stdin,
+                    help="The Moses search graph (default: standard input)")
+parser.add_argument('--archive', type=str, default=None,
+                    help="Write all lattices into this lattice archive instead of one FST per sentence")
+parser.add_argument('--binary', action='store_true',
+                    help="Store lattices in the archive in the binary lattice format")
+parser.add_argument('--optimize', action='store_true',
+                    help="Remove epsilons from, determinize and topologically sort the lattices in the archive")
+parser.add_argument('--prune', type=float, default=None, metavar='WEIGHT',
+                    help="With --optimize, remove arcs that are not on a path within WEIGHT of the best path")
+parser.add_argument('--processes', '-p', type=int, default=1,
+                    help="Number of processes converting lattices for the archive (default: %(default)s)")
 args = parser.parse_args()
-
-# to run: python searchgraph_to_fst.py [graph file] 
-# to view the graph: use graphvis gui 
-
-FST = False
-if args.input is not None:
-        FST = True
-	input_text = codecs.open(args.input,'rb','utf-8').readlines()
-
-graph_file = sys.stdin
-
-#get all the edges in a string
-edgelist=""
-end_nodes=[]
-nodes=[]
-
-
-#create an indexer for all the labels
-indexer = {}
-indexer["<eps>"]=0
-max_index=0
-
-
-
-def get_index(word):
-	global max_index
-	global indexer
-	if word in indexer:
-		return indexer[word]
-	else: 
-		max_index+=1
-		indexer[word]=max_index
-		return indexer[word]
-
-def print_string_indices():
-	out_indicies=""
-	for key in indexer:
-		out_indicies+=key +" "+ str(indexer[key]) + "\n"
-
-	keys_file.write(out_indicies)
-
-
-
-line = graph_file.readline()
-line_num = int(line[0: line.find(" ")])
-
-while not line =='':
-        e_start = line.find("recombined=")
-	if e_start <0: # recombined not found, just use hype node
-		e_start = line.find("hyp=")+4 
-		e_end =  line.find(" ",e_start)
-		e = line[e_start:e_end ]
-	else:
-		e_start +=11
-		e_end =  line.find(" ",e_start)
-		e = line[e_start:e_end ]
-
-
-	s_start = line.find("back=") 
-	if s_start <0: # back not found, this is just the start node	
-		line = graph_file.readline()
-		continue
-	s_start += 5 
-	s_end =  line.find(" ",s_start)
-	s = line[s_start:s_end ]
-
-	weight_start = line.find("transition=") +11
-	weight_end = line.find(" ",weight_start)
-	weight=line[weight_start:weight_end]
-
-
-	#check if this is an end node
-	end_start = line.find("forward=") +8
-	end_end = line.find(" ",end_start)
-	end=line[end_start:end_end]
-	if end=="-1":
-		end_nodes+= [int(e)]
-
-	nodes+= [int(e)] + [int(s)]
-
-
-
-	label_start = line.find("out=")+4 
-	label_end = line.find("\n")
-	label = line[label_start:label_end ]
-
-	#add label to hash table
-	label=label.replace(" ", "|")
-	get_index(label)
-	
-	if FST:
-		input_text_line=input_text[int(line_num)].split()
-		coverage_1_start=line.find("covered=") +8
-		coverage_1_end=  line.find("-",coverage_1_start)
-		coverage_1 = line[coverage_1_start: coverage_1_end]
-
-		coverage_2_start=coverage_1_end +1
-		coverage_2_end=  line.find(" ",coverage_2_start)
-		coverage_2 = line[coverage_2_start: coverage_2_end]
-
-		coverage =  "|".join(input_text_line[int(coverage_1): int(coverage_2)+1])
-		get_index(coverage)
-
-		edgelist+= str(s) +" " + str(e) +" "+ coverage +" "+ label + " "+ str(-1*float(weight))+"\n"
-	else:
-		edgelist+= str(s) +" " + str(e) +" "+ label +" "+ label + " "+ str(-1*float(weight))+"\n"
-
-	#advance loop
-	line = graph_file.readline()
-	
-
-###Write out the files
-fout_name = "{}.{}.fst.txt".format(args.prefix, line_num)
-fout_keys_name = "{}.{}".format(args.prefix, line_num) +  ".keys"
-fst_file=codecs.open(fout_name,'wb','utf-8')
-keys_file=codecs.open(fout_keys_name,'wb','utf-8')
-
-
-nodes=set(nodes) 
-end_nodes=set(end_nodes)
-
-end = max(nodes)
-
- # add endstate for all nodes that dont have one
-end +=1
-for node in end_nodes:
-	get_index("</eos>")
- 	edgelist+= str(node) + " " + str(end) + " </eos> </eos> 0\n"
-
-edgelist+= str(end)
-
-
-#write edgelist
-fst_file.write(edgelist)
-
-#make the keys file for the symbol table 
-print_string_indices()
+if args.archive is not None and args.input is not None:
+    parser.error('lattices in an archive have no input labels; --input cannot be combined with --archive')
+
+# to run: python searchgraph_to_fst.py < [graph file]
+# to view the graph: use graphvis gui
+
+
+def write_sentence(sentno, lines, input_text=None):
+    """Writes the FST and symbol table of one sentence"""
+
+    source_words = input_text[sentno].split() if input_text is not None else None
+    arcs, finalstate = search_graph_arcs(lines, source_words=source_words)
+    with codecs.open('{0}.{1}.fst.txt'.format(args.prefix, sentno), 'wb', 'utf-8') as fst_file, \
+            codecs.open('{0}.{1}.keys'.format(args.prefix, sentno), 'wb', 'utf-8') as keys_file:
+        write_fst(arcs, finalstate, fst_file, keys_file)
+
+
+def all_sentences(sentences, num_sentences=None):
+    """
+    Yields the (sentno, lines) pairs of sentences, and (sentno, []) for each sentence up to
+    num_sentences without a search graph
+    """
+    def _missing(begin, end):
+        for sentno in xrange(begin, end):
+            sys.stderr.write('Warning: no search graph for sentence {0}; writing the empty translation\n'.format(sentno))
+            yield sentno, []
+
+    expected = 0
+    for sentno, lines in sentences:
+        if sentno < expected:
+            sys.stderr.write('Error: the lines of sentence {0} are not contiguous, or not in order\n'.format(sentno))
+            sys.exit(1)
+        if num_sentences is not None and sentno >= num_sentences:
+            sys.stderr.write('Error: the search graph has sentence {0}, but there are {1} sentences\n'.format(sentno, num_sentences))
+            sys.exit(1)
+        for missing in _missing(expected, sentno):
+            yield missing
+        yield sentno, lines
+        expected = sentno + 1
+    for missing in _missing(expected, num_sentences or 0):
+        yield missing
+
+
+def convert(sentence):
+    """Converts the search graph of one sentence into a serialized lattice for the archive"""
+
+    sentno, lines = sentence
+    arcs, finalstate = search_graph_arcs(lines)
+    graph = Graph.from_arcs(sentno, arcs, finalstate)
+    if args.optimize:
+        graph = preprocess(graph, args.prune)
+
+    if args.binary:
+        return sentno, ArrayGraph.from_graph(graph).to_binary()
+    fst = StringIO()
+    graph.write_fst(fst)
+    return sentno, fst.getvalue()
+
+
+if args.archive is not None:
+    lines = (line for line in args.search_graph if line.strip())
+    sentences = all_sentences(((sentno, list(sentence_lines))
+                               for sentno, sentence_lines in groupby(lines, key=lambda line: int(line.split(None, 1)[0]))),
+                              args.num_sentences)
+    pool = Pool(args.processes) if args.processes > 1 else None
+    with LatticeArchiveWriter(args.archive) as archive:
+        for sentno, data in (pool.imap(convert, sentences) if pool else (convert(sentence) for sentence in sentences)):
+            archive.add(sentno, data)
+    if pool:
+        pool.close()
+else:
+    input_text = None
+    num_sentences = args.num_sentences
+    if args.input is not None:
+        input_text = codecs.open(args.input, 'rb', 'utf-8').readlines()
+        if num_sentences is None:
+            num_sentences = len(input_text)
+
+    graph_file = codecs.getreader('utf-8')(args.search_graph)
+    lines = (line for line in graph_file if line.strip())
+    sentences = groupby(lines, key=lambda line: int(line.split(None, 1)[0]))
+    for sentno, sentence_lines in all_sentences(sentences, num_sentences):
+        write_sentence(sentno, sentence_lines, input_text)
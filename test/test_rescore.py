@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import json
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+from rescore import main as rescore
+from test_score import load_wmt16_model
+
+
+class TestRescore(unittest.TestCase):
+    """
+    Regression tests for n-best rescoring with WMT16 models
+    """
+
+    def setUp(self):
+        """
+        Download pre-trained models, and make an n-best list of the references
+        """
+        load_wmt16_model('en','de')
+        with open('en-de/references') as references, open('en-de/out_nbest', 'w') as nbest:
+            for i, line in enumerate(references):
+                # two translations per sentence
+                nbest.write('{0} ||| {1} ||| 0\n'.format(i, line.strip()))
+                words = line.split()
+                nbest.write('{0} ||| {1} ||| 0\n'.format(i, ' '.join(words[:max(1, len(words) - 1)])))
+        self.num_lines = 2 * (i + 1)
+
+    # alignment weights (-w) of the first model, for each line of the n-best list
+    def test_alignweights(self):
+        for shared_source in False, True:
+            os.chdir('models/en-de/')
+            rescore(['model.npz'], open('../../en-de/in'), open('../../en-de/out_nbest'), open('../../en-de/out_rescore','w'),
+                    alignweights=True, shared_source=shared_source)
+            os.chdir('../..')
+            self.assertEqual(len(open('en-de/out_rescore').readlines()), self.num_lines)
+            alignments = [json.loads(line) for line in open('en-de/out_rescore_withwords.json')]
+            self.assertEqual(len(alignments), self.num_lines)
+            # one row per target word and <eos>, one column per source word and <eos>
+            for alignment in alignments:
+                self.assertEqual(len(alignment['matrix']), len(alignment['target_sent'].split()) + 1)
+                self.assertEqual(len(alignment['matrix'][0]), len(alignment['source_sent'].split()) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()